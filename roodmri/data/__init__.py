@@ -13,4 +13,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from .generator import DatasetGenerator
+from roodmri.utils.misc import lazy_attributes
+
+__all__ = ['BenchmarkDataset', 'DatasetGenerator', 'DecodedCache', 'SampleIndex']
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    'BenchmarkDataset': '.dataset',
+    'DatasetGenerator': '.generator',
+    'DecodedCache': '.cache',
+    'SampleIndex': '.index'
+})
@@ -0,0 +1,133 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+from pathlib import Path
+import pickle
+
+import monai.transforms as tf
+import numpy as np
+
+CACHE_VERSION = 1   # bump when the format of cache entries changes
+
+
+class DecodedCache(object):
+    """
+    Cache of decoded input files, stored as memory-mappable arrays.
+
+    The first time a file is loaded, it is decoded with MONAI's LoadImage
+    (e.g., gzip decompression of a .nii.gz file) and the resulting float32
+    array is saved uncompressed to the cache directory as a .npy file, next
+    to its meta data (affine, header fields, ...). Later loads, from any
+    process, memory-map that array instead of decoding the file again: the
+    data is only read from disk when it is accessed, and processes loading
+    the same file share the operating system's page cache instead of each
+    holding a decoded copy. Arrays are mapped copy-on-write, so transforms
+    may modify them in place without changing the cache.
+
+    Entries are keyed by the resolved path, modification time and size of
+    the source file, so a modified source is decoded again. If max_bytes is
+    set, least recently used entries are deleted when the cache grows beyond
+    it. Entries are written under temporary names and renamed, so several
+    processes can share a cache directory.
+
+    Args:
+        cache_dir: Path to the cache directory (created if needed).
+        max_bytes (optional): Maximum total size of the cache in bytes. If
+            None, the cache is not bounded. Default is None.
+    """
+
+    def __init__(self, cache_dir, max_bytes = None):
+        assert max_bytes is None or max_bytes > 0, "max_bytes should be None or positive."
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def load(self, path):
+        """
+        Load a file through the cache.
+
+        Returns:
+            Tuple (array, meta data) equal to the output of
+            LoadImage(image_only=False)(path), with the array memory-mapped.
+        """
+        array_path, meta_path = self._entry_paths(path)
+        try:
+            with open(meta_path, 'rb') as f:
+                meta = pickle.load(f)
+            array = np.load(array_path, mmap_mode='c')
+        except (OSError, EOFError, pickle.UnpicklingError):   # missing or evicted
+            array, meta = tf.LoadImage(image_only=False)(str(path))
+            self._write(array_path, lambda f: np.save(f, array))
+            self._write(meta_path, lambda f: pickle.dump(meta, f))
+            self._evict()
+            array = np.load(array_path, mmap_mode='c')
+        else:
+            os.utime(array_path)   # mark as recently used
+        return array, meta
+
+    def size(self):
+        """Total size of the cache entries in bytes."""
+        return sum(path.stat().st_size for path in self.cache_dir.glob('*.np[yk]'))
+
+    def clear(self):
+        """Delete all cache entries."""
+        for path in self.cache_dir.glob('*.np[yk]'):
+            path.unlink(missing_ok=True)
+
+    def _entry_paths(self, path):
+        path = Path(path).resolve()
+        stat = path.stat()
+        key = hashlib.sha1(f'{CACHE_VERSION}|{path}|{stat.st_mtime_ns}|{stat.st_size}'
+                           .encode()).hexdigest()
+        return self.cache_dir / f'{key}.npy', self.cache_dir / f'{key}.npk'
+
+    def _write(self, path, write_fn):
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            write_fn(f)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes."""
+        if self.max_bytes is None:
+            return
+        entries = []
+        for array_path in self.cache_dir.glob('*.npy'):
+            meta_path = array_path.with_suffix('.npk')
+            try:
+                stat = array_path.stat()
+                size = stat.st_size + (meta_path.stat().st_size if meta_path.exists() else 0)
+            except FileNotFoundError:   # evicted by another process
+                continue
+            entries.append((stat.st_mtime, size, array_path, meta_path))
+        total = sum(entry[1] for entry in entries)
+        # the newest entry (just written) is kept even if it alone exceeds max_bytes
+        for _, size, array_path, meta_path in sorted(entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            # processes that already mapped the array keep their mapping
+            array_path.unlink(missing_ok=True)
+            meta_path.unlink(missing_ok=True)
+            total -= size
+
+
+def get_cache(input_cache):
+    """DecodedCache from a DecodedCache, a path to a cache directory or None."""
+    if input_cache is None or isinstance(input_cache, DecodedCache):
+        return input_cache
+    return DecodedCache(input_cache)
+
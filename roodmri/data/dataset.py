@@ -0,0 +1,168 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from copy import deepcopy
+
+import monai.transforms as tf
+from monai.utils import MAX_SEED
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from roodmri.data.cache import get_cache
+from roodmri.data.generator import (_batched_transform, _configure_transform,
+                                    _load_subject, _num_severities, _sample_affine,
+                                    _set_random_state)
+from roodmri.data.utils import image_keys, is_file_list
+from roodmri.transforms import defaults
+from roodmri.utils.misc import sample_seed
+
+
+class BenchmarkDataset(Dataset):
+    """
+    Benchmarking dataset whose samples are generated on the fly.
+
+    Each item is one (subject, transform, severity level) sample, transformed
+    when it is requested instead of being read from a benchmarking dataset
+    saved by DatasetGenerator, so nothing is written to disk. Samples are
+    reproducible: the random state of the transforms is reset before each
+    sample using the same per-sample seed as DatasetGenerator, so a
+    BenchmarkDataset and a DatasetGenerator with the same input_files,
+    transform_settings and seed produce the same samples, in any order and
+    with any number of DataLoader workers.
+
+    Samples are ordered subject by subject, and each subject's decoded image
+    and label are kept in a small cache, so iterating in order (e.g., with a
+    DataLoader without shuffling) decodes each input file only once per
+    worker process.
+
+    Each item is a dictionary with the transformed 'image' (with one channel
+    per modality for multi-modality subjects) and 'label' (as tensors), the
+    'affine' of the transformed image (which differs from that of the input
+    image if a transform resamples it, e.g., Spacingd), and the 'subject_id',
+    'transform' and 'severity' of the sample. Samples of different subjects
+    can be batched together if their images have the same shape.
+
+    Args:
+        input_files: List of dictionaries containing the paths to images (or
+            one image per modality) and labels in the test set, as for
+            DatasetGenerator.
+        transform_settings (optional): Dictionary containing transforms and
+            settings for the severity levels, as for DatasetGenerator. If
+            None, the defaults in roodmri/transforms/defaults.py are used.
+            Default is None.
+        seed (optional): Integer global random seed (see DatasetGenerator). If
+            None, random transforms use the current global random state and
+            samples are not reproducible. Default is 0.
+        clean_label (optional): If not None, each subject's untransformed
+            image and label is included as a sample with transform clean_label
+            and severity 0 (e.g., 'Clean'), before its transformed samples.
+            Default is None.
+        cache_size (optional): Number of decoded subjects kept in memory by
+            each process. Default is 2.
+        input_cache (optional): Path to a cache directory, or DecodedCache,
+            through which input files are read (see DatasetGenerator).
+            DataLoader workers then share the decoded, memory-mapped inputs.
+            Default is None.
+    """
+
+    def __init__(self, input_files, transform_settings = None, seed = 0,
+                 clean_label = None, cache_size = 2, input_cache = None):
+        assert is_file_list(input_files)
+        assert isinstance(cache_size, int) and cache_size > 0, \
+            "cache_size should be a positive integer."
+        self.input_files = input_files
+        self.modalities = image_keys(input_files[0])
+        if transform_settings is not None:
+            self.transform_settings = transform_settings
+        else:
+            self.transform_settings = defaults.DEFAULT_TRANSFORM_SETTINGS
+        self.seed = seed
+        self.clean_label = clean_label
+        self.cache_size = cache_size
+        self.input_cache = get_cache(input_cache)
+        tasks = [(transform_name, i)
+                 for transform_name, settings in self.transform_settings.items()
+                 for i in range(_num_severities(settings))]
+        if clean_label is not None:
+            tasks.insert(0, (clean_label, -1))
+        self.samples = [(j, transform_name, i)
+                        for j in range(len(input_files)) for transform_name, i in tasks]
+        self._loaded = OrderedDict()   # decoded subjects, least recently used first
+        self._transforms = dict()      # (configured, batched) transforms, by (transform, index)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        j, transform_name, i = self.samples[index]
+        subject_id = self.subject_id(j)
+        loaded = self._load(j)
+        if transform_name == self.clean_label and i == -1:
+            data = deepcopy(loaded)
+        else:
+            data = self._transform(loaded, transform_name, i, subject_id)
+        return {
+            'image': torch.as_tensor(data['image']),
+            'label': torch.as_tensor(data['label']),
+            'affine': torch.as_tensor(_sample_affine(data, loaded['image_meta_dict']['affine'])),
+            'subject_id': subject_id,
+            'transform': transform_name,
+            'severity': i + 1
+        }
+
+    @staticmethod
+    def subject_id(j):
+        """Subject ID of the j-th input file, as in DatasetGenerator."""
+        return str(j + 1).zfill(6)
+
+    def _load(self, j):
+        """Decoded image and label of the j-th input file, through the cache."""
+        if j in self._loaded:
+            self._loaded.move_to_end(j)
+        else:
+            self._loaded[j] = _load_subject(self.input_files[j], self.input_cache,
+                                            self.modalities)
+            while len(self._loaded) > self.cache_size:
+                self._loaded.popitem(last=False)
+        return self._loaded[j]
+
+    def _transform(self, loaded, transform_name, i, subject_id):
+        """
+        Apply the transforms for severity index i to a copy of a loaded subject.
+
+        As in DatasetGenerator, a batched implementation of the transform (see
+        roodmri/transforms/batched.py) is used if there is one, so samples
+        match generated files exactly.
+        """
+        settings = self.transform_settings[transform_name]
+        if (transform_name, i) not in self._transforms:
+            self._transforms[(transform_name, i)] = (
+                _configure_transform(settings, i), _batched_transform(settings))
+        transform, batched = self._transforms[(transform_name, i)]
+        transforms = tf.Compose(settings['pre_transforms'] + [transform]
+                                + settings['post_transforms'])
+        if self.seed is None:
+            transforms.set_random_state(seed=np.random.randint(MAX_SEED))
+            seed = None
+        else:
+            seed = sample_seed(self.seed, transform_name, i + 1, subject_id)
+            _set_random_state(transforms, seed)
+        if batched is None:
+            return transforms(deepcopy(loaded))
+        data = tf.Compose(settings['pre_transforms'])(deepcopy(loaded))
+        data = batched([transform], data, [seed])[0]
+        return tf.Compose(settings['post_transforms'])(data)
@@ -0,0 +1,117 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+
+STAGES = ['load', 'transform', 'write']
+
+
+class JsonLinesHook(object):
+    """
+    Append each sample record to a JSON-lines file.
+
+    Records are written one per line and flushed immediately, so the file
+    can be followed (e.g., with tail -f) while a job is running.
+
+    Args:
+        path: Path of the JSON-lines file. Records are appended if it exists.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def __call__(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+class PrometheusHook(object):
+    """
+    Keep Prometheus-style counters of sample records in a text file.
+
+    After each record, the file is rewritten (via a temporary file, so it is
+    never read half-written) in the Prometheus text exposition format, e.g.,
+    for node_exporter's textfile collector. Counters are labelled by
+    transform and severity level:
+
+        {prefix}_samples_total: number of samples written
+        {prefix}_seconds_total: time spent, with an additional stage label
+            ('load', 'transform' or 'write')
+        {prefix}_bytes_written_total: bytes written
+
+    Args:
+        path: Path of the text file (conventionally ending in .prom).
+        prefix (optional): Prefix of the metric names. Default is
+            'roodmri_generation'.
+    """
+
+    def __init__(self, path, prefix = 'roodmri_generation'):
+        self.path = Path(path)
+        self.prefix = prefix
+        self.samples = dict()
+        self.seconds = dict()
+        self.bytes_written = dict()
+
+    def __call__(self, record):
+        labels = (record['transform'], record['severity'])
+        self.samples[labels] = self.samples.get(labels, 0) + 1
+        self.bytes_written[labels] = self.bytes_written.get(labels, 0) + record['bytes_written']
+        for stage in STAGES:
+            key = labels + (stage,)
+            self.seconds[key] = self.seconds.get(key, 0.0) + record[f'{stage}_time']
+        self.write()
+
+    def write(self):
+        """Write the current counters to the text file."""
+        lines = []
+        for name, help_text, values, label_names in [
+                ('samples_total', 'Number of samples written.', self.samples,
+                 ['transform', 'severity']),
+                ('seconds_total', 'Time spent generating samples, by stage.', self.seconds,
+                 ['transform', 'severity', 'stage']),
+                ('bytes_written_total', 'Bytes written.', self.bytes_written,
+                 ['transform', 'severity'])]:
+            lines.append(f'# HELP {self.prefix}_{name} {help_text}')
+            lines.append(f'# TYPE {self.prefix}_{name} counter')
+            for labels, value in sorted(values.items()):
+                label_text = ','.join(f'{label}="{value}"'
+                                      for label, value in zip(label_names, labels))
+                lines.append(f'{self.prefix}_{name}{{{label_text}}} {value}')
+        tmp_path = self.path.with_name(f'.{self.path.name}.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.path)
+
+
+def jsonable(value):
+    """Convert transform parameter values (tuples, arrays, tensors) for JSON."""
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu().numpy()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [jsonable(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): jsonable(item) for key, item in value.items()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
@@ -13,25 +13,45 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from copy import deepcopy
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from copy import copy, deepcopy
 import csv
+from itertools import groupby
+import os
 from pathlib import Path
+import random
+import shutil
+import tempfile
 import time
 
-from monai.data import DataLoader, Dataset, write_nifti
 import monai.transforms as tf
+from monai.utils import MAX_SEED
 import numpy as np
 import torch
 
-from roodmri.data.utils import is_file_list
-from roodmri.transforms.defaults import DEFAULT_TRANSFORM_SETTINGS
-from roodmri.utils.misc import rgetattr, rsetattr
+from roodmri.data.cache import get_cache
+from roodmri.data.events import jsonable
+from roodmri.data.index import SampleIndex
+from roodmri.data.manifest import Manifest, manifest_paths, params_hash, source_signature
+from roodmri.data.utils import image_keys, is_file_list, scan_input_files
+from roodmri.data.writers import (BackgroundWriter, get_writer, path_checksum, path_mtime,
+                                  path_size)
+from roodmri.transforms.batched import get_batched_transform, is_random_transform
+from roodmri.transforms import defaults
+from roodmri.utils.misc import rgetattr, rsetattr, sample_seed
 
 BASE_TRANSFORMS = [
     tf.LoadImaged(keys=['image', 'label']),
     tf.AddChanneld(keys=['image', 'label'])
 ]
-DEVICE = torch.device("cpu")
+LABEL_LINK_MODES = ['hardlink', 'symlink', 'manifest']
+IMAGE_DTYPES = ['float32', 'int16', 'float16']
+LABEL_DTYPES = ['float32', 'uint8']
+TYPE_CONVERSION_TRANSFORMS = (tf.ToTensord, tf.ToNumpyd)
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'NUMEXPR_NUM_THREADS']
+
+_worker_generator = None   # set in each worker process by _init_worker
 
 
 class DatasetGenerator(object):
@@ -52,13 +72,179 @@ class DatasetGenerator(object):
             image file (e.g., a brain MRI NIfTI file); 'label': full path to
             the 'ground truth' binary segmentation. For an example of how to
             produce a list like this, see input_file_globbing.py in the examples
-            directory.
+            directory. Multi-modality subjects have one key per modality
+            instead of 'image' (e.g., 't1', 'flair' and 't2', with the same
+            keys for every subject): the modalities are loaded as the channels
+            of the 'image' the transforms act on, in the order of the keys of
+            the first dictionary, so each sample is computed in one pass with
+            the same random transform for every modality (spatial transforms
+            resample all channels together). Each modality is then saved to
+            its own file, named with its key instead of 'image'.
         out_path: string specifying the full path to the directory where the
             benchmarking dataset will be stored.
         transform_settings (optional): Dictionary containing transforms and settings for
             the severity levels to be used in generating the benchmarking
             dataset. For an example of the structure of such a dictionary, see
-            the defaults in roodmri/transforms/defaults.py.
+            the defaults in roodmri/transforms/defaults.py. Each entry may also
+            include an optional 'label_preserving' boolean stating whether the
+            label passes through the transforms unchanged. If it is omitted,
+            this is inferred from the keys/include of the transforms (see
+            label_links). Entries may also include an optional
+            'batched_transform' callable that applies the transform at several
+            severity levels in one pass (see roodmri/transforms/batched.py), or
+            None to disable batching. If it is omitted, the batched
+            implementation registered for the type of the transform (if any)
+            is used, provided the pre/post transforms are not random.
+        load_once (optional): Boolean describing whether to process the test
+            set subject by subject rather than transform by transform. If True,
+            each subject's image and label are loaded (decoded) only once and
+            every transform/severity level in transform_settings is applied to
+            copies of the loaded arrays before moving on to the next subject.
+            This avoids re-reading each input file once per transform and
+            severity level. Output paths and file names are the same in both
+            modes. Default is False.
+        num_workers (optional): Number of worker processes used to generate
+            samples. Each unit of work (a subject and the transform/severity
+            levels to apply to it) is sent to a process pool, with at most
+            2 x num_workers units queued at any time. If 0, all units are
+            processed one after another in the current process. Default is 0.
+        threads_per_worker (optional): Number of torch/BLAS threads each worker
+            process may use. Keeping this small avoids oversubscribing the CPU
+            when num_workers is large. Only used if num_workers > 0. Default is
+            1.
+        resume (optional): Boolean describing whether to skip samples that
+            were already written by a previous run. Every completed sample is
+            recorded in a manifest file (manifest.jsonl) in out_path, keyed by
+            subject ID, transform and severity level along with a hash of the
+            transform's parameters and the size/modification time of the source
+            files. If True, samples whose record matches the current settings
+            and whose files pass the check chosen with verify are skipped, so
+            an interrupted run can be restarted, and transforms or subjects can
+            be added to an existing benchmarking dataset, without regenerating
+            everything. Missing, partially written, corrupted or stale samples
+            are regenerated. If False, all samples are regenerated. Default is
+            True.
+        seed (optional): Integer global random seed. If specified, the random
+            state of the transforms (torch, numpy, Python and MONAI random
+            states) is reset before each sample using a seed derived from
+            (seed, transform name, severity level, subject ID), so each sample
+            is reproducible independently of the order in which samples are
+            generated, of num_workers and of sharding. If None, random
+            transforms use the current global random state. Default is None.
+        shard_index (optional): Integer index of the shard of the work to
+            generate with this object, between 0 and num_shards - 1. Default
+            is 0.
+        num_shards (optional): Integer number of disjoint shards the work is
+            split into. Running one generator per shard_index (e.g., one per
+            cluster node) with the same seed produces the same files as a
+            single run with num_shards = 1. Work is split by subject, so the
+            samples (and shared label) of a subject are all written by one
+            shard, and each shard records its samples in its own manifest file
+            (manifest.{shard_index}.jsonl). Shards do not save the sample index
+            (see write_index). Default is 1.
+        label_links (optional): How to store labels for label-preserving
+            transforms (e.g., intensity transforms such as BiasField or
+            RicianNoise, which leave the label untouched). A transform is
+            label-preserving if its settings say so ('label_preserving') or,
+            otherwise, if neither the transform nor any of its pre/post
+            transforms (other than ToTensord/ToNumpyd) acts on 'label'. For
+            these transforms the label is written once per subject to a hidden
+            .labels folder in out_path, and each sample's label is then:
+            'hardlink': a hard link to that file (falls back to a copy if the
+            file system does not support hard links); 'symlink': a relative
+            symbolic link to that file; 'manifest': not created, the manifest
+            record for the sample points at the shared file instead. If None,
+            every label is written in full. Default is 'hardlink'.
+        output_format (optional): Format of the saved samples. 'nii.gz':
+            gzipped NIfTI files; 'nii': uncompressed NIfTI files (faster to
+            write, and can be memory-mapped when read); 'zarr': one chunked,
+            compressed zarr array store per transform/severity level
+            ({transform}_{severity}.zarr in out_path) with one array per
+            sample at {subject_id}/image and {subject_id}/label, and the affine
+            stored as an array attribute. Zarr arrays can be sliced without
+            decompressing whole volumes; this format requires the zarr
+            package. See roodmri/data/writers.py. Default is 'nii.gz'.
+        compression_level (optional): Integer gzip compression level (1-9)
+            used for the 'nii.gz' output format. Lower levels write faster. If
+            None, nibabel's default level is used. Default is None.
+        write_workers (optional): Number of background threads used to write
+            samples. If greater than 0, each transformed sample is handed to a
+            writer thread and the next sample is computed while it is being
+            compressed and written. If 0, samples are written before moving on.
+            Default is 0.
+        max_pending_writes (optional): Maximum number of samples waiting to be
+            written (or being written) at any time when write_workers > 0.
+            Computing stops until a slot is free, which caps the memory held
+            by pending writes. If None, 2 x write_workers. Default is None.
+        hooks (optional): Sequence of callables, each called (in the main
+            process, in completion order) with a record of every sample
+            written: a dictionary with the 'subject_id', 'transform' and
+            'severity' of the sample, the resolved 'params' of the transform
+            (values of the severity_controller parameters), the durations in
+            seconds of the 'load_time', 'transform_time' (including pre/post
+            transforms) and 'write_time' stages, 'bytes_written' and a
+            'timestamp'. Subjects loaded once for several samples report the
+            load time with their first sample only, and severity levels
+            computed together by a batched transform share its time equally,
+            so times add up to the total. See roodmri/data/events.py for hooks
+            writing records to a JSON-lines file or Prometheus-style counters
+            to a text file; any other callable (e.g., a function sending
+            records to a monitoring service) can be used as well. Default is
+            None.
+        verbose (optional): Boolean describing whether to print progress
+            (severity level parameters, samples skipped when resuming and one
+            line per unit of work).
+            Warnings are always printed. Default is True.
+        input_cache (optional): Path to a cache directory, or DecodedCache
+            (see roodmri/data/cache.py), through which input files are read.
+            Each input file is then decoded once into a memory-mapped array
+            shared by every run, severity level and worker process, instead
+            of being decompressed again each time it is loaded. If None,
+            input files are read directly. Default is None.
+        scan_inputs (optional): How input files are checked when the object
+            is created (see roodmri/data/utils.py, scan_input_files), so that
+            missing, unreadable or mismatched files are reported before any
+            work starts instead of when they are reached. 'header': the
+            headers of all files are read in parallel, and image/label shapes
+            and affines are compared; 'data': the data of every file is read
+            as well (catches corrupt compressed files); None: no check.
+            Default is 'header'.
+        largest_first (optional): Boolean describing whether to process
+            subjects with the largest images first (using the voxel counts
+            from scan_inputs), so parallel runs do not end waiting on one large
+            volume. Ignored if scan_inputs is None. Default is True.
+        image_dtype (optional): Data type of the saved images. 'float32';
+            'int16': scaled to the intensity range of each image with the NIfTI
+            scl_slope/scl_inter fields, which readers (nibabel, MONAI) apply
+            automatically (NIfTI formats only); 'float16' (zarr format only).
+            Default is 'float32'.
+        label_dtype (optional): Data type of the saved labels, 'float32' or
+            'uint8' (values are rounded). Default is 'float32'.
+        memory_budget (optional): Approximate number of bytes of sample data
+            each process may hold at once, estimated from the voxel counts of
+            scan_inputs (float32 image and label). Batched transforms then
+            compute as many severity levels at a time as fit in the budget
+            (at least one), and if max_pending_writes is None, the number of
+            samples waiting for background writes is bounded by a third of
+            the budget. If None, all severity levels of a batched transform
+            are computed at once. Default is None.
+        write_index (optional): Boolean describing whether to save an index of
+            all samples recorded in the manifest (transform, severity level,
+            subject ID, original files, parameter values, paths, shape and
+            checksums) to out_path/index.parquet (index.csv if pyarrow is not
+            installed) when generate_dataset finishes. Loaders can filter it
+            instead of listing the dataset's folders; see SampleIndex in
+            roodmri/data/index.py. Ignored if num_shards > 1, as a shard cannot
+            tell when the other shards are done: once they all are, save the
+            index with SampleIndex.from_manifest(out_path).save() (until then,
+            SampleIndex.load builds it from the manifests). Default is True.
+        verify (optional): How resume checks the files of recorded samples.
+            'size': each file must exist with the recorded size and
+            modification time, which only reads file metadata; 'checksum':
+            each file must also have the recorded SHA-1 checksum, which reads
+            every file of the dataset (once per run and plan call) but also
+            finds files corrupted in place without a change of size or
+            modification time. Default is 'size'.
 
     Additional attributes:
         filename_mappings: Dictionary containing mappings from provided file
@@ -70,7 +256,15 @@ class DatasetGenerator(object):
             filename conventions for subsequent analyses.
     """
 
-    def __init__(self, input_files, out_path, transform_settings = None):
+    def __init__(self, input_files, out_path, transform_settings = None,
+                 load_once = False, num_workers = 0, threads_per_worker = 1,
+                 resume = True, seed = None, shard_index = 0, num_shards = 1,
+                 label_links = 'hardlink', output_format = 'nii.gz',
+                 compression_level = None, write_workers = 0,
+                 max_pending_writes = None, hooks = None, verbose = True,
+                 input_cache = None, scan_inputs = 'header', largest_first = True,
+                 image_dtype = 'float32', label_dtype = 'float32', memory_budget = None,
+                 write_index = True, verify = 'size'):
         assert is_file_list(input_files)
         assert isinstance(out_path, str), "out_path should be a string."
         self.input_files = input_files
@@ -84,7 +278,69 @@ class DatasetGenerator(object):
         if transform_settings is not None:
             self.transform_settings = transform_settings
         else:
-            self.transform_settings = DEFAULT_TRANSFORM_SETTINGS
+            self.transform_settings = defaults.DEFAULT_TRANSFORM_SETTINGS
+        assert isinstance(num_workers, int) and num_workers >= 0, \
+            "num_workers should be a non-negative integer."
+        assert isinstance(threads_per_worker, int) and threads_per_worker > 0, \
+            "threads_per_worker should be a positive integer."
+        self.load_once = load_once
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        assert isinstance(num_shards, int) and num_shards > 0, \
+            "num_shards should be a positive integer."
+        assert isinstance(shard_index, int) and 0 <= shard_index < num_shards, \
+            "shard_index should be an integer between 0 and num_shards - 1."
+        if num_shards > 1 and seed is None:
+            print("WARNING: num_shards > 1 but no seed was specified. Random "
+                  "transforms will not be reproducible across shards.")
+        assert label_links is None or label_links in LABEL_LINK_MODES, \
+            f"label_links should be None or one of {LABEL_LINK_MODES}."
+        self.resume = resume
+        self.seed = seed
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.label_links = label_links
+        assert isinstance(write_workers, int) and write_workers >= 0, \
+            "write_workers should be a non-negative integer."
+        self.writer = get_writer(output_format, compression_level)
+        self.write_workers = write_workers
+        self.max_pending_writes = max_pending_writes
+        self.hooks = list(hooks) if hooks is not None else []
+        self.verbose = verbose
+        self.input_cache = get_cache(input_cache)
+        self.input_info = None
+        if scan_inputs is not None:
+            self.input_info = scan_input_files(input_files, scan_inputs)
+        self.largest_first = largest_first
+        assert image_dtype in IMAGE_DTYPES, f"image_dtype should be one of {IMAGE_DTYPES}."
+        assert label_dtype in LABEL_DTYPES, f"label_dtype should be one of {LABEL_DTYPES}."
+        assert not (image_dtype == 'int16' and output_format == 'zarr'), \
+            "image_dtype 'int16' requires a NIfTI output_format."
+        assert not (image_dtype == 'float16' and output_format != 'zarr'), \
+            "image_dtype 'float16' requires the 'zarr' output_format."
+        assert memory_budget is None or self.input_info is not None, \
+            "memory_budget requires scan_inputs."
+        self.image_dtype = image_dtype
+        self.label_dtype = label_dtype
+        self.memory_budget = memory_budget
+        self.write_index = write_index
+        self._write_options = {'image': {'dtype': image_dtype,
+                                         'scaled': image_dtype == 'int16'},
+                               'label': {'dtype': label_dtype}}
+        # output data types are part of the parameter hashes (unless they are
+        # the defaults, so existing manifests and shared labels stay valid)
+        self._output_tag = ()
+        if (image_dtype, label_dtype) != ('float32', 'float32'):
+            self._output_tag = (image_dtype, label_dtype)
+        self._label_preserving = {name: _preserves_label(settings)
+                                  for name, settings in self.transform_settings.items()}
+        self._batched_transforms = {name: _batched_transform(settings)
+                                    for name, settings in self.transform_settings.items()}
+        self.manifest = Manifest(self.out_path, shard_index if num_shards > 1 else None,
+                                 verify)
+        self.modalities = image_keys(input_files[0])
+        self._shared_checksums = dict()   # shared label path -> checksum
+        self._params_hashes = dict()
         filename_mappings = dict()
         for i, sample_dict in enumerate(self.input_files):
             filename_mappings[sample_dict['label']] = str(i + 1).zfill(6)
@@ -93,7 +349,13 @@ class DatasetGenerator(object):
               " of your machine's storage (roughly the size of the test set x "
               "the number of transforms x the number of severity levels). "
               "Please ensure that you have enough free space in the directory "
-              "specified by out_path before continuing.")
+              "specified by out_path before continuing (the plan method "
+              "estimates the storage and time needed).")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['hooks'] = []   # only called in the main process; may not be picklable
+        return state
 
     def generate_dataset(self):
         """
@@ -104,43 +366,571 @@ class DatasetGenerator(object):
         transforms and severity levels specified in self.transform_settings.
         Files are saved in the folder specified by self.out_path.
         """
-        for transform_name, settings in self.transform_settings.items():
-            sv_controller = settings['severity_controller']
-            # iterate over severity levels
-            for i in range(len(sv_controller[next(iter(sv_controller))])):
-                print("-" * 10)
-                transform = deepcopy(settings['transform'])
-                for param, values in sv_controller.items():
-                    value = values[i]
-                    rsetattr(transform, param, value)
-                print(transform_name, *[(param, rgetattr(transform, param))
-                                        for param in sv_controller.keys()])
-                transforms = tf.Compose(BASE_TRANSFORMS + settings['pre_transforms']
-                                        + [transform] + settings['post_transforms'])
-                test_ds = Dataset(data=self.input_files, transform=transforms)
-                loader = DataLoader(test_ds, batch_size=1)
-                step_start = time.time()
-                for j, test_data in enumerate(loader):
-                    subject_id = self.filename_mappings[test_data['label_meta_dict']['filename_or_obj'][0]]
-                    affine = test_data['image_meta_dict']['affine'][0]
-                    save_dir = self.out_path / f'{transform_name}_{i+1}/{subject_id}'
-                    Path(save_dir).mkdir(parents=True, exist_ok=True)
-                    test_inputs, test_labels = (
-                        test_data["image"].to(DEVICE),
-                        test_data["label"].to(DEVICE),
-                    )
-                    test_inputs = np.squeeze(test_inputs.numpy())
-                    test_labels = np.squeeze(test_labels.numpy())
-                    for data, label in zip([test_inputs, test_labels], ['image', 'label']):
-                        write_nifti(
-                            data,
-                            save_dir / f'{subject_id}_{transform_name}_{i+1}_{label}.nii.gz',
-                            affine=affine
-                        )
-                    step_time = time.time() - step_start
-                    print(f"{j+1}/{len(test_ds)} saved, step time: {(step_time):.4f} seconds")
-                    step_start = time.time()
-        print(f"\nFinished. Check {self.out_path} for files.")
+        if self.verbose:
+            for transform_name, settings in self.transform_settings.items():
+                for i in range(_num_severities(settings)):
+                    transform = _configure_transform(settings, i)
+                    print(f"{transform_name}_{i+1}", *[(param, rgetattr(transform, param))
+                          for param in settings['severity_controller'].keys()])
+            print("-" * 10)
+        units = self._get_units()
+        if not units and self.verbose:
+            print("All samples are already complete.")
+        self._prepare_shared_labels(units)
+        background_writer = None
+        if self.num_workers > 0:
+            results = self._run_parallel(units)
+        else:
+            background_writer = self._background_writer()
+            results = (self._process_unit(unit, background_writer) for unit in units)
+        pending_records = []   # records (or futures of records) not yet emitted
+        try:
+            for j, (description, step_time, records) in enumerate(results):
+                pending_records.extend(records)
+                pending_records = self._emit_records(pending_records)
+                if self.verbose:
+                    print(f"{j+1}/{len(units)} saved ({description}), "
+                          f"step time: {(step_time):.4f} seconds")
+        finally:
+            if background_writer is not None:
+                background_writer.close()   # flush pending writes
+        self._emit_records(pending_records, wait=True)
+        if self.write_index and self.num_shards == 1 and manifest_paths(self.out_path):
+            # rebuilt from the manifest files, which also have earlier runs' samples
+            index_path = SampleIndex.from_manifest(self.out_path).save()
+            if self.verbose:
+                print(f"Sample index saved to {index_path}.")
+        if self.verbose:
+            print(f"\nFinished. Check {self.out_path} for files.")
+
+    def _emit_records(self, records, wait = False):
+        """
+        Pass sample records to self.hooks.
+
+        Records of samples still being written by a BackgroundWriter are
+        futures; finished ones are emitted, in order, and the rest are
+        returned (unless wait is True, in which case all are waited for).
+        """
+        for k, record in enumerate(records):
+            if isinstance(record, Future):
+                if not (wait or record.done()):
+                    return records[k:]
+                record = record.result()
+            for hook in self.hooks:
+                hook(record)
+        return []
+
+    def plan(self, num_subjects = 1, num_workers = None):
+        """
+        Estimate the storage and time needed by generate_dataset.
+
+        Only the headers of the input images are read, to get their shapes
+        and data types. The samples of a few subjects (num_subjects, spread
+        over the range of input sizes) are then generated for every
+        transform/severity level into a temporary folder in out_path, which is
+        deleted afterwards. Their load/transform/write times and sizes are
+        measured per voxel and scaled to every subject that generate_dataset
+        would process (i.e., after sharding and resuming), giving the
+        projected size of each output folder, the total disk usage, the total
+        CPU time and the wall time with num_workers worker processes.
+        Estimates assume that time and size grow linearly with the number of
+        voxels, and timings are measured in the current process.
+
+        Args:
+            num_subjects (optional): Number of subjects to time. Default is 1.
+            num_workers (optional): Number of worker processes to estimate
+                the wall time for. If None, self.num_workers. Default is None.
+
+        Returns:
+            Dictionary with the input 'shapes' and 'dtypes' (and number of
+            subjects with each), the 'sampled_subjects', the projected
+            'directories' sizes in bytes (by output folder), 'total_bytes',
+            the 'free_bytes' in out_path, 'cpu_seconds', 'num_workers' and
+            'wall_seconds'.
+        """
+        if num_workers is None:
+            num_workers = self.num_workers
+        assert isinstance(num_subjects, int) and num_subjects > 0, \
+            "num_subjects should be a positive integer."
+        input_info = self.input_info
+        if input_info is None:
+            input_info = scan_input_files(self.input_files)
+        voxels = [info['voxels'] for info in input_info]
+        units = self._get_units()
+        subjects = sorted({j for j, _ in units}, key=lambda j: voxels[j])
+        picks = [subjects[k] for k in sorted(set(np.linspace(
+            0, len(subjects) - 1, min(num_subjects, len(subjects))).round().astype(int)))]
+        tasks = [(transform_name, i)
+                 for transform_name, settings in self.transform_settings.items()
+                 for i in range(_num_severities(settings))]
+        load_rates, task_rates = [], {task: [] for task in tasks}
+        with tempfile.TemporaryDirectory(prefix='.plan', dir=self.out_path) as tmp_dir:
+            # the planner shares no mutable state with self: transforms hold
+            # random states, and shared labels are written to tmp_dir
+            planner = copy(self)
+            planner.out_path = Path(tmp_dir)
+            planner.manifest = Manifest(tmp_dir)
+            planner.hooks = []
+            planner.transform_settings = deepcopy(self.transform_settings)
+            planner._shared_checksums = dict()
+            planner._params_hashes = dict()
+            for j in picks:
+                if self.load_once:
+                    sample_units = [(j, tasks)]
+                else:
+                    sample_units = [(j, list(group))
+                                    for _, group in groupby(tasks, key=lambda task: task[0])]
+                for unit in sample_units:
+                    records = planner._transform_unit(unit, None)
+                    load_rates.append(sum(r['load_time'] for r in records) / voxels[j])
+                    for record in records:
+                        task = (record['transform'], record['severity'] - 1)
+                        task_rates[task].append(
+                            ((record['transform_time'] + record['write_time']) / voxels[j],
+                             record['bytes_written'] / voxels[j]))
+        load_rate = np.mean(load_rates) if load_rates else 0.0
+        task_rates = {task: np.mean(rates, axis=0) for task, rates in task_rates.items()
+                      if rates}
+        directories, unit_seconds = dict(), []
+        for j, unit_tasks in units:
+            seconds = load_rate * voxels[j]
+            for transform_name, i in unit_tasks:
+                time_rate, byte_rate = task_rates[(transform_name, i)]
+                seconds += time_rate * voxels[j]
+                path = self.writer.sample_path(self.out_path, transform_name, i + 1,
+                                               self.filename_mappings[
+                                                   self.input_files[j]['label']],
+                                               self.modalities[0])
+                directory = path.relative_to(self.out_path).parts[0]
+                directories[directory] = directories.get(directory, 0) + byte_rate * voxels[j]
+            unit_seconds.append(seconds)
+        worker_seconds = np.zeros(max(num_workers, 1))
+        for seconds in unit_seconds:   # units are handed out in order to idle workers
+            worker_seconds[np.argmin(worker_seconds)] += seconds
+        count = lambda values: {str(v): values.count(v) for v in sorted(set(values), key=str)}
+        plan = {
+            'shapes': count([info['shape'] for info in input_info]),
+            'dtypes': count([info['dtype'] for info in input_info]),
+            'sampled_subjects': [self.filename_mappings[self.input_files[j]['label']]
+                                 for j in picks],
+            'directories': {name: int(size) for name, size in directories.items()},
+            'total_bytes': int(sum(directories.values())),
+            'free_bytes': shutil.disk_usage(self.out_path).free,
+            'cpu_seconds': float(sum(unit_seconds)),
+            'num_workers': num_workers,
+            'wall_seconds': float(worker_seconds.max())
+        }
+        if self.verbose:
+            for name, size in plan['directories'].items():
+                print(f"{name}: {size / 2 ** 20:.1f} MB")
+            print("-" * 10)
+            print(f"{len(units)} units of work, {sum(len(t) for _, t in units)} samples")
+            print(f"Projected disk usage: {plan['total_bytes'] / 2 ** 30:.2f} GB "
+                  f"({plan['free_bytes'] / 2 ** 30:.2f} GB free in {self.out_path})")
+            print(f"Projected CPU time: {plan['cpu_seconds'] / 3600:.2f} hours")
+            print(f"Projected wall time with num_workers = {num_workers}: "
+                  f"{plan['wall_seconds'] / 3600:.2f} hours")
+        if plan['total_bytes'] > plan['free_bytes']:
+            print("WARNING: the projected size of the benchmarking dataset is larger "
+                  f"than the free space in {self.out_path}.")
+        return plan
+
+    def _get_units(self):
+        """
+        Split the work into units.
+
+        Each unit is a tuple (subject index, tasks) where tasks is a list of
+        (transform name, severity index) pairs to apply to that subject. In
+        load_once mode there is one unit per subject; otherwise there is one
+        unit per transform/subject with all of the transform's severity levels
+        (so a batched transform computes them in one pass), ordered transform
+        by transform. Only the units of every num_shards-th subject, starting
+        at shard_index, are kept. If self.resume is True, samples already
+        recorded as complete in the manifest are then left out. If
+        self.largest_first is True, units are finally sorted by decreasing
+        image size.
+        """
+        tasks = [(transform_name, i)
+                 for transform_name, settings in self.transform_settings.items()
+                 for i in range(_num_severities(settings))]
+        subjects = range(self.shard_index, len(self.input_files), self.num_shards)
+        if self.load_once:
+            units = [(j, tasks) for j in subjects]
+        else:
+            groups = [list(group) for _, group in groupby(tasks, key=lambda task: task[0])]
+            units = [(j, group) for group in groups for j in subjects]
+        if self.resume:
+            units = self._drop_complete(units)
+        if self.largest_first and self.input_info is not None:
+            units.sort(key=lambda unit: -self.input_info[unit[0]]['voxels'])   # stable
+        return units
+
+    def _drop_complete(self, units):
+        """Remove tasks recorded as complete in the manifest from units."""
+        sources = dict()
+        remaining = []
+        num_skipped = 0
+        for j, tasks in units:
+            input_file = self.input_files[j]
+            subject_id = self.filename_mappings[input_file['label']]
+            if j not in sources:
+                sources[j] = source_signature(input_file)
+            todo = [(transform_name, i) for transform_name, i in tasks
+                    if not self.manifest.is_complete(
+                        subject_id, transform_name, i + 1,
+                        self._params_hash(transform_name, i), sources[j])]
+            num_skipped += len(tasks) - len(todo)
+            if todo:
+                remaining.append((j, todo))
+        if num_skipped and self.verbose:
+            print(f"Skipping {num_skipped} samples already recorded as complete "
+                  f"in {self.manifest.path}.")
+        return remaining
+
+    def _params_hash(self, transform_name, i):
+        """Hash of the transforms used for a transform/severity level."""
+        if (transform_name, i) not in self._params_hashes:
+            settings = self.transform_settings[transform_name]
+            self._params_hashes[(transform_name, i)] = params_hash(
+                self.seed, settings['pre_transforms'], _configure_transform(settings, i),
+                settings['post_transforms'], *self._output_tag)
+        return self._params_hashes[(transform_name, i)]
+
+    def _run_parallel(self, units):
+        """Process units in a process pool, yielding results as they finish."""
+        max_pending = 2 * self.num_workers
+        units = iter(units)
+        with ProcessPoolExecutor(max_workers=self.num_workers,
+                                 initializer=_init_worker,
+                                 initargs=(self, self.threads_per_worker)) as executor:
+            pending = set()
+            while True:
+                for unit in units:
+                    pending.add(executor.submit(_process_unit_in_worker, unit))
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    def _background_writer(self):
+        """Create a BackgroundWriter if write_workers > 0, otherwise None."""
+        if self.write_workers == 0:
+            return None
+        return BackgroundWriter(self.write_workers, self._pending_writes())
+
+    def _process_unit(self, unit, background_writer = None):
+        """
+        Load one subject and save each of its transformed samples.
+
+        Args:
+            unit: Tuple (subject index, tasks), see _get_units.
+            background_writer (optional): BackgroundWriter to queue writes to.
+                The caller is responsible for closing it. If None and
+                self.write_workers > 0, a writer is created for this unit and
+                closed (flushed) before returning. Default is None.
+
+        Returns:
+            Tuple containing a short description of the unit, the time in
+            seconds it took to process and the records of its samples (see
+            hooks; futures of records for samples still being written by
+            background_writer).
+        """
+        step_start = time.time()
+        own_writer = background_writer is None
+        if own_writer:
+            background_writer = self._background_writer()
+        try:
+            records = self._transform_unit(unit, background_writer)
+        finally:
+            if own_writer and background_writer is not None:
+                background_writer.close()
+        if own_writer:
+            records = [record.result() if isinstance(record, Future) else record
+                       for record in records]
+        j, tasks = unit
+        subject_id = self.filename_mappings[self.input_files[j]['label']]
+        if len(tasks) == 1:
+            description = f"{tasks[0][0]}_{tasks[0][1]+1}/{subject_id}"
+        elif len({transform_name for transform_name, _ in tasks}) == 1:
+            description = f"{tasks[0][0]}/{subject_id}"
+        else:
+            description = subject_id
+        return description, time.time() - step_start, records
+
+    def _transform_unit(self, unit, background_writer):
+        """
+        Apply each of a unit's transforms and write (or queue) the results.
+
+        Severity levels of a transform with a batched implementation are
+        computed together in one pass (in chunks that fit in
+        self.memory_budget). Each sample is written (or queued) before the next
+        one is computed, and the last sample of the unit transforms the loaded
+        subject in place instead of a copy.
+
+        Returns:
+            List of the records of the unit's samples (see hooks), or futures
+            of records for samples queued to background_writer.
+        """
+        j, tasks = unit
+        input_file = self.input_files[j]
+        subject_id = self.filename_mappings[input_file['label']]
+        source = source_signature(input_file)
+        start = time.perf_counter()
+        loaded = _load_subject(input_file, self.input_cache, self.modalities)
+        load_time = time.perf_counter() - start
+        # copied, as the last sample may update the loaded metadata in place
+        affine = np.array(loaded['image_meta_dict']['affine'])
+        shared_label = None
+        records = []
+        remaining = len(tasks)
+        for transform_name, group in groupby(tasks, key=lambda task: task[0]):
+            indices = [i for _, i in group]
+            remaining -= len(indices)
+            samples = self._iter_samples(loaded, transform_name, indices, subject_id,
+                                         copy=remaining > 0, chunk_size=self._chunk_size(j))
+            for i, data, transform_time in samples:
+                record = self._sample_record(subject_id, transform_name, i, load_time,
+                                             transform_time)
+                load_time = 0.0   # reported with the first sample only
+                label_source = None
+                if self.label_links is not None and self._label_preserving[transform_name]:
+                    if shared_label is None:
+                        shared_label = self._shared_label_path(subject_id, source)
+                        if shared_label not in self._shared_checksums:   # e.g., in plan
+                            start = time.perf_counter()
+                            self._save_shared_label(loaded['label'], affine, shared_label)
+                            record['write_time'] = time.perf_counter() - start
+                            record['bytes_written'] = path_size(shared_label) or 0
+                    label_source = shared_label
+                args = (data['image'], data['label'], _sample_affine(data, affine),
+                        transform_name, i + 1, subject_id, label_source, source, record)
+                del data   # the writer holds the only reference to the sample
+                if background_writer is None:
+                    records.append(self._save_and_record(*args))
+                else:
+                    records.append(background_writer.submit(self._save_and_record, *args))
+        return records
+
+    def _iter_samples(self, loaded, transform_name, indices, subject_id, copy, chunk_size):
+        """
+        Generate the samples of one transform at several severity levels.
+
+        Yields:
+            Tuples (severity index, data, transform time in seconds). Samples
+            computed together by a batched transform share its time equally.
+            If copy is False, the last sample may modify loaded in place.
+        """
+        if self._batched_transforms[transform_name] is None:
+            for k, i in enumerate(indices):
+                start = time.perf_counter()
+                data = self._apply(loaded, transform_name, i, subject_id,
+                                   copy=copy or k < len(indices) - 1)
+                yield i, data, time.perf_counter() - start
+            return
+        chunk_size = chunk_size or len(indices)
+        for k in range(0, len(indices), chunk_size):
+            chunk = indices[k:k + chunk_size]
+            start = time.perf_counter()
+            samples = self._apply_batched(loaded, transform_name, chunk, subject_id,
+                                          copy=copy or k + chunk_size < len(indices))
+            transform_time = (time.perf_counter() - start) / len(chunk)
+            for i in chunk:
+                yield i, samples.pop(0), transform_time
+
+    def _chunk_size(self, j):
+        """Number of severity levels a batched transform may compute at once (None: all)."""
+        if self.memory_budget is None:
+            return None
+        # the loaded subject, plus an output and an intermediate per severity
+        slots = self.memory_budget // self._sample_bytes(j) - self._pending_writes()
+        return max(1, (slots - 1) // 2)
+
+    def _sample_bytes(self, j):
+        """Approximate memory held by one float32 image/label sample of subject j."""
+        return 2 * 4 * self.input_info[j]['voxels']
+
+    def _pending_writes(self):
+        """Maximum number of samples waiting to be written by a BackgroundWriter."""
+        if self.write_workers == 0:
+            return 0
+        if self.max_pending_writes is not None:
+            return self.max_pending_writes
+        if self.memory_budget is None:
+            return 2 * self.write_workers
+        # a third of the budget for pending writes of the largest subject
+        largest = max(self._sample_bytes(j) for j in range(len(self.input_files)))
+        return max(1, min(2 * self.write_workers, self.memory_budget // largest // 3))
+
+    def _sample_record(self, subject_id, transform_name, i, load_time, transform_time):
+        """Record of one sample for the hooks, before it is written."""
+        settings = self.transform_settings[transform_name]
+        return {
+            'subject_id': subject_id,
+            'transform': transform_name,
+            'severity': i + 1,
+            'params': {param: jsonable(values[i])
+                       for param, values in settings['severity_controller'].items()},
+            'load_time': load_time,
+            'transform_time': transform_time,
+            'write_time': 0.0,
+            'bytes_written': 0
+        }
+
+    def _apply(self, loaded, transform_name, i, subject_id, copy):
+        """Apply the transforms for one severity level to a loaded subject."""
+        settings = self.transform_settings[transform_name]
+        transforms = tf.Compose(settings['pre_transforms']
+                                + [_configure_transform(settings, i)]
+                                + settings['post_transforms'])
+        self._seed_transforms(transforms, transform_name, i, subject_id)
+        return transforms(deepcopy(loaded) if copy else loaded)
+
+    def _apply_batched(self, loaded, transform_name, indices, subject_id, copy = True):
+        """
+        Apply the transforms for several severity levels in one pass.
+
+        Each output gets its own copy of the metadata dictionaries before the
+        post_transforms, since transforms that resample (e.g., Spacingd)
+        update the affine in place.
+        """
+        settings = self.transform_settings[transform_name]
+        transforms, seeds = [], []
+        for i in indices:
+            transform = _configure_transform(settings, i)
+            seeds.append(self._seed_transforms(
+                tf.Compose(settings['pre_transforms'] + [transform]
+                           + settings['post_transforms']),
+                transform_name, i, subject_id))
+            transforms.append(transform)
+        data = tf.Compose(settings['pre_transforms'])(deepcopy(loaded) if copy else loaded)
+        post_transforms = tf.Compose(settings['post_transforms'])
+        batched = self._batched_transforms[transform_name]
+        return [post_transforms(_own_metadata(out)) for out in batched(transforms, data, seeds)]
+
+    def _seed_transforms(self, transforms, transform_name, i, subject_id):
+        """
+        Set the random states used by transforms for one sample.
+
+        Returns:
+            The sample's seed, or None if self.seed is None.
+        """
+        if self.seed is None:
+            # fresh MONAI random states; the deep copied transforms would
+            # otherwise all start from the same state for every subject
+            transforms.set_random_state(seed=np.random.randint(MAX_SEED))
+            return None
+        seed = sample_seed(self.seed, transform_name, i + 1, subject_id)
+        _set_random_state(transforms, seed)
+        return seed
+
+    def _save_and_record(self, image, label, affine, transform_name, severity,
+                         subject_id, label_source, source, record):
+        """
+        Save a sample, then record it in the manifest.
+
+        Returns:
+            record (see _sample_record), completed with the write time and
+            bytes written.
+        """
+        start = time.perf_counter()
+        files = self._save_sample(image, label, affine, transform_name, severity,
+                                  subject_id, label_source)
+        self.manifest.record(subject_id, transform_name, severity,
+                             self._params_hash(transform_name, severity - 1),
+                             source, files, params=record['params'],
+                             shape=[n for n in image.shape[1:] if n != 1])
+        record['write_time'] += time.perf_counter() - start
+        record['bytes_written'] += sum(files[key]['size'] or 0 for key in files
+                                       if key != 'label' or label_source is None)
+        record['timestamp'] = time.time()
+        return record
+
+    def _save_sample(self, image, label, affine, transform_name, severity, subject_id,
+                     label_source = None):
+        """
+        Write a transformed image/label pair to its benchmarking folder.
+
+        Each file is first written under a temporary name and then renamed, so
+        a file at the final path is never partially written. If label_source
+        is given, the label is not written; it is linked to label_source
+        according to self.label_links instead. The channels of multi-modality
+        images are written to one file per modality.
+
+        Returns:
+            Dictionary mapping 'image' (or each modality) and 'label' to the
+            path (relative to self.out_path), size and checksum of the sample's
+            files, for the manifest.
+        """
+        files = dict()
+        if self.modalities == ['image']:
+            items = [('image', image)]
+        else:
+            items = [(key, image[c:c + 1]) for c, key in enumerate(self.modalities)]
+        for key, data in items + [('label', label)]:
+            path = self.writer.sample_path(self.out_path, transform_name, severity,
+                                           subject_id, key)
+            if key == 'label' and label_source is not None:
+                if self.label_links == 'manifest':
+                    path = label_source
+                else:
+                    self.writer.link(label_source, path, self.label_links)
+                checksum = self._shared_checksums[label_source]
+            else:
+                self.writer.write(data, path, affine,
+                                  **self._write_options['label' if key == 'label' else 'image'])
+                checksum = path_checksum(path)
+            files[key] = {'path': str(path.relative_to(self.out_path)),
+                          'size': path_size(path), 'mtime_ns': path_mtime(path),
+                          'sha1': checksum}
+        return files
+
+    def _prepare_shared_labels(self, units):
+        """
+        Check or write the shared labels of units before any unit is processed.
+
+        For every subject with label-preserving samples in units, a shared
+        label left by an earlier run is kept if the manifest record of a
+        sample linked to it shows it unchanged (see self.verify); otherwise it
+        is written again from the input label. This is done once, in the main
+        process, so worker processes only link samples to the labels in
+        self._shared_checksums and never write the same file (nor do shards,
+        which each own a subject's samples).
+        """
+        if self.label_links is None:
+            return
+        for j, tasks in units:
+            if not any(self._label_preserving[transform_name] for transform_name, _ in tasks):
+                continue
+            input_file = self.input_files[j]
+            subject_id = self.filename_mappings[input_file['label']]
+            path = self._shared_label_path(subject_id, source_signature(input_file))
+            if path in self._shared_checksums:
+                continue
+            checksum = self.manifest.shared_file_checksum(path, subject_id)
+            if checksum is not None:
+                self._shared_checksums[path] = checksum
+                continue
+            loaded = _load_subject(input_file, self.input_cache, self.modalities[:1])
+            self._save_shared_label(loaded['label'], np.array(loaded['image_meta_dict']['affine']),
+                                    path)
+
+    def _shared_label_path(self, subject_id, source):
+        """
+        Path of a subject's shared label.
+
+        The file name includes a hash of the source files, so a label whose
+        source image/label changed is written again instead of reused.
+        """
+        return self.writer.shared_label_path(self.out_path, subject_id,
+                                             params_hash(source, *self._output_tag)[:12])
+
+    def _save_shared_label(self, label, affine, path):
+        """Write a subject's untransformed label, for label-preserving transforms."""
+        self.writer.write(label, path, affine, **self._write_options['label'])
+        self._shared_checksums[path] = path_checksum(path)
 
     def save_filename_mappings(self, path):
         """
@@ -154,3 +944,127 @@ class DatasetGenerator(object):
             writer.writerow(['original_label_filename', 'new_subject_id'])
             for filename, subject_id in self.filename_mappings.items():
                 writer.writerow([filename, subject_id])
+
+
+def _load_subject(input_file, input_cache = None, modalities = None):
+    """
+    Load the image and label of an input file, adding a channel dimension.
+
+    Same as tf.Compose(BASE_TRANSFORMS)(input_file), reading through
+    input_cache (a DecodedCache) if it is not None. The images of several
+    modalities (modalities, by default every key but 'label') are stacked as
+    the channels of 'image', with the metadata of the first one.
+    """
+    if modalities is None:
+        modalities = image_keys(input_file)
+    keys = modalities + ['label']
+    if input_cache is None:
+        transforms = BASE_TRANSFORMS
+        if modalities != ['image']:
+            transforms = [tf.LoadImaged(keys=keys), tf.AddChanneld(keys=keys)]
+        data = tf.Compose(transforms)(input_file)
+    else:
+        data = dict(input_file)
+        for key in keys:
+            array, meta = input_cache.load(input_file[key])
+            data[key] = array[np.newaxis]
+            data[f'{key}_meta_dict'] = meta
+    if modalities != ['image']:
+        data['image'] = np.concatenate([data.pop(key) for key in modalities])
+        data['image_meta_dict'] = data[f'{modalities[0]}_meta_dict']
+        assert len(data['image']) == len(modalities), \
+            f"The images of {input_file['label']} should be 3D volumes (one per modality)."
+    return data
+
+
+def _own_metadata(data):
+    """Shallow copy of a sample whose metadata dictionaries are not shared with other samples."""
+    return {key: dict(value) if key.endswith('_meta_dict') else value
+            for key, value in data.items()}
+
+
+def _sample_affine(data, default):
+    """
+    Affine of a transformed sample.
+
+    Transforms that resample the image (e.g., Spacingd) update the affine in
+    its metadata; default (the affine of the loaded image) is used if the
+    sample has none.
+    """
+    meta = data.get('image_meta_dict')
+    if isinstance(meta, dict) and meta.get('affine') is not None:
+        return meta['affine']
+    return default
+
+
+def _num_severities(settings):
+    """Number of severity levels described by a severity_controller."""
+    sv_controller = settings['severity_controller']
+    return len(sv_controller[next(iter(sv_controller))])
+
+
+def _configure_transform(settings, i):
+    """Copy of settings['transform'] with parameters for severity index i."""
+    transform = deepcopy(settings['transform'])
+    for param, values in settings['severity_controller'].items():
+        rsetattr(transform, param, values[i])
+    return transform
+
+
+def _preserves_label(settings):
+    """Whether the transforms in settings leave the label unchanged."""
+    if 'label_preserving' in settings:
+        return settings['label_preserving']
+    transform = settings['transform']
+    keys = getattr(transform, 'include', None)   # TorchIO transforms
+    if keys is None:
+        keys = getattr(transform, 'keys', None)   # MONAI transforms
+    if keys is None or 'label' in keys:
+        return False
+    for other in settings['pre_transforms'] + settings['post_transforms']:
+        if 'label' in getattr(other, 'keys', ['label']) \
+                and not isinstance(other, TYPE_CONVERSION_TRANSFORMS):
+            return False
+    return True
+
+
+def _batched_transform(settings):
+    """Batched implementation to use for the transforms in settings, or None."""
+    if 'batched_transform' in settings:
+        return settings['batched_transform']
+    if any(is_random_transform(transform) for transform
+           in settings['pre_transforms'] + settings['post_transforms']):
+        return None
+    return get_batched_transform(settings['transform'])
+
+
+def _set_random_state(transforms, seed):
+    """Seed the global and per-transform random states used by transforms."""
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    transforms.set_random_state(seed=seed)
+
+
+def _init_worker(generator, num_threads):
+    """Limit the threads used by a worker process and store the generator."""
+    global _worker_generator
+    for env_var in THREAD_ENV_VARS:
+        os.environ[env_var] = str(num_threads)
+    torch.set_num_threads(num_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(num_threads)
+    except ImportError:
+        pass
+    if generator.seed is None:
+        # forked workers inherit the parent's random states; decorrelate them
+        worker_seed = int.from_bytes(os.urandom(4), 'little')
+        random.seed(worker_seed)
+        np.random.seed(worker_seed)
+        torch.manual_seed(worker_seed)
+    _worker_generator = generator
+
+
+def _process_unit_in_worker(unit):
+    return _worker_generator._process_unit(unit)
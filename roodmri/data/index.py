@@ -0,0 +1,193 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from roodmri.data.manifest import Manifest, manifest_paths
+from roodmri.data.writers import _tmp_path
+
+INDEX_FILENAMES = ['index.parquet', 'index.csv']
+INDEX_COLUMNS = ['subject_id', 'transform', 'severity', 'modality', 'original_image',
+                 'original_label',
+                 'image_path', 'label_path', 'shape', 'image_size', 'label_size',
+                 'image_sha1', 'label_sha1', 'params_hash', 'params']
+
+
+class SampleIndex(object):
+    """
+    Columnar index of the samples of a benchmarking dataset.
+
+    The index has one row per (subject, transform, severity level) sample
+    recorded in the manifest of a dataset generated by DatasetGenerator (one
+    row per modality of multi-modality samples), with the columns:
+
+        subject_id, transform, severity: identify the sample
+        modality: key of the image ('image', or the modality, e.g., 't1')
+        original_image, original_label: paths of the input files
+        image_path, label_path: paths of the sample's files, relative to
+            out_path
+        shape: spatial shape of the sample, e.g. '182x218x182'
+        image_size, label_size: sizes in bytes of the sample's files
+        image_sha1, label_sha1: SHA-1 checksums of the sample's files
+        params_hash: hash of the transform's parameters
+        params: JSON object of the transform's parameter values at the
+            severity level
+
+    DatasetGenerator saves the index to out_path/index.parquet (or
+    out_path/index.csv if pyarrow is not installed) when it finishes, so
+    loaders can list and filter samples without walking the dataset's
+    folders. Fields unknown for datasets generated with older versions are
+    empty.
+
+    Args:
+        df: pandas DataFrame with the columns above.
+        out_path (optional): Path to the benchmarking dataset directory,
+            used to resolve relative paths. Default is None.
+    """
+
+    def __init__(self, df, out_path = None):
+        self.df = df
+        self.out_path = None if out_path is None else Path(out_path)
+        self._positions = None
+
+    @classmethod
+    def from_manifest(cls, out_path):
+        """Build the index of a dataset from its manifest."""
+        rows = []
+        for (subject_id, transform_name, severity), record in sorted(
+                Manifest(out_path).records.items()):
+            files, source = record['files'], record['source']
+            shape = record.get('shape')
+            for modality in files:
+                if modality == 'label':
+                    continue
+                rows.append([
+                    subject_id, transform_name, severity, modality,
+                    source[modality]['path'], source['label']['path'],
+                    files[modality]['path'], files['label']['path'],
+                    None if shape is None else 'x'.join(str(n) for n in shape),
+                    files[modality]['size'], files['label']['size'],
+                    files[modality].get('sha1'), files['label'].get('sha1'),
+                    record['params_hash'],
+                    None if record.get('params') is None else json.dumps(record['params'])
+                ])
+        return cls(pd.DataFrame(rows, columns=INDEX_COLUMNS), out_path)
+
+    @classmethod
+    def load(cls, out_path):
+        """
+        Load the index of a dataset.
+
+        The saved index is read if it is at least as recent as every manifest
+        file; otherwise (e.g., the index of an interrupted or sharded run),
+        the index is built from the manifest.
+        """
+        path = index_path(out_path)
+        if path is None:
+            assert manifest_paths(out_path), \
+                f"{out_path} has neither a sample index nor a manifest."
+            return cls.from_manifest(out_path)
+        if path.suffix == '.parquet':
+            df = pd.read_parquet(path)
+        else:
+            df = pd.read_csv(path, dtype={'subject_id': str})
+        if 'modality' not in df:   # saved before multi-modality support
+            df.insert(INDEX_COLUMNS.index('modality'), 'modality', 'image')
+        return cls(df, out_path)
+
+    def save(self, path = None):
+        """
+        Save the index via a temporary file.
+
+        Args:
+            path (optional): Path of a .parquet (requires pyarrow) or .csv
+                file. If None, index.parquet in out_path if pyarrow is
+                installed, otherwise index.csv. Default is None.
+
+        Returns:
+            Path of the saved index.
+        """
+        if path is None:
+            assert self.out_path is not None, "path is required if out_path is None."
+            try:
+                import pyarrow  # noqa: F401
+                path = self.out_path / INDEX_FILENAMES[0]
+            except ImportError:
+                path = self.out_path / INDEX_FILENAMES[1]
+        path = Path(path)
+        tmp_path = _tmp_path(path)
+        if path.suffix == '.parquet':
+            self.df.to_parquet(tmp_path, index=False)
+        else:
+            self.df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        return path
+
+    def select(self, query, **variables):
+        """
+        Select samples with a pandas query expression over the columns.
+
+        Example:
+            index.select("transform == 'Ghosting' and severity >= 3 "
+                         "and subject_id in @subjects", subjects=['000001'])
+
+        Args:
+            query: Expression passed to pandas.DataFrame.query.
+            **variables: Values of the variables referenced with @ in query.
+
+        Returns:
+            SampleIndex with the selected rows.
+        """
+        return SampleIndex(self.df.query(query, local_dict=variables), self.out_path)
+
+    def paths(self, subject_id, transform_name, severity, modality = 'image'):
+        """Absolute (image path, label path) of a sample, for one of its modalities (constant time)."""
+        if self._positions is None:
+            keys = zip(self.df['subject_id'], self.df['transform'], self.df['severity'],
+                       self.df['modality'])
+            self._positions = {(s, t, int(v), m): k for k, (s, t, v, m) in enumerate(keys)}
+        row = self.df.iloc[self._positions[(subject_id, transform_name, int(severity),
+                                            modality)]]
+        return self._resolve(row['image_path']), self._resolve(row['label_path'])
+
+    def image_paths(self):
+        """Absolute paths of the images of all samples."""
+        return [self._resolve(path) for path in self.df['image_path']]
+
+    def label_paths(self):
+        """Absolute paths of the labels of all samples."""
+        return [self._resolve(path) for path in self.df['label_path']]
+
+    def _resolve(self, path):
+        return Path(path) if self.out_path is None else self.out_path / path
+
+    def __len__(self):
+        return len(self.df)
+
+
+def index_path(out_path):
+    """Path of the saved index of a dataset if it is up to date, otherwise None."""
+    out_path = Path(out_path)
+    manifest_mtime = max([path.stat().st_mtime for path in manifest_paths(out_path)],
+                         default=0)
+    for filename in INDEX_FILENAMES:
+        path = out_path / filename
+        if path.exists() and path.stat().st_mtime >= manifest_mtime:
+            return path
+    return None
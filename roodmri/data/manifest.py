@@ -0,0 +1,262 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from roodmri.data.writers import path_checksum, path_mtime, path_size
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+SHARD_MANIFEST_FILENAME = 'manifest.{shard_index}.jsonl'
+VERIFY_MODES = ['size', 'checksum']
+
+
+class Manifest(object):
+    """
+    Append-only record of the samples written to a benchmarking dataset.
+
+    Each line of the manifest file is a JSON record describing one completed
+    (subject, transform, severity level) sample: a hash of the transform's
+    parameters and their resolved values, the size and modification time of
+    the source files, the shape of the sample, and the relative path, size,
+    modification time and checksum of every file (or array directory)
+    written. Records are only appended once all files of a sample have been
+    written, so a sample interrupted part-way through never appears as
+    complete.
+
+    Each shard of a sharded run (see DatasetGenerator) appends to its own
+    file, manifest.{shard_index}.jsonl, so shards running on different
+    machines never write to the same file. The records of all manifest files
+    in the directory are merged when the manifest is loaded, reading the
+    files from the least to the most recently modified. When a key appears
+    more than once, the last record read wins. See SampleIndex
+    (roodmri/data/index.py) for a columnar, queryable view of the records.
+
+    Args:
+        out_path: Path to the benchmarking dataset directory. The manifest is
+            stored in a file named manifest.jsonl inside this directory.
+        shard_index (optional): Index of the shard whose records are appended
+            to manifest.{shard_index}.jsonl instead. Default is None.
+        verify (optional): How is_complete checks the recorded files. 'size':
+            each file must have the recorded size and modification time;
+            'checksum': each file must also have the recorded checksum, which
+            reads every file (so files corrupted without changing size or
+            modification time are found too). Default is 'size'.
+    """
+
+    def __init__(self, out_path, shard_index = None, verify = 'size'):
+        assert verify in VERIFY_MODES, f"verify should be one of {VERIFY_MODES}."
+        self.out_path = Path(out_path)
+        self.verify = verify
+        if shard_index is None:
+            self.path = self.out_path / MANIFEST_FILENAME
+        else:
+            self.path = self.out_path / SHARD_MANIFEST_FILENAME.format(shard_index=shard_index)
+        self.records = dict()
+        self._checksums = dict()   # checksums of existing files
+        self._subject_keys = None   # record keys by subject ID, built on first use
+        for path in manifest_paths(self.out_path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue   # partially written line from a killed job
+                    self.records[self._key(record['subject_id'], record['transform'],
+                                           record['severity'])] = record
+
+    @staticmethod
+    def _key(subject_id, transform_name, severity):
+        return subject_id, transform_name, int(severity)
+
+    def is_complete(self, subject_id, transform_name, severity, params_hash, source):
+        """
+        Check whether a sample has already been written and is up to date.
+
+        A sample is complete if it has a record with the same parameter hash
+        and source files, and every file in the record exists with the
+        recorded size and modification time (if the record has one) or, with
+        verify = 'checksum', with the recorded size and checksum (if the
+        record has one). Checksums of files shared by several samples (e.g.,
+        labels) are computed once.
+        """
+        record = self.records.get(self._key(subject_id, transform_name, severity))
+        if record is None:
+            return False
+        if record['params_hash'] != params_hash or record['source'] != source:
+            return False
+        return all(self._is_unchanged(self.out_path / file_info['path'], file_info)
+                   for file_info in record['files'].values())
+
+    def shared_file_checksum(self, path, subject_id):
+        """
+        Recorded checksum of a file shared by a subject's samples, if it is unchanged.
+
+        The file (e.g., a shared label) is checked as in is_complete against
+        the record of a sample of subject_id whose file is path, or a hard or
+        symbolic link to it.
+
+        Returns:
+            The recorded checksum, or None if no record links to path or the
+            file changed since.
+        """
+        path = Path(path)
+        if not path.exists():
+            return None
+        if self._subject_keys is None:
+            self._subject_keys = dict()
+            for key in self.records:
+                self._subject_keys.setdefault(key[0], []).append(key)
+        for key in self._subject_keys.get(subject_id, []):
+            for file_info in self.records[key]['files'].values():
+                linked = self.out_path / file_info['path']
+                if (file_info.get('sha1') is not None and _same_file(linked, path)
+                        and self._is_unchanged(path, file_info)):
+                    return file_info['sha1']
+        return None
+
+    def _is_unchanged(self, path, file_info):
+        """Whether a file or array directory still matches its recorded information."""
+        if path_size(path) != file_info['size']:
+            return False
+        if self.verify == 'size':
+            return (file_info.get('mtime_ns') is None
+                    or path_mtime(path) == file_info['mtime_ns'])
+        return file_info.get('sha1') is None or self._checksum(path) == file_info['sha1']
+
+    def _checksum(self, path):
+        """Checksum of a file or array directory, cached by path and modification time."""
+        key = (os.path.realpath(path), os.stat(path).st_mtime_ns)
+        if key not in self._checksums:
+            self._checksums[key] = path_checksum(path)
+        return self._checksums[key]
+
+    def record(self, subject_id, transform_name, severity, params_hash, source, files,
+               params = None, shape = None):
+        """
+        Append a record for a sample whose files have all been written.
+
+        Each record is written with a single append so that several worker
+        processes can record samples in the same manifest.
+        """
+        record = {
+            'subject_id': subject_id,
+            'transform': transform_name,
+            'severity': int(severity),
+            'params_hash': params_hash,
+            'params': params,
+            'source': source,
+            'shape': None if shape is None else [int(n) for n in shape],
+            'files': files
+        }
+        line = (json.dumps(record) + '\n').encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        key = self._key(subject_id, transform_name, severity)
+        if self._subject_keys is not None and key not in self.records:
+            self._subject_keys.setdefault(subject_id, []).append(key)
+        self.records[key] = record
+
+
+def _same_file(path, other):
+    """Whether two paths are (links to) the same file, or directories of the same files."""
+    if not (os.path.exists(path) and os.path.exists(other)):
+        return False
+    if os.path.samefile(path, other):
+        return True
+    if not (os.path.isdir(path) and os.path.isdir(other)):
+        return False
+    files = [sorted((os.path.relpath(os.path.join(root, filename), top),
+                     os.stat(os.path.join(root, filename)).st_ino)
+                    for root, _, filenames in os.walk(top) for filename in filenames)
+             for top in (path, other)]
+    return files[0] == files[1]   # e.g., zarr arrays of hard-linked chunks
+
+
+def manifest_paths(out_path):
+    """Paths of the manifest files of a dataset (unsharded and per shard), oldest first."""
+    out_path = Path(out_path)
+    paths = [out_path / MANIFEST_FILENAME] + list(
+        out_path.glob(SHARD_MANIFEST_FILENAME.format(shard_index='*')))
+    paths = [path for path in paths if path.exists()]
+    return sorted(paths, key=lambda path: (path.stat().st_mtime_ns, path.name))
+
+
+def source_signature(input_file):
+    """Path, size and modification time of each file in an input_files item."""
+    signature = dict()
+    for key, path in input_file.items():
+        stat = os.stat(path)
+        signature[key] = {'path': str(path), 'size': stat.st_size,
+                          'mtime_ns': stat.st_mtime_ns}
+    return signature
+
+
+def params_hash(*objs):
+    """
+    Hash the parameters of transforms (or any other objects).
+
+    Objects are converted to a stable string representation by recursing into
+    their public attributes, so two transforms configured identically have the
+    same hash across processes and runs. Private attributes (which hold
+    per-call state such as sampled noise) and random number generators are
+    ignored.
+    """
+    return hashlib.sha1(_stable_repr(objs).encode()).hexdigest()
+
+
+def _stable_repr(obj, _depth=0, _seen=None):
+    if _seen is None:
+        _seen = set()
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return repr(obj)
+    if isinstance(obj, np.generic):
+        return repr(obj.item())
+    if isinstance(obj, torch.Tensor):
+        obj = obj.detach().cpu().numpy()
+    if isinstance(obj, np.ndarray):
+        digest = hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest()
+        return f'ndarray({obj.dtype},{obj.shape},{digest})'
+    if isinstance(obj, (np.random.RandomState, np.random.Generator, torch.Generator)):
+        return type(obj).__name__
+    if _depth > 8 or id(obj) in _seen:
+        return type(obj).__qualname__
+    _seen = _seen | {id(obj)}
+    if isinstance(obj, (list, tuple)):
+        items = ','.join(_stable_repr(x, _depth + 1, _seen) for x in obj)
+        return f'[{items}]'
+    if isinstance(obj, dict):
+        items = ','.join(f'{_stable_repr(k)}:{_stable_repr(v, _depth + 1, _seen)}'
+                         for k, v in sorted(obj.items(), key=lambda item: str(item[0])))
+        return f'{{{items}}}'
+    if isinstance(obj, (set, frozenset)):
+        return _stable_repr(sorted(obj, key=str), _depth + 1, _seen)
+    if isinstance(obj, type):
+        return f'{obj.__module__}.{obj.__qualname__}'
+    if callable(obj) and not hasattr(obj, '__dict__'):
+        return getattr(obj, '__qualname__', type(obj).__qualname__)
+    name = f'{type(obj).__module__}.{type(obj).__qualname__}'
+    if hasattr(obj, '__dict__'):
+        attrs = {k: v for k, v in vars(obj).items() if not k.startswith('_')}
+        return name + _stable_repr(attrs, _depth + 1, _seen)
+    return name
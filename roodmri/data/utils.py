@@ -1,16 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import nibabel as nib
+import numpy as np
+
+SCAN_MODES = ['header', 'data']
+
+
 def is_file_list(input_files):
     """Used to check whether input_files are formatted correctly."""
     assert isinstance(input_files, list), "input_files must be a list."
     assert len(input_files) != 0, "input_files should be a non-empty list."
     assert all(isinstance(item, dict) for item in input_files), \
         "Each item in input_files should be a dictionary."
+    keys = set(input_files[0].keys())
     for item in input_files:
         assert isinstance(item, dict), \
             "Each item in input_files should be a dictionary."
-        assert len(item) == 2 \
-            and all([x in item.keys() for x in ['image', 'label']]), \
-                ("Each dictionary in input_files should have two keys: "
-                 "'image', and 'label'.")
+        assert len(item) >= 2 and 'label' in item.keys(), \
+            ("Each dictionary in input_files should have a 'label' key and at "
+             "least one image key ('image', or one key per modality, e.g., "
+             "'t1' and 'flair').")
+        assert set(item.keys()) == keys, \
+            "All dictionaries in input_files should have the same keys."
         assert all([isinstance(x, str) for x in item.values()]), \
             "All values in the dictionaries in input_files should be strings."
-        return True
\ No newline at end of file
+    return True
+
+
+def image_keys(input_file):
+    """
+    Keys of the images of an input_files item: every key but 'label'.
+
+    An item usually has a single 'image'; multi-modality subjects have one
+    key per modality (e.g., 't1', 'flair' and 't2').
+    """
+    return [key for key in input_file if key != 'label']
+
+
+def scan_input_files(input_files, mode = 'header', num_workers = 8, atol = 1e-3):
+    """
+    Check that all input files can be used before any work starts.
+
+    Files are checked in parallel threads. For each item of input_files, the
+    image(s) and label must exist and have readable headers, and the spatial
+    shapes (first three dimensions) and affines of each image and the label
+    must agree. In 'data' mode, the whole data of every file is also read,
+    which catches truncated or corrupt compressed files at the cost of
+    decompressing each file once.
+    All problems are reported together.
+
+    Args:
+        input_files: List of dictionaries with image and 'label' paths (see
+            DatasetGenerator).
+        mode (optional): 'header' or 'data'. Default is 'header'.
+        num_workers (optional): Number of threads. Default is 8.
+        atol (optional): Absolute tolerance of the affine comparison. Default
+            is 1e-3.
+
+    Returns:
+        List with one dictionary per item of input_files, holding the 'shape',
+        number of 'voxels' and data type ('dtype') of the image (for several
+        modalities, the shape and data type of the first one and the voxels
+        of all of them).
+    """
+    assert mode in SCAN_MODES, f"mode should be one of {SCAN_MODES}."
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        results = list(executor.map(lambda item: _scan_item(item, mode, atol), input_files))
+    problems = [problem for _, item_problems in results for problem in item_problems]
+    assert not problems, (f"{len(problems)} problems found in input_files:\n"
+                          + "\n".join(problems))
+    return [info for info, _ in results]
+
+
+def _scan_item(item, mode, atol):
+    """Header information of one item of input_files, and a list of its problems."""
+    headers, problems = dict(), []
+    keys = image_keys(item)
+    for key in keys + ['label']:
+        path = item[key]
+        if not os.path.exists(path):
+            problems.append(f"{path}: file not found.")
+            continue
+        try:
+            image = nib.load(path)
+            if mode == 'data':
+                np.asarray(image.dataobj)
+            headers[key] = image
+        except Exception as e:
+            problems.append(f"{path}: unreadable ({e}).")
+    if len(headers) < len(item):
+        return None, problems
+    label = headers['label']
+    for key in keys:
+        image = headers[key]
+        if image.shape[:3] != label.shape[:3]:
+            problems.append(f"{item[key]}: image shape {image.shape} does not match "
+                            f"label shape {label.shape}.")
+        if not np.allclose(image.affine, label.affine, atol=atol):
+            problems.append(f"{item[key]}: image and label affines do not match.")
+    image = headers[keys[0]]
+    info = {'shape': tuple(int(n) for n in image.shape),
+            'voxels': int(sum(np.prod(headers[key].shape) for key in keys)),
+            'dtype': str(image.get_data_dtype())}
+    return info, problems
@@ -0,0 +1,388 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import os
+from pathlib import Path
+import shutil
+import socket
+import threading
+import uuid
+
+from monai.data.utils import to_affine_nd
+import nibabel as nib
+import numpy as np
+import torch
+
+OUTPUT_FORMATS = ['nii.gz', 'nii', 'zarr']
+DEVICE = torch.device("cpu")
+
+
+class NiftiWriter(object):
+    """
+    Write benchmarking samples as NIfTI files.
+
+    Samples are saved to out_path/{transform}_{severity}/{subject_id}/ as
+    {subject_id}_{transform}_{severity}_{key}.nii.gz (or .nii), with the affine
+    of the input image. Arrays are stored as float32 unless another data type
+    is given to write; integer data types can be stored as is (e.g., uint8
+    labels) or scaled to the full range of the type with the NIfTI scl_slope
+    and scl_inter fields (e.g., int16 images, half the size of float32 with a
+    precision of 1/65535 of the intensity range).
+
+    Args:
+        compressed (optional): Boolean describing whether to gzip files
+            (.nii.gz) or not (.nii). Uncompressed files are faster to write and
+            can be memory-mapped when read. Default is True.
+        compression_level (optional): Integer gzip compression level from 1
+            (fastest) to 9 (smallest). If None, nibabel's default is used.
+            Ignored if compressed is False. Default is None.
+    """
+
+    def __init__(self, compressed = True, compression_level = None):
+        assert compression_level is None or compression_level in range(1, 10), \
+            "compression_level should be None or an integer from 1 to 9."
+        self.compressed = compressed
+        self.compression_level = compression_level
+        self.suffix = '.nii.gz' if compressed else '.nii'
+
+    def sample_path(self, out_path, transform_name, severity, subject_id, key):
+        """Path of one file of a benchmarking sample."""
+        return (Path(out_path) / f'{transform_name}_{severity}/{subject_id}'
+                / f'{subject_id}_{transform_name}_{severity}_{key}{self.suffix}')
+
+    def shared_label_path(self, out_path, subject_id, tag):
+        """Path of the label shared by a subject's label-preserving samples."""
+        return Path(out_path) / '.labels' / f'{subject_id}_{tag}_label{self.suffix}'
+
+    def write(self, data, path, affine, dtype = None, scaled = False):
+        """
+        Write data to path via a temporary file.
+
+        Args:
+            dtype (optional): Data type stored in the file. If None, float32.
+                Default is None.
+            scaled (optional): Boolean describing whether to scale data to the
+                range of an integer dtype (with scl_slope/scl_inter) rather
+                than round it. Default is False.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = _tmp_path(path)
+        array = np.squeeze(to_numpy(data))
+        if scaled:
+            # nibabel computes scl_slope/scl_inter and converts block by block
+            image = nib.Nifti1Image(array, to_affine_nd(3, to_numpy(affine)))
+            image.set_data_dtype(dtype)
+        else:
+            image = nib.Nifti1Image(_cast(array, dtype), to_affine_nd(3, to_numpy(affine)))
+        if self.compressed and self.compression_level is not None:
+            with gzip.open(tmp_path, 'wb', compresslevel=self.compression_level) as f:
+                image.to_file_map({'image': nib.FileHolder(fileobj=f)})
+        else:
+            nib.save(image, tmp_path)
+        os.replace(tmp_path, path)
+
+    def link(self, source, path, mode):
+        """Point path at source with a hard or symbolic link."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _link(source, path, mode)
+
+    @staticmethod
+    def read(path):
+        """
+        Open a sample without loading it.
+
+        Returns:
+            Tuple (array proxy, affine). The proxy can be sliced; slices of
+            uncompressed (.nii) files are read through a memory map.
+        """
+        image = nib.load(str(path), mmap='r')
+        return image.dataobj, image.affine
+
+
+class ZarrWriter(object):
+    """
+    Write benchmarking samples to chunked, compressed zarr array stores.
+
+    Each transform/severity level gets one store,
+    out_path/{transform}_{severity}.zarr, holding one array per sample at
+    {subject_id}/{key} (float32 unless another data type is given to write,
+    e.g., float16 images or uint8 labels). The affine of the input image is
+    kept in the 'affine' attribute of each array. Arrays are split into chunks of at
+    most chunk_size voxels per axis and each chunk is compressed separately,
+    so slices can be read without decompressing whole volumes. Requires the
+    zarr package.
+
+    Args:
+        chunk_size (optional): Maximum chunk length along each axis. Default is
+            64.
+    """
+
+    def __init__(self, chunk_size = 64):
+        try:
+            import zarr  # noqa: F401
+        except ImportError:
+            raise ImportError("The zarr package is required for the 'zarr' "
+                              "output format (pip install zarr).")
+        self.chunk_size = chunk_size
+
+    def sample_path(self, out_path, transform_name, severity, subject_id, key):
+        """Path of one array of a benchmarking sample."""
+        return Path(out_path) / f'{transform_name}_{severity}.zarr' / subject_id / key
+
+    def shared_label_path(self, out_path, subject_id, tag):
+        """Path of the label shared by a subject's label-preserving samples."""
+        return Path(out_path) / '.labels.zarr' / f'{subject_id}_{tag}' / 'label'
+
+    def write(self, data, path, affine, dtype = None, scaled = False):
+        """
+        Write data as an array at path via a temporary array.
+
+        Args:
+            dtype (optional): Data type of the array (e.g., float16 images or
+                uint8 labels). If None, float32. Default is None.
+            scaled (optional): Not supported; integer data types are stored
+                unscaled. Default is False.
+        """
+        import zarr
+        assert not scaled, "Scaled integer arrays are not supported by the zarr format."
+        data = _cast(np.squeeze(to_numpy(data)), dtype)
+        group = _require_group(path)
+        tmp_name = _tmp_path(path).name
+        create = getattr(group, 'create_array', None) or group.create_dataset
+        array = create(name=tmp_name, shape=data.shape, dtype=data.dtype,
+                       chunks=tuple(min(self.chunk_size, n) for n in data.shape),
+                       overwrite=True)
+        array[...] = data
+        array.attrs['affine'] = to_numpy(affine).tolist()
+        _replace_tree(path.parent / tmp_name, path)
+
+    def link(self, source, path, mode):
+        """Point path at the source array with hard links or a symbolic link."""
+        _require_group(path)
+        tmp_path = _tmp_path(path)
+        if mode == 'symlink':
+            os.symlink(os.path.relpath(source, path.parent), tmp_path)
+        else:
+            for root, _, filenames in os.walk(source):
+                target_dir = tmp_path / Path(root).relative_to(source)
+                target_dir.mkdir(parents=True, exist_ok=True)
+                for filename in filenames:
+                    _link(Path(root) / filename, target_dir / filename, mode)
+        _replace_tree(tmp_path, path)
+
+    @staticmethod
+    def read(path):
+        """
+        Open a sample without loading it.
+
+        Returns:
+            Tuple (zarr array, affine). Slicing the array only reads and
+            decompresses the chunks that overlap the slice.
+        """
+        import zarr
+        store_path, array_path = _split_store_path(path, array=True)
+        array = zarr.open_array(str(store_path), path=array_path, mode='r')
+        return array, np.array(array.attrs['affine'])
+
+
+class BackgroundWriter(object):
+    """
+    Run write jobs in background threads while the caller keeps computing.
+
+    At most max_pending jobs (each holding the arrays it will write) are
+    queued or running at once; submit blocks until a slot is free, which
+    bounds the memory used by pending writes. Errors raised by a job are
+    re-raised by the next call to submit or close, so no failed write goes
+    unnoticed.
+
+    Args:
+        num_threads: Number of writer threads.
+        max_pending (optional): Maximum number of jobs queued or running. If
+            None, 2 x num_threads. Default is None.
+    """
+
+    def __init__(self, num_threads, max_pending = None):
+        if max_pending is None:
+            max_pending = 2 * num_threads
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs), waiting while max_pending jobs are in flight."""
+        self._check()
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def close(self):
+        """Wait for all queued jobs to finish and re-raise the first error."""
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.futures = []
+            self.executor.shutdown(wait=True)
+
+    def _check(self):
+        """Drop finished jobs, re-raising the error of any that failed."""
+        pending = []
+        for future in self.futures:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self.futures = pending
+
+
+def _cast(array, dtype = None):
+    """Convert array to dtype (float32 if None), rounding floats to integers."""
+    dtype = np.dtype(np.float32 if dtype is None else dtype)
+    if dtype.kind in 'iu' and array.dtype.kind == 'f':
+        array = np.rint(array)
+    return array.astype(dtype, copy=False)
+
+
+def get_writer(output_format, compression_level = None):
+    """Create the writer for one of OUTPUT_FORMATS."""
+    assert output_format in OUTPUT_FORMATS, \
+        f"output_format should be one of {OUTPUT_FORMATS}."
+    if output_format == 'zarr':
+        return ZarrWriter()
+    return NiftiWriter(compressed=output_format == 'nii.gz',
+                       compression_level=compression_level)
+
+
+def path_size(path):
+    """Size in bytes of a file or of all files in a directory (None if missing)."""
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    if path.is_dir():
+        return sum(os.path.getsize(os.path.join(root, filename))
+                   for root, _, filenames in os.walk(path) for filename in filenames)
+    return None
+
+
+def path_mtime(path):
+    """
+    Modification time in nanoseconds of a file, or latest modification time of
+    the files in a directory (None if missing).
+    """
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_mtime_ns
+    if path.is_dir():
+        return max((os.stat(os.path.join(root, filename)).st_mtime_ns
+                    for root, _, filenames in os.walk(path) for filename in filenames),
+                   default=0)
+    return None
+
+
+def path_checksum(path):
+    """
+    SHA-1 checksum of a file, or of all files in a directory (None if missing).
+
+    Files in a directory (e.g., the chunks of a zarr array) are hashed in
+    sorted order, together with their paths relative to the directory.
+    """
+    path = Path(path)
+    if path.is_file():
+        files = [(None, path)]
+    elif path.is_dir():
+        files = sorted((str(file.relative_to(path)), file)
+                       for file in path.rglob('*') if file.is_file())
+    else:
+        return None
+    checksum = hashlib.sha1()
+    for name, file in files:
+        if name is not None:
+            checksum.update(name.encode() + b'\0')
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                checksum.update(block)
+    return checksum.hexdigest()
+
+
+def to_numpy(data):
+    """Convert a tensor or array to a numpy array."""
+    if isinstance(data, torch.Tensor):
+        return data.detach().to(DEVICE).numpy()
+    return np.asarray(data)
+
+
+def _tmp_path(path):
+    # unique across the processes and threads of every machine writing to out_path
+    return path.with_name(f'.{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex}'
+                          f'.{path.name}')
+
+
+def _split_store_path(path, array = False):
+    """Split an array path into the .zarr store path and the path inside it."""
+    parts = Path(path).parts
+    index = next(i for i, part in enumerate(parts) if part.endswith('.zarr'))
+    inner = parts[index + 1:] if array else parts[index + 1:-1]
+    return Path(*parts[:index + 1]), '/'.join(inner)
+
+
+def _require_group(path):
+    """Open (creating if needed) the zarr group that will contain path."""
+    import zarr
+    store_path, group_path = _split_store_path(path)
+    for attempt in range(3):
+        try:
+            group = zarr.open_group(str(store_path), mode='a')
+            return group.require_group(group_path) if group_path else group
+        except zarr.errors.ContainsGroupError:
+            if attempt == 2:   # group created concurrently by another process
+                raise
+
+
+def _link(source, path, mode):
+    """Point path at source with a hard or symbolic link, via a temporary link."""
+    tmp_path = _tmp_path(path)
+    if mode == 'symlink':
+        os.symlink(os.path.relpath(source, path.parent), tmp_path)
+    else:
+        try:
+            os.link(source, tmp_path)
+        except OSError:   # e.g., file system without hard link support
+            shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, path)
+    if os.path.lexists(tmp_path):   # path was already a hard link to source
+        os.remove(tmp_path)
+
+
+def _remove(path):
+    if os.path.islink(path) or not os.path.isdir(path):
+        os.remove(path)
+    else:
+        shutil.rmtree(path)
+
+
+def _replace_tree(tmp_path, path):
+    """Move a directory (or link) into place, removing what was there."""
+    if os.path.lexists(path):
+        _remove(path)
+    os.replace(tmp_path, path)
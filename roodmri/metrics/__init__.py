@@ -13,4 +13,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from .calculate import calculate_metrics
+from roodmri.utils.misc import lazy_attributes
+
+# submodules are imported on first use: calculate_metrics only needs pandas,
+# while evaluate_models imports torch
+__all__ = ['RunningStats', 'bootstrap_metrics', 'calculate_metrics',
+           'calculate_metrics_streaming', 'evaluate_models', 'evaluate_predictions',
+           'segmentation_metrics']
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    'RunningStats': '.streaming',
+    'bootstrap_metrics': '.bootstrap',
+    'calculate_metrics': '.calculate',
+    'calculate_metrics_streaming': '.streaming',
+    'evaluate_models': '.runner',
+    'evaluate_predictions': '.evaluate',
+    'segmentation_metrics': '.segmentation'
+})
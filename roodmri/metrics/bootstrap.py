@@ -0,0 +1,181 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from concurrent.futures import ProcessPoolExecutor
+import zlib
+
+import numpy as np
+import pandas as pd
+
+CI_STATS = ['estimate', 'lower', 'upper']
+
+
+def bootstrap_metrics(
+    df,
+    transform_col,
+    severity_col,
+    metric_cols,
+    clean_label,
+    grouping_cols = None,
+    subject_col = 'Subject_ID',
+    alpha_oa = 2/3,
+    alpha_deg = 2/3,
+    num_samples = 1000,
+    confidence = 0.95,
+    seed = None,
+    num_workers = 0
+):
+    """
+    Bootstrap confidence intervals for benchmarking/robustness metrics.
+
+    Subjects are resampled with replacement num_samples times, and the
+    Overall and Degradation metrics of calculate_metrics (mean columns) are
+    recomputed for each resample; intervals are percentiles of the
+    resampled values. Each resample keeps all transform/severity results of
+    the subjects it draws, so the pairing between clean and corrupted results
+    is preserved.
+
+    Each group (unique values of grouping_cols) is processed as a subject x
+    (transform, severity) array: subject means for every resample are a
+    single product of the (num_samples x subjects) matrix of resampling
+    counts with that array, and the severity-weighted sums are a second
+    product with a matrix of alpha_oa/alpha_deg weights. Groups are
+    processed in parallel if num_workers > 0.
+
+    Args:
+        df, transform_col, severity_col, metric_cols, clean_label,
+            grouping_cols, alpha_oa, alpha_deg: See calculate_metrics.
+        subject_col (optional): String describing the column label for the
+            subject column in df. Default is 'Subject_ID'.
+        num_samples (optional): Number of bootstrap resamples. Default is
+            1000.
+        confidence (optional): Confidence level of the percentile intervals.
+            Default is 0.95.
+        seed (optional): Integer random seed. Each group draws from its own
+            random generator derived from the seed and its grouping values,
+            so intervals do not depend on num_workers or on the other groups
+            in df. If None, results are not reproducible. Default is None.
+        num_workers (optional): Number of worker processes. If 0, groups are
+            processed in the current process. Default is 0.
+
+    Returns:
+        Tuple (combined_ci, combined_agg_ci) with the same index as combined
+        and combined_agg from calculate_metrics, and columns ('Overall' or
+        'Degradation', metric, 'estimate'/'lower'/'upper'), where estimate is
+        the value on the original sample (the mean column of calculate_metrics).
+    """
+    if grouping_cols is None:
+        grouping_cols = []
+    assert 0 < confidence < 1, "confidence should be between 0 and 1."
+    if grouping_cols:
+        groups = list(df.groupby(grouping_cols))
+    else:
+        groups = [((), df)]
+    args = []
+    for key, group in groups:
+        key = key if isinstance(key, tuple) else (key,)
+        seed_sequence = np.random.SeedSequence(
+            None if seed is None else [seed, zlib.crc32(repr(key).encode())])
+        args.append((group, transform_col, severity_col, metric_cols, clean_label,
+                     subject_col, alpha_oa, alpha_deg, num_samples, confidence,
+                     seed_sequence))
+    if num_workers > 0:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_bootstrap_group, *zip(*args)))
+    else:
+        results = [_bootstrap_group(*a) for a in args]
+    columns = pd.MultiIndex.from_product([['Overall', 'Degradation'],
+                                          list(metric_cols.keys()), CI_STATS])
+    rows, agg_rows = dict(), dict()
+    for (key, _), (transforms, values, agg_values) in zip(groups, results):
+        key = key if isinstance(key, tuple) else (key,)
+        for transform_name, row in zip(transforms, values):
+            rows[key + (transform_name,)] = row
+        agg_rows[key] = agg_values
+    combined_ci = pd.DataFrame.from_dict(rows, orient='index', columns=columns)
+    combined_ci.index = pd.MultiIndex.from_tuples(
+        combined_ci.index, names=grouping_cols + [transform_col])
+    combined_agg_ci = pd.DataFrame.from_dict(agg_rows, orient='index', columns=columns)
+    if grouping_cols:
+        combined_agg_ci.index = pd.MultiIndex.from_tuples(combined_agg_ci.index,
+                                                          names=grouping_cols)
+        if len(grouping_cols) == 1:
+            combined_agg_ci.index = combined_agg_ci.index.get_level_values(0)
+    return combined_ci.sort_index(), combined_agg_ci.sort_index()
+
+
+def _bootstrap_group(df, transform_col, severity_col, metric_cols, clean_label,
+                     subject_col, alpha_oa, alpha_deg, num_samples, confidence,
+                     seed_sequence):
+    """
+    Bootstrap the metrics of one group.
+
+    Returns:
+        Tuple (transforms, per-transform rows, aggregated row), rows ordered
+        as the columns of bootstrap_metrics.
+    """
+    metrics = list(metric_cols.keys())
+    table = (df.groupby([subject_col, transform_col, severity_col])[metrics].mean()
+             .unstack([transform_col, severity_col]))   # subjects x (metric, t, s)
+    cells = table[metrics[0]].columns   # (transform, severity) pairs, sorted
+    cell_transforms = cells.get_level_values(0)
+    severities = cells.get_level_values(1).to_numpy(dtype=float)
+    assert clean_label in cell_transforms, \
+        f"Each group should contain rows for {transform_col} {clean_label}."
+    clean = np.flatnonzero(cell_transforms == clean_label)
+    transforms = [t for t in cell_transforms.unique() if t != clean_label]
+    # weight matrices mapping (transform, severity) cells to transforms
+    oa_weights = np.zeros((len(cells), len(transforms)))
+    deg_weights = np.zeros((len(cells), len(transforms)))
+    for k, transform_name in enumerate(transforms):
+        member = cell_transforms == transform_name
+        oa_weights[member, k] = alpha_oa ** severities[member]
+        deg_weights[member, k] = alpha_deg ** severities[member]
+    # row 0: original sample; rows 1...: resampling counts of each subject
+    num_subjects = len(table)
+    rng = np.random.default_rng(seed_sequence)
+    counts = np.vstack([np.ones(num_subjects),
+                        rng.multinomial(num_subjects, np.full(num_subjects, 1 / num_subjects),
+                                        size=num_samples)])
+    overall, degradation = [], []
+    for metric in metrics:
+        values = table[metric].to_numpy(dtype=float)
+        valid = ~np.isnan(values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = (counts @ np.where(valid, values, 0)) / (counts @ valid)
+        clean_means = np.nanmean(means[:, clean], axis=1, keepdims=True)
+        filled = np.nan_to_num(means)   # missing cells add nothing, as in calculate_metrics
+        overall.append((filled @ oa_weights + clean_means) / (oa_weights.sum(axis=0) + 1))
+        sign = -1 if metric_cols[metric] else 1
+        deg = sign * np.nan_to_num(means - clean_means) @ deg_weights
+        degradation.append(deg / deg_weights.sum(axis=0))
+    # (samples, transforms, columns) in the order Overall/Degradation x metrics
+    values = np.stack(overall + degradation, axis=-1)
+    agg_values = values.mean(axis=1)
+    return (transforms, _summarize(values, confidence),
+            _summarize(agg_values, confidence))
+
+
+def _summarize(values, confidence):
+    """
+    Point estimates and confidence bounds of bootstrapped values.
+
+    values has the original sample in row 0 and the bootstrap samples in the
+    other rows; the last axis (columns) is interleaved as (estimate, lower,
+    upper) for each column.
+    """
+    tail = 100 * (1 - confidence) / 2
+    lower, upper = np.nanpercentile(values[1:], [tail, 100 - tail], axis=0)
+    return np.stack([values[0], lower, upper], axis=-1).reshape(*values.shape[1:-1], -1)
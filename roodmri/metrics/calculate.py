@@ -13,6 +13,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
 
 
@@ -24,7 +29,8 @@ def calculate_metrics(
     clean_label,
     grouping_cols = None,
     alpha_oa = 2/3,
-    alpha_deg = 2/3
+    alpha_deg = 2/3,
+    cache_path = None
 ):
     """
     Calculate benchmarking/robustness metrics.
@@ -65,12 +71,54 @@ def calculate_metrics(
         alpha_deg (optional): Severity-level weighting parameter for degradation
             metric calculations (e.g., wmDSC). See Boone et al., 2022 for
             details. Default is 2/3.
+        cache_path (optional): Path to a pickle file caching the metrics of
+            each group (unique values of grouping_cols) with a fingerprint of
+            the group's rows. If the file exists, only groups that are new or
+            whose rows changed (in any column used by the metrics, regardless
+            of row order) are recomputed, and cached metrics are reused for
+            the others; the file is then updated. The cache is ignored if it
+            was written with different arguments. Default is None.
     """
+    if cache_path is not None:
+        return _calculate_metrics_cached(df, transform_col, severity_col, metric_cols,
+                                         clean_label, grouping_cols, alpha_oa, alpha_deg,
+                                         cache_path)
     # TODO assertions to check that column labels exist in df, etc.
     if grouping_cols is None:
         grouping_cols = []
     agg = (df.groupby(grouping_cols + [transform_col, severity_col])
            [list(metric_cols.keys())].agg(['mean', 'std'])) # agg over subjects
+    return metrics_from_agg(agg, transform_col, severity_col, metric_cols,
+                            clean_label, grouping_cols, alpha_oa, alpha_deg)
+
+
+def metrics_from_agg(
+    agg,
+    transform_col,
+    severity_col,
+    metric_cols,
+    clean_label,
+    grouping_cols = None,
+    alpha_oa = 2/3,
+    alpha_deg = 2/3
+):
+    """
+    Calculate benchmarking/robustness metrics from per-group statistics.
+
+    Second half of calculate_metrics, for callers that aggregate the
+    per-sample results themselves (see calculate_metrics_streaming).
+
+    Args:
+        agg: pandas DataFrame indexed by grouping_cols, transform_col and
+            severity_col, with (metric, 'mean') and (metric, 'std') columns
+            holding the mean and standard deviation of each metric over
+            subjects, i.e., df.groupby(grouping_cols + [transform_col,
+            severity_col])[metrics].agg(['mean', 'std']).
+        Other arguments: See calculate_metrics.
+    """
+    if grouping_cols is None:
+        grouping_cols = []
+    agg = agg.copy()
     clean_rows = (agg.xs(clean_label, axis=0, level=transform_col)
                   .droplevel(severity_col, axis=0))   # get clean rows
     agg.drop(clean_label, axis=0, level=transform_col, inplace=True) # drop rows
@@ -98,3 +146,59 @@ def calculate_metrics(
     combined = oa_metrics.join(deg_metrics)
     combined_agg = combined.groupby(grouping_cols).agg('mean')
     return combined, combined_agg
+
+
+def _calculate_metrics_cached(df, transform_col, severity_col, metric_cols, clean_label,
+                              grouping_cols, alpha_oa, alpha_deg, cache_path):
+    """calculate_metrics, recomputing only groups whose rows are not in the cache."""
+    assert grouping_cols, "grouping_cols should be specified to cache metrics."
+    grouping_cols = list(grouping_cols)
+    settings = (transform_col, severity_col, dict(metric_cols), clean_label,
+                grouping_cols, alpha_oa, alpha_deg)
+    cache = {'settings': settings, 'fingerprints': dict(), 'combined': None}
+    if Path(cache_path).exists():
+        cached = pd.read_pickle(cache_path)
+        if cached['settings'] == settings:
+            cache = cached
+    groups = {key if isinstance(key, tuple) else (key,): indices
+              for key, indices in df.groupby(grouping_cols).indices.items()}
+    fingerprints = _group_fingerprints(df, groups, [transform_col, severity_col]
+                                       + list(metric_cols.keys()))
+    changed = [key for key, fingerprint in fingerprints.items()
+               if cache['fingerprints'].get(key) != fingerprint]
+    parts = []
+    if cache['combined'] is not None:   # cached rows of unchanged groups
+        combined = cache['combined']
+        keys = combined.index.droplevel(transform_col).to_flat_index()
+        keys = [key if isinstance(key, tuple) else (key,) for key in keys]
+        unchanged = [key in fingerprints and key not in changed for key in keys]
+        parts.append(combined[unchanged])
+    if changed:
+        rows = np.sort(np.concatenate([groups[key] for key in changed]))
+        parts.append(calculate_metrics(df.iloc[rows], transform_col, severity_col,
+                                       metric_cols, clean_label, grouping_cols,
+                                       alpha_oa, alpha_deg)[0])
+    combined = pd.concat(parts).sort_index()
+    cache = {'settings': settings, 'fingerprints': fingerprints, 'combined': combined}
+    temp_path = f'{cache_path}.tmp'
+    pd.to_pickle(cache, temp_path)
+    os.replace(temp_path, cache_path)   # never leave a partially written cache
+    combined_agg = combined.groupby(grouping_cols).agg('mean')
+    return combined, combined_agg
+
+
+def _group_fingerprints(df, groups, columns):
+    """
+    Fingerprint of the rows of each group, independent of row order.
+
+    Args:
+        df: pandas DataFrame.
+        groups: Dictionary mapping group keys to positions of rows in df.
+        columns: Sequence of column labels included in the fingerprints.
+
+    Returns:
+        Dictionary mapping group keys to hex digests of the sorted row hashes.
+    """
+    hashes = pd.util.hash_pandas_object(df[list(columns)], index=False).to_numpy()
+    return {key: hashlib.sha1(np.sort(hashes[indices]).tobytes()).hexdigest()
+            for key, indices in groups.items()}
@@ -0,0 +1,286 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import os
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from roodmri.metrics.segmentation import METRICS, segmentation_metrics
+
+DEFAULT_PRED_PATTERN = ('{transform}_{severity}/{subject_id}/'
+                        '{subject_id}_{transform}_{severity}_pred.nii.gz')
+
+
+def evaluate_predictions(
+    benchmark_path,
+    pred_path,
+    pred_pattern = DEFAULT_PRED_PATTERN,
+    model = None,
+    clean_label = 'Clean',
+    clean_labels = None,
+    metrics = None,
+    labels = None,
+    threshold = 0.5,
+    use_spacing = True,
+    num_workers = 0,
+    input_cache = None,
+    query = None,
+    query_vars = None
+):
+    """
+    Evaluate a model's predictions on a benchmarking dataset.
+
+    Predictions are compared to the labels of the benchmarking dataset
+    generated by DatasetGenerator (and to the original labels for clean
+    data), and the results are returned as a DataFrame with one row per
+    sample that can be passed directly to calculate_metrics:
+
+        Model,Transform,Severity,Subject_ID,DSC,HD95,ASD,VD
+        unet_a,Affine,1,000001,0.82,1.41,0.53,-120.0
+        .
+        .
+        unet_a,Clean,0,000001,0.85,1.41,0.47,-85.0
+
+    Samples are listed from the sample index (or manifest) of the
+    benchmarking dataset or, if it has none (e.g., datasets generated with
+    older versions), from its {transform}_{severity}/{subject_id}/ folders,
+    and can be filtered with query. Samples without a
+    prediction file are skipped with a warning. Subjects are evaluated in
+    parallel, and each distinct label file is only read once per subject.
+
+    Args:
+        benchmark_path: Path to the benchmarking dataset (out_path of
+            DatasetGenerator).
+        pred_path: Path to the folder containing the predictions.
+        pred_pattern (optional): Format string giving the path of the
+            prediction for a sample relative to pred_path, with fields
+            {transform}, {severity} and {subject_id}. Clean data has
+            transform clean_label and severity 0. Default is
+            '{transform}_{severity}/{subject_id}/{subject_id}_{transform}_{severity}_pred.nii.gz'.
+        model (optional): String added to every row as a 'Model' column. If
+            None, no 'Model' column is added. Default is None.
+        clean_label (optional): String used as the transform of clean data.
+            Default is 'Clean'.
+        clean_labels (optional): Original (clean) label of each subject,
+            either a dictionary mapping subject IDs to label paths or the path
+            to a csv file saved by DatasetGenerator.save_filename_mappings.
+            If None, clean labels are read from the manifest; if the dataset
+            has no manifest, clean data is not evaluated. Default is None.
+        metrics (optional): Sequence of metrics to calculate (see
+            segmentation_metrics). If None, all metrics are calculated.
+            Default is None.
+        labels (optional): Sequence of label values to evaluate separately,
+            for multi-class segmentations. Results then include a 'Label'
+            column. If None, voxels above threshold are evaluated as a single
+            foreground class. Default is None.
+        threshold (optional): Float threshold separating foreground from
+            background when labels is None. Default is 0.5.
+        use_spacing (optional): Boolean describing whether distances and
+            volumes are in physical units given by the voxel sizes of the
+            label files (True) or in voxels (False). Default is True.
+        num_workers (optional): Number of worker processes. If 0, subjects
+            are evaluated in the current process. Default is 0.
+        input_cache (optional): Path to a cache directory, or DecodedCache
+            (see roodmri/data/cache.py), through which label files are read,
+            so that evaluating several models (or the same model again) does
+            not decompress the labels each time. Predictions are always read
+            directly. If None, labels are read directly. Default is None.
+        query (optional): pandas query expression selecting the samples to
+            evaluate, over the columns of the sample index (see SampleIndex in
+            roodmri/data/index.py; only subject_id, transform and severity
+            for datasets without a manifest). Clean samples have transform
+            clean_label and severity 0. E.g., "transform == 'Ghosting' and
+            severity >= 3 and subject_id in @subjects". If None, all samples
+            are evaluated. Default is None.
+        query_vars (optional): Dictionary with the values of the variables
+            referenced with @ in query. Default is None.
+
+    Returns:
+        pandas DataFrame with one row per sample (and label value), sorted by
+        transform, severity and subject ID.
+    """
+    if metrics is None:
+        metrics = METRICS
+    samples = benchmark_samples(benchmark_path, clean_label, clean_labels, query, query_vars)
+    units, missing = [], 0
+    for subject_id in sorted(samples):
+        unit = []
+        for transform_name, severity, _, label_file in samples[subject_id]:
+            pred_file = Path(pred_path) / pred_pattern.format(
+                transform=transform_name, severity=severity, subject_id=subject_id)
+            if pred_file.exists():
+                unit.append((transform_name, severity, str(label_file), str(pred_file)))
+            else:
+                missing += 1
+        if unit:
+            units.append((subject_id, unit))
+    if missing:
+        print(f"WARNING: {missing} samples have no prediction in {pred_path} and "
+              "were skipped.")
+    if input_cache is not None:
+        from roodmri.data.cache import get_cache
+        input_cache = get_cache(input_cache)
+    args = [(unit, metrics, labels, threshold, use_spacing, input_cache) for unit in units]
+    if num_workers > 0:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_evaluate_subject, *zip(*args)))
+    else:
+        results = [_evaluate_subject(*a) for a in args]
+    df = pd.DataFrame([row for rows in results for row in rows],
+                      columns=result_columns(metrics, labels))
+    df = df.sort_values(['Transform', 'Severity', 'Subject_ID'], kind='stable',
+                        ignore_index=True)
+    if model is not None:
+        df.insert(0, 'Model', model)
+    return df
+
+
+def result_columns(metrics, labels = None):
+    """Columns of the results of one model (see evaluate_predictions)."""
+    return (['Transform', 'Severity', 'Subject_ID'] + ([] if labels is None else ['Label'])
+            + list(metrics))
+
+
+def sample_results(pred, label, affine, metrics, labels = None, threshold = 0.5,
+                   use_spacing = True):
+    """
+    Metrics of one predicted sample, for each label value.
+
+    Returns:
+        List of rows [label value, metric values...] (without the label value
+        if labels is None), see evaluate_predictions for the arguments.
+    """
+    spacing = np.sqrt((affine[:3, :3] ** 2).sum(axis=0)) if use_spacing else None
+    rows = []
+    for value in ([None] if labels is None else labels):
+        if value is None:
+            masks = pred > threshold, label > threshold
+        else:
+            masks = np.rint(pred) == value, np.rint(label) == value
+        results = segmentation_metrics(*masks, spacing=spacing, metrics=metrics)
+        rows.append(([] if value is None else [value]) + [results[m] for m in metrics])
+    return rows
+
+
+def benchmark_samples(benchmark_path, clean_label = 'Clean', clean_labels = None,
+                      query = None, query_vars = None):
+    """
+    List the samples of a benchmarking dataset saved by DatasetGenerator.
+
+    See evaluate_predictions for the arguments.
+
+    Returns:
+        Dictionary mapping each subject ID to a list of (transform, severity,
+        image path, label path). The image path of multi-modality samples is
+        a tuple with the path of each modality, and that of clean samples is
+        None if clean_labels is given.
+    """
+    from roodmri.data.index import SampleIndex, index_path
+    from roodmri.data.manifest import manifest_paths
+    benchmark_path = Path(benchmark_path)
+    if clean_labels is not None and not isinstance(clean_labels, dict):
+        with open(clean_labels, newline='') as csvfile:
+            clean_labels = {row['new_subject_id']: row['original_label_filename']
+                            for row in csv.DictReader(csvfile)}
+    if index_path(benchmark_path) is not None or manifest_paths(benchmark_path):
+        table = SampleIndex.load(benchmark_path).df
+        table = table.assign(image_path=[benchmark_path / p for p in table['image_path']],
+                             label_path=[benchmark_path / p for p in table['label_path']])
+        sources = table.drop_duplicates(['subject_id', 'modality'], keep='last')
+        clean = pd.DataFrame({'subject_id': sources['subject_id'],
+                              'modality': sources['modality'],
+                              'original_image': sources['original_image'],
+                              'original_label': sources['original_label'],
+                              'image_path': [Path(p) for p in sources['original_image']],
+                              'label_path': [Path(p) for p in sources['original_label']]})
+    else:
+        rows = []
+        for folder in sorted(benchmark_path.glob('*_*')):
+            transform_name, severity = folder.name.rsplit('_', 1)
+            if not folder.is_dir() or not severity.isdigit():
+                continue
+            for label_file in sorted(folder.glob('*/*_label.nii*')):
+                image_file = label_file.with_name(label_file.name.replace('_label.', '_image.'))
+                rows.append([label_file.parent.name, transform_name, int(severity),
+                             image_file, label_file])
+        table = pd.DataFrame(rows, columns=['subject_id', 'transform', 'severity',
+                                            'image_path', 'label_path'])
+        table = table.sort_values(['subject_id', 'transform', 'severity'], kind='stable')
+        clean = None
+    if clean_labels is not None:
+        clean = pd.DataFrame({'subject_id': list(clean_labels.keys()), 'image_path': None,
+                              'label_path': [Path(p) for p in clean_labels.values()]})
+    if clean is not None:
+        table = pd.concat([table, clean.assign(transform=clean_label, severity=0)],
+                          ignore_index=True)
+    if query is not None:
+        table = table.query(query, local_dict=query_vars or dict())
+    samples, image_paths = dict(), dict()   # image paths of the modalities of each sample
+    for row in table.itertuples(index=False):
+        key = (row.subject_id, row.transform, int(row.severity))
+        if key not in image_paths:
+            image_paths[key] = []
+            samples.setdefault(row.subject_id, []).append((key, row.label_path))
+        image_paths[key].append(row.image_path)
+    for subject_samples in samples.values():
+        for k, (key, label_path) in enumerate(subject_samples):
+            paths = image_paths[key]
+            subject_samples[k] = (key[1], key[2], paths[0] if len(paths) == 1 else tuple(paths),
+                                  label_path)
+    return samples
+
+
+def _evaluate_subject(unit, metrics, labels, threshold, use_spacing, input_cache = None):
+    """Evaluate all samples of one subject, reading each label file once."""
+    subject_id, samples = unit
+    label_cache = dict()
+    rows = []
+    for transform_name, severity, label_file, pred_file in samples:
+        stat = os.stat(label_file)
+        key = (stat.st_dev, stat.st_ino)   # hard links share a cached label
+        if key not in label_cache:
+            label_cache[key] = read_array(label_file, input_cache)
+        label, affine = label_cache[key]
+        pred, _ = read_array(pred_file)
+        assert pred.shape == label.shape, \
+            f"Prediction {pred_file} and label {label_file} have different shapes."
+        for row in sample_results(pred, label, affine, metrics, labels, threshold,
+                                  use_spacing):
+            rows.append([transform_name, severity, subject_id] + row)
+    return rows
+
+
+def read_array(path, input_cache = None):
+    """
+    Read a NIfTI file or zarr array, returning (squeezed array, affine).
+
+    If input_cache (a DecodedCache) is given, files other than zarr arrays are
+    read through it, and the array is memory-mapped.
+    """
+    if any(part.endswith('.zarr') for part in Path(path).parts):
+        from roodmri.data.writers import ZarrWriter
+        array, affine = ZarrWriter.read(path)
+    elif input_cache is not None:
+        array, meta = input_cache.load(path)
+        affine = meta['affine']
+    else:
+        image = nib.load(str(path))
+        array, affine = image.dataobj, image.affine
+    return np.squeeze(np.asarray(array)), np.asarray(affine)
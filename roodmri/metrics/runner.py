@@ -0,0 +1,246 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import csv
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from roodmri.metrics.evaluate import (benchmark_samples, read_array, result_columns,
+                                      sample_results)
+from roodmri.metrics.segmentation import METRICS
+
+
+def evaluate_models(
+    models,
+    benchmark,
+    csv_path = None,
+    batch_size = 1,
+    roi_size = None,
+    sw_batch_size = 1,
+    overlap = 0.25,
+    postprocess = None,
+    device = None,
+    num_workers = 0,
+    metric_workers = 0,
+    metrics = None,
+    labels = None,
+    threshold = 0.5,
+    use_spacing = True,
+    input_cache = None
+):
+    """
+    Run torch models on a benchmarking dataset and evaluate their predictions.
+
+    Work is split into three pipelined stages: DataLoader workers load (or
+    generate) samples, the current process runs inference, and a process pool
+    computes metrics, so loading, inference and metric computation overlap.
+    Samples with the same shape are stacked into batches of up to batch_size
+    volumes, and every model is run on each batch, so inputs
+    are only loaded/decoded once however many models are compared. Results
+    are returned as a DataFrame in the format expected by calculate_metrics:
+
+        Model,Transform,Severity,Subject_ID,DSC,HD95,ASD,VD
+
+    Args:
+        models: Dictionary mapping model names to callables (e.g., torch
+            modules) taking a batch of images of shape (B, C, H, W, D) and
+            returning a batch of outputs, or a single callable (named
+            'model').
+        benchmark: BenchmarkDataset (samples generated on the fly), or the
+            path to a benchmarking dataset saved by DatasetGenerator (samples
+            are listed as in evaluate_predictions, including clean samples
+            when the dataset has a manifest; pass a SavedBenchmarkDataset to
+            select samples with a query).
+        csv_path (optional): Path to a csv file that results are written to
+            as soon as they are computed (in completion order), so partial
+            results survive an interrupted run. Default is None.
+        batch_size (optional): Maximum number of same-shape volumes per
+            inference batch. Default is 1.
+        roi_size (optional): Sequence with the spatial size of the windows
+            used for sliding-window inference (MONAI's
+            sliding_window_inference). If None, models are run on whole
+            volumes. Default is None.
+        sw_batch_size (optional): Number of windows per model call in
+            sliding-window inference. Default is 1.
+        overlap (optional): Overlap between windows in sliding-window
+            inference. Default is 0.25.
+        postprocess (optional): Callable turning a batch of model outputs
+            into a batch of label maps. If None, outputs with one channel are
+            thresholded at 0 (logits) and outputs with several channels are
+            reduced with argmax over channels. Default is None.
+        device (optional): torch device to run models on. If None, 'cuda' if
+            available, otherwise 'cpu'. Default is None.
+        num_workers (optional): Number of DataLoader worker processes loading
+            samples. Default is 0.
+        metric_workers (optional): Number of processes computing metrics. If
+            0, metrics are computed in the current process after each batch.
+            Default is 0.
+        metrics, labels, threshold, use_spacing (optional): See
+            evaluate_predictions.
+        input_cache (optional): Path to a cache directory, or DecodedCache,
+            through which the files of a saved benchmarking dataset are read
+            (see roodmri/data/cache.py). For a BenchmarkDataset, pass it to
+            the dataset instead. Default is None.
+
+    Returns:
+        pandas DataFrame with one row per model and sample (and label value),
+        sorted by model, transform, severity and subject ID.
+    """
+    if metrics is None:
+        metrics = METRICS
+    if not isinstance(models, dict):
+        models = {'model': models}
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if postprocess is None:
+        postprocess = _default_postprocess
+    if not isinstance(benchmark, Dataset):
+        benchmark = SavedBenchmarkDataset(benchmark, input_cache=input_cache)
+    for model in models.values():
+        if isinstance(model, torch.nn.Module):
+            model.to(device).eval()
+    columns = ['Model'] + result_columns(metrics, labels)
+    loader = DataLoader(benchmark, batch_size=None, num_workers=num_workers)
+    executor = ProcessPoolExecutor(metric_workers) if metric_workers > 0 else None
+    csv_file = None
+    if csv_path is not None:
+        csv_file = open(csv_path, 'w', newline='')
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(columns)
+    rows, pending = [], set()
+
+    def add_rows(new_rows):
+        rows.extend(new_rows)
+        if csv_file is not None:
+            csv_writer.writerows(new_rows)
+            csv_file.flush()
+
+    try:
+        for batch in _same_shape_batches(loader, batch_size):
+            images = torch.stack([torch.as_tensor(s['image']) for s in batch])
+            images = images.to(device=device, dtype=torch.float32)
+            for name, model in models.items():
+                with torch.no_grad():
+                    if roi_size is None:
+                        outputs = model(images)
+                    else:
+                        from monai.inferers import sliding_window_inference
+                        outputs = sliding_window_inference(images, roi_size, sw_batch_size,
+                                                           model, overlap=overlap)
+                    preds = postprocess(outputs).detach().cpu().numpy()
+                for sample, pred in zip(batch, preds):
+                    ids = (name, sample['transform'], int(sample['severity']),
+                           sample['subject_id'])
+                    args = (ids, np.squeeze(pred), np.squeeze(np.asarray(sample['label'])),
+                            np.asarray(sample['affine']), metrics, labels, threshold,
+                            use_spacing)
+                    if executor is None:
+                        add_rows(_evaluate_sample(*args))
+                        continue
+                    pending.add(executor.submit(_evaluate_sample, *args))
+                    while len(pending) >= 4 * metric_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            add_rows(future.result())
+        for future in pending:
+            add_rows(future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if csv_file is not None:
+            csv_file.close()
+    df = pd.DataFrame(rows, columns=columns)
+    return df.sort_values(['Model', 'Transform', 'Severity', 'Subject_ID'], kind='stable',
+                          ignore_index=True)
+
+
+class SavedBenchmarkDataset(Dataset):
+    """
+    Samples of a benchmarking dataset saved by DatasetGenerator.
+
+    Items have the same format as BenchmarkDataset items (the modalities of
+    multi-modality samples are stacked as channels of the image). Samples are
+    listed as in evaluate_predictions; clean samples without an image are left
+    out.
+
+    Args:
+        benchmark_path: Path to the benchmarking dataset.
+        clean_label (optional): String used as the transform of clean data.
+            Default is 'Clean'.
+        input_cache (optional): Path to a cache directory, or DecodedCache,
+            through which files are read. Default is None.
+        query, query_vars (optional): Filter of the samples, see
+            evaluate_predictions. Default is None.
+    """
+
+    def __init__(self, benchmark_path, clean_label = 'Clean', input_cache = None,
+                 query = None, query_vars = None):
+        samples = benchmark_samples(benchmark_path, clean_label, query=query,
+                                    query_vars=query_vars)
+        self.input_cache = None
+        if input_cache is not None:
+            from roodmri.data.cache import get_cache
+            self.input_cache = get_cache(input_cache)
+        self.samples = [(subject_id, transform_name, severity, image_file, label_file)
+                        for subject_id in sorted(samples)
+                        for transform_name, severity, image_file, label_file
+                        in samples[subject_id] if image_file is not None]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        subject_id, transform_name, severity, image_file, label_file = self.samples[index]
+        image_files = image_file if isinstance(image_file, tuple) else (image_file,)
+        images = [read_array(path, self.input_cache) for path in image_files]
+        label, _ = read_array(label_file, self.input_cache)
+        image, affine = np.stack([image for image, _ in images]), images[0][1]
+        return {
+            'image': torch.as_tensor(image),
+            'label': torch.as_tensor(label[np.newaxis]),
+            'affine': torch.as_tensor(affine),
+            'subject_id': subject_id,
+            'transform': transform_name,
+            'severity': severity
+        }
+
+
+def _same_shape_batches(samples, batch_size):
+    """Group samples with the same image shape into batches of batch_size."""
+    buckets = dict()   # samples waiting for a full batch, keyed by shape
+    for sample in samples:
+        bucket = buckets.setdefault(tuple(sample['image'].shape), [])
+        bucket.append(sample)
+        if len(bucket) == batch_size:
+            yield buckets.pop(tuple(sample['image'].shape))
+    yield from buckets.values()
+
+
+def _default_postprocess(outputs):
+    if outputs.shape[1] == 1:
+        return (outputs > 0).to(torch.uint8)
+    return torch.argmax(outputs, dim=1, keepdim=True)
+
+
+def _evaluate_sample(ids, pred, label, affine, metrics, labels, threshold, use_spacing):
+    """Result rows of one model on one sample; ids is (model, transform, severity, subject)."""
+    assert pred.shape == label.shape, \
+        f"Prediction and label of {ids} have different shapes."
+    return [list(ids) + row for row in sample_results(pred, label, affine, metrics,
+                                                      labels, threshold, use_spacing)]
@@ -0,0 +1,141 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+from scipy import ndimage
+
+METRICS = ['DSC', 'HD95', 'ASD', 'VD']
+
+
+def segmentation_metrics(pred, label, spacing = None, metrics = None):
+    """
+    Calculate segmentation metrics for a predicted mask.
+
+    Surface-based metrics share one computation of the surfaces and distance
+    transforms. Both masks are first cropped to the bounding box of their
+    union (plus a one-voxel margin), outside of which they are empty, so the
+    cost of the distance transforms depends on the size of the segmented
+    structures rather than on the size of the volume.
+
+    Surface voxels are foreground voxels with a background neighbour (6-
+    connectivity), and surface distances are distances from each surface
+    voxel of one mask to the closest surface voxel of the other. HD95 and ASD
+    follow MONAI's compute_hausdorff_distance (percentile=95) and
+    compute_average_surface_distance (symmetric=True).
+
+    Args:
+        pred: Boolean array (or array cast to boolean) with the predicted mask.
+        label: Boolean array with the ground truth mask, same shape as pred.
+        spacing (optional): Sequence of voxel sizes along each axis, used to
+            express distances and volumes in physical units. If None,
+            distances are in voxels and volumes in number of voxels. Default
+            is None.
+        metrics (optional): Sequence of metric names to calculate, from
+            'DSC' (Dice similarity coefficient), 'HD95' (95th percentile
+            symmetric Hausdorff distance), 'ASD' (mean of the average surface
+            distances in both directions) and 'VD' (volume difference, pred
+            minus label). If None, all metrics are calculated. Default is
+            None.
+
+    Returns:
+        Dictionary mapping metric names to values. If both masks are empty,
+        DSC is 1 and distances are 0; if only one is empty, DSC is 0 and
+        distances are NaN.
+    """
+    if metrics is None:
+        metrics = METRICS
+    assert all(metric in METRICS for metric in metrics), \
+        f"metrics should be a subset of {METRICS}."
+    pred, label = np.asarray(pred, dtype=bool), np.asarray(label, dtype=bool)
+    assert pred.shape == label.shape, "pred and label should have the same shape."
+    if spacing is None:
+        spacing = np.ones(pred.ndim)
+    values = dict()
+    if 'DSC' in metrics:
+        values['DSC'] = dice_coefficient(pred, label)
+    if 'HD95' in metrics or 'ASD' in metrics:
+        pred_to_label, label_to_pred = surface_distances(pred, label, spacing)
+        if pred_to_label is None:
+            both_empty = not pred.any() and not label.any()
+            distance = 0.0 if both_empty else np.nan
+            hd95 = asd = distance
+        else:
+            hd95 = max(np.percentile(pred_to_label, 95), np.percentile(label_to_pred, 95))
+            asd = (pred_to_label.mean() + label_to_pred.mean()) / 2
+        if 'HD95' in metrics:
+            values['HD95'] = float(hd95)
+        if 'ASD' in metrics:
+            values['ASD'] = float(asd)
+    if 'VD' in metrics:
+        values['VD'] = volume_difference(pred, label, spacing)
+    return {metric: values[metric] for metric in metrics}
+
+
+def dice_coefficient(pred, label):
+    """Dice similarity coefficient of two masks (1 if both are empty)."""
+    pred, label = np.asarray(pred, dtype=bool), np.asarray(label, dtype=bool)
+    total = np.count_nonzero(pred) + np.count_nonzero(label)
+    if total == 0:
+        return 1.0
+    return 2.0 * np.count_nonzero(pred & label) / total
+
+
+def volume_difference(pred, label, spacing = None):
+    """Volume of pred minus volume of label, in units of prod(spacing)."""
+    voxel_volume = 1.0 if spacing is None else float(np.prod(spacing))
+    difference = np.count_nonzero(pred) - np.count_nonzero(label)
+    return difference * voxel_volume
+
+
+def surface_distances(pred, label, spacing = None):
+    """
+    Distances between the surfaces of two masks.
+
+    Returns:
+        Tuple (distances from each surface voxel of pred to the surface of
+        label, distances from each surface voxel of label to the surface of
+        pred), or (None, None) if either mask is empty.
+    """
+    pred, label = np.asarray(pred, dtype=bool), np.asarray(label, dtype=bool)
+    crop = _union_bounding_box(pred, label)
+    if crop is None or not pred.any() or not label.any():
+        return None, None
+    # both masks are empty outside the bounding box, so padding with zeros
+    # keeps surfaces on the image border and all distances exact
+    pred_surface = _surface(np.pad(pred[crop], 1))
+    label_surface = _surface(np.pad(label[crop], 1))
+    if spacing is None:
+        spacing = np.ones(pred.ndim)
+    to_label = ndimage.distance_transform_edt(~label_surface, sampling=spacing)
+    to_pred = ndimage.distance_transform_edt(~pred_surface, sampling=spacing)
+    return to_label[pred_surface], to_pred[label_surface]
+
+
+def _surface(mask):
+    """Foreground voxels with at least one background neighbour."""
+    return mask & ~ndimage.binary_erosion(mask)
+
+
+def _union_bounding_box(pred, label):
+    """Slices of the bounding box of pred | label, or None if both are empty."""
+    union = pred | label
+    crop = []
+    for axis in range(union.ndim):
+        other_axes = tuple(a for a in range(union.ndim) if a != axis)
+        indices = np.flatnonzero(union.any(axis=other_axes))
+        if len(indices) == 0:
+            return None
+        crop.append(slice(indices[0], indices[-1] + 1))
+    return tuple(crop)
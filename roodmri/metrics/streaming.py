@@ -0,0 +1,202 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from roodmri.metrics.calculate import metrics_from_agg
+
+STATS = ['count', 'mean', 'm2']
+
+
+class RunningStats(object):
+    """
+    Mergeable running statistics of segmentation metrics per group.
+
+    For each group (unique values of the key columns) and metric, the number
+    of non-missing values, their mean and their sum of squared deviations
+    from the mean (M2) are kept. Statistics are updated one chunk of rows at
+    a time and two RunningStats can be merged (Chan et al.'s parallel
+    algorithm), so results can be aggregated chunk by chunk, or separately
+    on different machines and combined afterwards, without holding all rows
+    in memory.
+
+    Args:
+        key_cols: Sequence of column labels defining the groups (e.g.,
+            grouping_cols + [transform_col, severity_col]).
+        metric_cols: Sequence of metric column labels.
+    """
+
+    def __init__(self, key_cols, metric_cols):
+        self.key_cols = list(key_cols)
+        self.metric_cols = list(metric_cols)
+        columns = pd.MultiIndex.from_product([self.metric_cols, STATS])
+        index = pd.MultiIndex.from_tuples([], names=self.key_cols)
+        self.stats = pd.DataFrame(columns=columns, index=index, dtype=float)
+
+    def update(self, df):
+        """Add the rows of a DataFrame chunk to the statistics."""
+        groups = df.groupby(self.key_cols)[self.metric_cols]
+        count = groups.count()
+        mean = groups.mean()
+        m2 = groups.var(ddof=0) * count
+        chunk = pd.concat({'count': count, 'mean': mean, 'm2': m2}, axis=1)
+        chunk = chunk.swaplevel(0, 1, axis=1)[self.stats.columns]
+        self.stats = _merge_stats(self.stats, chunk, self.metric_cols)
+        return self
+
+    def merge(self, other):
+        """Combine with the statistics of another RunningStats (e.g., a shard)."""
+        assert other.key_cols == self.key_cols and other.metric_cols == self.metric_cols, \
+            "RunningStats should have the same key and metric columns to be merged."
+        self.stats = _merge_stats(self.stats, other.stats, self.metric_cols)
+        return self
+
+    def agg(self):
+        """
+        Mean and standard deviation of each metric per group.
+
+        Returns:
+            pandas DataFrame equal (up to rounding) to
+            df.groupby(key_cols)[metric_cols].agg(['mean', 'std']) for all rows
+            added so far.
+        """
+        columns = dict()
+        for metric in self.metric_cols:
+            count = self.stats[(metric, 'count')]
+            columns[(metric, 'mean')] = self.stats[(metric, 'mean')].where(count > 0)
+            columns[(metric, 'std')] = np.sqrt(
+                self.stats[(metric, 'm2')] / (count - 1)).where(count > 1)
+        return pd.DataFrame(columns, index=self.stats.index).sort_index()
+
+    def save(self, path):
+        """Save the statistics to a pickle file, e.g., to merge them elsewhere."""
+        pd.to_pickle({'key_cols': self.key_cols, 'metric_cols': self.metric_cols,
+                      'stats': self.stats}, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load statistics saved with save."""
+        state = pd.read_pickle(path)
+        running_stats = cls(state['key_cols'], state['metric_cols'])
+        running_stats.stats = state['stats']
+        return running_stats
+
+
+def calculate_metrics_streaming(
+    data,
+    transform_col,
+    severity_col,
+    metric_cols,
+    clean_label,
+    grouping_cols = None,
+    alpha_oa = 2/3,
+    alpha_deg = 2/3,
+    chunksize = 1000000,
+    read_kwargs = None
+):
+    """
+    Calculate benchmarking/robustness metrics without loading all results.
+
+    Same as calculate_metrics, but per-sample results are read and reduced
+    to running statistics (see RunningStats) one chunk at a time, so the
+    results table never has to fit in memory. Only the grouping, transform,
+    severity and metric columns are read from files.
+
+    Args:
+        data: Per-sample results (see calculate_metrics for the format), as
+            a path to a csv or Parquet (.parquet) file, a sequence of such
+            paths, an iterable of pandas DataFrames, or a RunningStats (e.g.,
+            merged from shards aggregated on different machines).
+        chunksize (optional): Number of rows per chunk when reading files.
+            Default is 1000000.
+        read_kwargs (optional): Dictionary of extra keyword arguments for
+            pd.read_csv. Default is None.
+        Other arguments: See calculate_metrics.
+
+    Returns:
+        Tuple (combined, combined_agg) as returned by calculate_metrics.
+    """
+    if grouping_cols is None:
+        grouping_cols = []
+    running_stats = data
+    if not isinstance(data, RunningStats):
+        running_stats = RunningStats(grouping_cols + [transform_col, severity_col],
+                                     list(metric_cols.keys()))
+        for chunk in read_chunks(data, running_stats.key_cols + running_stats.metric_cols,
+                                 chunksize, read_kwargs):
+            running_stats.update(chunk)
+    return metrics_from_agg(running_stats.agg(), transform_col, severity_col,
+                            metric_cols, clean_label, grouping_cols, alpha_oa, alpha_deg)
+
+
+def read_chunks(data, columns = None, chunksize = 1000000, read_kwargs = None):
+    """
+    Iterate over per-sample results in chunks of rows.
+
+    Args:
+        data: Path to a csv or Parquet file, sequence of paths, or iterable of
+            pandas DataFrames (yielded as they are).
+        columns (optional): Sequence of columns to read. If None, all columns
+            are read. Default is None.
+        chunksize (optional): Number of rows per chunk. Default is 1000000.
+        read_kwargs (optional): Dictionary of extra keyword arguments for
+            pd.read_csv. Default is None.
+    """
+    if isinstance(data, (str, Path)):
+        data = [data]
+    for item in data:
+        if isinstance(item, pd.DataFrame):
+            yield item if columns is None else item[list(columns)]
+        elif str(item).endswith('.parquet'):
+            try:
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("The pyarrow package is required to read Parquet "
+                                  "files (pip install pyarrow).")
+            for batch in pq.ParquetFile(item).iter_batches(batch_size=chunksize,
+                                                           columns=columns):
+                yield batch.to_pandas()
+        else:
+            yield from pd.read_csv(item, usecols=columns, chunksize=chunksize,
+                                   **(read_kwargs or dict()))
+
+
+def _merge_stats(a, b, metric_cols):
+    """Merge two tables of per-group count/mean/M2 statistics."""
+    if len(a) == 0:
+        return b.copy()
+    if len(b) == 0:
+        return a.copy()
+    index = a.index.union(b.index)
+    a, b = a.reindex(index), b.reindex(index)
+    merged = dict()
+    for metric in metric_cols:
+        na = a[(metric, 'count')].fillna(0)
+        nb = b[(metric, 'count')].fillna(0)
+        ma = a[(metric, 'mean')].fillna(0)
+        mb = b[(metric, 'mean')].fillna(0)
+        n = na + nb
+        delta = mb - ma
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = (ma + delta * nb / n).where(n > 0, 0)
+            m2 = (a[(metric, 'm2')].fillna(0) + b[(metric, 'm2')].fillna(0)
+                  + (delta ** 2 * na * nb / n).where(n > 0, 0))
+        merged[(metric, 'count')] = n
+        merged[(metric, 'mean')] = mean
+        merged[(metric, 'm2')] = m2
+    return pd.DataFrame(merged, index=index)
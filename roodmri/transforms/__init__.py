@@ -13,4 +13,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from .defaults import DEFAULT_TRANSFORM_SETTINGS
+from roodmri.utils.misc import lazy_attributes
+
+__all__ = ['ChannelwiseAdjustContrastd', 'ChannelwiseRandRicianNoised',
+           'DEFAULT_TRANSFORM_SETTINGS', 'default_transform_settings']
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    'ChannelwiseAdjustContrastd': '.intensity',
+    'ChannelwiseRandRicianNoised': '.intensity',
+    'DEFAULT_TRANSFORM_SETTINGS': '.defaults',
+    'default_transform_settings': '.defaults'
+})
@@ -0,0 +1,166 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Severity-batched implementations of transforms.
+
+A batched implementation applies several copies of the same transform, each
+configured for a different severity level, to one sample in a single pass.
+Work that does not depend on the severity level (intensity statistics,
+normalization, Fourier transforms, etc.) is done once and the outputs are
+written to preallocated buffers. Each function has the signature
+
+    fn(transforms, data, seeds) -> list of data dictionaries
+
+where transforms is the list of configured transforms (one per severity
+level, see DatasetGenerator), data is the sample dictionary produced by the
+pre_transforms, and seeds is the list of per-sample random seeds (None when
+no seed is set). Random MONAI transforms draw from their own random states
+(already seeded by the generator) in the same order as the original
+transforms, so batched and unbatched outputs match. Random TorchIO transforms
+draw from torch's global random number generator, reseeded with seeds[k]
+before drawing the parameters of severity level k (see kspace.py).
+"""
+
+from monai.transforms import AdjustContrastd, RandRicianNoised, Randomizable
+from monai.utils import ensure_tuple_rep
+import numpy as np
+import torch
+import torchio as tio
+
+from roodmri.transforms.intensity import ChannelwiseAdjustContrastd, ChannelwiseRandRicianNoised
+from roodmri.transforms.kspace import ghosting_severities, motion_severities
+from roodmri.transforms.spatial import affine_severities, elastic_severities
+
+
+def adjust_contrast_severities(transforms, data, seeds = None):
+    """
+    Batched AdjustContrastd: gamma correction at several gamma values.
+
+    The intensity range and normalized image are computed once per key (per
+    channel for ChannelwiseAdjustContrastd) and shared by all gamma values.
+    """
+    outputs = [dict(data) for _ in transforms]
+    channel_wise = isinstance(transforms[0], ChannelwiseAdjustContrastd)
+    for key in transforms[0].key_iterator(data):
+        img, is_tensor = _to_numpy(data[key])
+        epsilon = 1e-7   # same as monai.transforms.AdjustContrast
+        parts = [slice(c, c + 1) for c in range(len(img))] if channel_wise else [slice(None)]
+        out = None
+        for part in parts:
+            img_min = img[part].min()
+            img_range = img[part].max() - img_min
+            norm = (img[part] - img_min) / float(img_range + epsilon)
+            if out is None:
+                out = np.empty((len(transforms),) + img.shape, dtype=norm.dtype)
+            for k, transform in enumerate(transforms):
+                np.power(norm, transform.adjuster.gamma, out=out[k][part])
+                out[k][part] *= img_range
+                out[k][part] += img_min
+        for k in range(len(transforms)):
+            outputs[k][key] = _from_numpy(out[k], is_tensor)
+    return outputs
+
+
+def rician_noise_severities(transforms, data, seeds = None):
+    """
+    Batched RandRicianNoised: Rician noise at several noise levels.
+
+    Per-channel (or whole-image) standard deviations used for relative noise
+    are computed once and shared by all noise levels. For
+    ChannelwiseRandRicianNoised, the random state is restored before each
+    channel.
+    """
+    same_draws = isinstance(transforms[0], ChannelwiseRandRicianNoised)
+    outputs = [dict(data) for _ in transforms]
+    stds = dict()   # shared statistics, keyed by data key
+    out = dict()    # preallocated output buffers, keyed by data key
+    for k, transform in enumerate(transforms):
+        transform.randomize(None)
+        if not transform._do_transform:
+            continue
+        noise = transform.rand_rician_noise
+        for key in transform.key_iterator(data):
+            noise.randomize(None)
+            if not noise._do_transform:
+                continue
+            if key not in out:
+                img, is_tensor = _to_numpy(data[key])
+                img = img.astype(noise.dtype, copy=False)
+                out[key] = (img, is_tensor, np.empty((len(transforms),) + img.shape,
+                                                     dtype=img.dtype))
+            img, is_tensor, buffer = out[key]
+            if noise.channel_wise:
+                if key not in stds:
+                    stds[key] = [d.std() for d in img]
+                means = ensure_tuple_rep(noise.mean, len(img))
+                std_values = ensure_tuple_rep(noise.std, len(img))
+                state = noise.R.get_state() if same_draws else None
+                for c, d in enumerate(img):
+                    if state is not None:
+                        noise.R.set_state(state)
+                    std = std_values[c] * stds[key][c] if noise.relative else std_values[c]
+                    _add_rician_noise(noise, d, means[c], std, buffer[k][c])
+            else:
+                if key not in stds:
+                    stds[key] = img.std()
+                std = noise.std * stds[key] if noise.relative else noise.std
+                _add_rician_noise(noise, img, noise.mean, std, buffer[k])
+            outputs[k][key] = _from_numpy(buffer[k], is_tensor)
+    return outputs
+
+
+BATCHED_TRANSFORMS = {
+    AdjustContrastd: adjust_contrast_severities,
+    ChannelwiseAdjustContrastd: adjust_contrast_severities,
+    RandRicianNoised: rician_noise_severities,
+    ChannelwiseRandRicianNoised: rician_noise_severities,
+    tio.transforms.RandomGhosting: ghosting_severities,
+    tio.transforms.RandomMotion: motion_severities,
+    tio.transforms.RandomAffine: affine_severities,
+    tio.transforms.RandomElasticDeformation: elastic_severities,
+}
+
+
+def get_batched_transform(transform):
+    """Batched implementation registered for the type of transform, or None."""
+    return BATCHED_TRANSFORMS.get(type(transform))
+
+
+def is_random_transform(transform):
+    """Whether transform is a random MONAI or TorchIO transform."""
+    return isinstance(transform, (Randomizable, tio.transforms.augmentation.RandomTransform))
+
+
+def _add_rician_noise(noise, img, mean, std, out):
+    """Same computation (and random draws) as RandRicianNoise._add_noise, into out."""
+    _std = noise.R.uniform(0, std) if noise.sample_std else std
+    noise1 = noise.R.normal(mean, _std, size=img.shape).astype(img.dtype, copy=False)
+    noise2 = noise.R.normal(mean, _std, size=img.shape).astype(img.dtype, copy=False)
+    np.add(img, noise1, out=out)
+    np.square(out, out=out)
+    np.square(noise2, out=noise2)
+    out += noise2
+    np.sqrt(out, out=out)
+
+
+def _to_numpy(data):
+    if isinstance(data, torch.Tensor):
+        return data.detach().cpu().numpy(), True
+    return np.asarray(data), False
+
+
+def _from_numpy(data, is_tensor):
+    return torch.from_numpy(data) if is_tensor else data
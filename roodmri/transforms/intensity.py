@@ -0,0 +1,92 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Intensity transforms that treat each channel of an image on its own.
+
+The modalities of a multi-modality subject are the channels of 'image' (see
+DatasetGenerator). MONAI's AdjustContrastd normalizes with the intensity
+range of all channels together, and RandRicianNoised draws the noise of each
+channel after that of the previous one, so a modality's output would depend
+on the other modalities. The transforms here give each channel the output it
+would get as a single-channel image; single-channel images are transformed
+exactly as by the MONAI transforms.
+"""
+
+from monai.transforms import AdjustContrastd, RandRicianNoised
+from monai.utils import convert_data_type, ensure_tuple_rep
+import numpy as np
+import torch
+
+
+class ChannelwiseAdjustContrastd(AdjustContrastd):
+    """
+    AdjustContrastd with the intensity range of each channel.
+
+    Each channel is normalized with its own minimum and range before the
+    gamma correction.
+    """
+
+    def __call__(self, data):
+        d = dict(data)
+        for key in self.key_iterator(d):
+            d[key] = _stack([self.adjuster(channel) for channel in d[key]], d[key])
+        return d
+
+
+class ChannelwiseRandRicianNoised(RandRicianNoised):
+    """
+    RandRicianNoised (channel_wise=True) with the same random draws for each channel.
+
+    The random state of the noise is restored before each channel, so every
+    channel gets the noise it would get as a single-channel image (the noise
+    of two channels then only differs by its relative standard deviation).
+    See RandRicianNoised for the arguments.
+    """
+
+    def __init__(self, keys, prob = 0.1, mean = 0.0, std = 1.0, relative = False,
+                 sample_std = True, dtype = np.float32, allow_missing_keys = False):
+        super().__init__(keys, prob=prob, mean=mean, std=std, channel_wise=True,
+                         relative=relative, sample_std=sample_std, dtype=dtype,
+                         allow_missing_keys=allow_missing_keys)
+
+    def __call__(self, data):
+        d = dict(data)
+        self.randomize(None)
+        if not self._do_transform:
+            return d
+        noise = self.rand_rician_noise
+        for key in self.key_iterator(d):
+            noise.randomize(None)
+            if not noise._do_transform:
+                continue
+            img, *_ = convert_data_type(d[key], dtype=noise.dtype)
+            means = ensure_tuple_rep(noise.mean, len(img))
+            stds = ensure_tuple_rep(noise.std, len(img))
+            state = noise.R.get_state()
+            channels = []
+            for c, channel in enumerate(img):
+                noise.R.set_state(state)
+                std = stds[c] * channel.std() if noise.relative else stds[c]
+                channels.append(noise._add_noise(channel, mean=means[c], std=std))
+            d[key] = _stack(channels, img)
+        return d
+
+
+def _stack(channels, like):
+    """Stack channels as a tensor or an array, like the input image."""
+    if isinstance(like, torch.Tensor):
+        return torch.stack(channels)
+    return np.stack(channels)
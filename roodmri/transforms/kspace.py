@@ -0,0 +1,239 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Severity-batched k-space artifacts (TorchIO RandomGhosting and RandomMotion).
+
+Both transforms corrupt the Fourier spectrum of each image channel. Here the
+spectrum of the clean channel is computed once and shared by every severity
+level, and the corrupted spectra of all severity levels are inverted together
+in batched FFT calls, which run on torch's intra-op thread pool (see
+threads_per_worker in DatasetGenerator). Random parameters are drawn from
+torch's random number generator in the same order as TorchIO, so outputs
+match the unbatched transforms up to floating point rounding.
+"""
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+import torchio as tio
+from torchio.data.io import nib_to_sitk
+
+FFT_BATCH_BYTES = 2 ** 30   # maximum size of the spectra inverted in one FFT call
+SPATIAL_DIMS = (-3, -2, -1)
+
+
+def ghosting_severities(transforms, data, seeds = None):
+    """
+    Batched tio.transforms.RandomGhosting: ghosting at several severity levels.
+
+    Ghosting scales every num_ghosts-th plane of the spectrum along one axis
+    except the center of k-space, i.e., multiplies the spectrum by a mask that
+    only varies along that axis. The inverse FFT along the other two axes is
+    therefore done once per axis and shared by every severity level; only the
+    inverse FFT along the ghosting axis is done per severity level.
+    """
+    if transforms[0].include is None or any(
+            isinstance(axis, str) for t in transforms for axis in t.axes):
+        return _apply_unbatched(transforms, data, seeds)
+    keys = _image_keys(transforms[0], data)
+    params = []
+    for k, transform in enumerate(transforms):
+        params.append(dict())
+        if not _draw_probability(transform, seeds, k):
+            continue
+        for key in keys:
+            axes = transform.axes
+            if _is_2d(data[key]):
+                axes = tuple(a for a in axes if a != 2)
+            min_ghosts, max_ghosts = transform.num_ghosts_range
+            params[k][key] = transform.get_params(
+                (int(min_ghosts), int(max_ghosts)), tuple(int(a) for a in axes),
+                transform.intensity_range, transform.restore)
+        if keys:
+            torch.rand(1)   # drawn by the Ghosting transform RandomGhosting applies
+    outputs = [dict(data) for _ in transforms]
+    for key in keys:
+        image = torch.as_tensor(data[key])
+        active = [k for k in range(len(transforms))
+                  if key in params[k] and params[k][key][0] and params[k][key][2]]
+        results = {k: [] for k in range(len(transforms)) if key in params[k]}
+        for channel in image:
+            spectrum = _fourier_transform(channel)
+            for axis in sorted({params[k][key][1] for k in active}):
+                severities = [k for k in active if params[k][key][1] == axis]
+                masks = [_ghost_mask(spectrum.shape[axis], params[k][key][0],
+                                     float(params[k][key][2]), params[k][key][3])
+                         for k in severities]
+                for k, result in zip(severities, _inv_fourier_masked(spectrum, axis, masks)):
+                    results[k].append(result)
+            for k in results:
+                if k not in active:   # no ghosts or zero intensity
+                    results[k].append(channel)
+        for k, channels in results.items():
+            outputs[k][key] = torch.stack(channels)
+    return outputs
+
+
+def motion_severities(transforms, data, seeds = None):
+    """
+    Batched tio.transforms.RandomMotion: motion at several severity levels.
+
+    The slab of k-space taken from the clean image is cut from the shared
+    spectrum. For the slabs taken from moved (resampled) images, the FFT along
+    the last axis is done on the whole volume but the FFT along the first two
+    axes only on the slab, which is all that is kept.
+    """
+    if transforms[0].include is None:
+        return _apply_unbatched(transforms, data, seeds)
+    keys = _image_keys(transforms[0], data)
+    params = []
+    for k, transform in enumerate(transforms):
+        params.append(dict())
+        if not _draw_probability(transform, seeds, k):
+            continue
+        for key in keys:
+            params[k][key] = transform.get_params(
+                transform.degrees_range, transform.translation_range,
+                transform.num_transforms, is_2d=_is_2d(data[key]))
+        if keys:
+            torch.rand(1)   # drawn by the Motion transform RandomMotion applies
+    outputs = [dict(data) for _ in transforms]
+    for key in keys:
+        image = torch.as_tensor(data[key])
+        active = [k for k in range(len(transforms)) if key in params[k]]
+        results = {k: [] for k in active}
+        for channel in image:
+            sitk_image = nib_to_sitk(channel[np.newaxis], np.eye(4), force_3d=True)
+            spectrum = _fourier_transform(channel)
+            corrupted = []
+            for k in active:
+                times, degrees, translation = params[k][key]
+                corrupted.append(_motion_spectrum(
+                    sitk_image, spectrum, times, degrees, translation,
+                    transforms[k].image_interpolation))
+            for k, result in zip(active, _inv_fourier_transforms(corrupted)):
+                results[k].append(result)
+        for k, channels in results.items():
+            outputs[k][key] = torch.stack(channels)
+    return outputs
+
+
+def _ghost_mask(length, num_ghosts, intensity, restore):
+    """Factors by which tio.transforms.Ghosting.add_artifact scales each plane."""
+    mask = torch.ones(length)
+    mask[::num_ghosts] = 1 - intensity
+    mid_idx = length // 2
+    if restore is None:
+        mask[mid_idx:mid_idx + 1] = 1
+    else:
+        size_restore = int(np.round(restore * length))
+        mask[mid_idx - size_restore // 2:mid_idx + size_restore // 2] = 1
+    return mask
+
+
+def _motion_spectrum(sitk_image, spectrum, times, degrees, translation, interpolation):
+    """Same spectrum as tio.transforms.Motion.add_artifact, reusing spectrum."""
+    motion = tio.transforms.Motion(degrees, translation, times, interpolation)
+    rigid_transforms = motion.get_rigid_transforms(degrees, translation, sitk_image)
+    images = motion.resample_images(sitk_image, rigid_transforms, interpolation)
+    order = list(range(len(images)))   # image used for each slab of k-space
+    motion.sort_spectra(order, times)
+    last_index = spectrum.shape[-1]
+    indices = [int(value) for value in (last_index * times).astype(int).tolist()]
+    indices.append(last_index)
+    result = torch.empty_like(spectrum)
+    ini = 0
+    for j, fin in zip(order, indices):
+        if j == 0:   # clean image
+            result[..., ini:fin] = spectrum[..., ini:fin]
+        elif fin > ini:
+            array = sitk.GetArrayFromImage(images[j]).transpose()
+            result[..., ini:fin] = _fourier_slab(torch.from_numpy(array), ini, fin)
+        ini = fin
+    return result
+
+
+def _fourier_transform(tensor):
+    """Centered spectrum, as tio.transforms.FourierTransform.fourier_transform."""
+    return torch.fft.fftshift(torch.fft.fftn(tensor))
+
+
+def _fourier_slab(tensor, ini, fin):
+    """Centered spectrum of tensor restricted to [..., ini:fin]."""
+    length = tensor.shape[-1]
+    shifted = (torch.arange(ini, fin) - length // 2) % length   # fftshift of [ini:fin]
+    slab = torch.fft.fft(tensor, dim=-1).index_select(-1, shifted)
+    return torch.fft.fftshift(torch.fft.fftn(slab, dim=(0, 1)), dim=(0, 1))
+
+
+def _inv_fourier_transforms(spectra):
+    """Real part of the inverse of each centered spectrum, in batched FFT calls."""
+    results = []
+    if not spectra:
+        return results
+    batch_size = max(1, FFT_BATCH_BYTES // (spectra[0].numel() * spectra[0].element_size()))
+    for start in range(0, len(spectra), batch_size):
+        batch = torch.stack(spectra[start:start + batch_size])
+        batch = torch.fft.ifftn(torch.fft.ifftshift(batch, dim=SPATIAL_DIMS), dim=SPATIAL_DIMS)
+        results.extend(batch.real.contiguous())
+    return results
+
+
+def _inv_fourier_masked(spectrum, axis, masks):
+    """
+    Real part of the inverse of the centered spectrum multiplied by each mask.
+
+    Each mask holds one factor per plane along axis.
+    """
+    other_dims = tuple(d for d in range(spectrum.ndim) if d != axis)
+    partial = torch.fft.ifftn(torch.fft.ifftshift(spectrum, dim=other_dims), dim=other_dims)
+    shape = [1] * spectrum.ndim
+    shape[axis] = -1
+    results = []
+    batch_size = max(1, FFT_BATCH_BYTES // (partial.numel() * partial.element_size()))
+    for start in range(0, len(masks), batch_size):
+        batch = partial * torch.stack([m.reshape(shape) for m in masks[start:start + batch_size]])
+        batch = torch.fft.ifft(torch.fft.ifftshift(batch, dim=axis + 1), dim=axis + 1)
+        results.extend(batch.real.contiguous())
+    return results
+
+
+def _image_keys(transform, data):
+    """Keys of the images a TorchIO intensity transform is applied to."""
+    label_keys = transform.label_keys or []
+    exclude = transform.exclude or []
+    return [key for key in data if key in transform.include
+            and key not in label_keys and key not in exclude]
+
+
+def _draw_probability(transform, seeds, k):
+    """Seed severity level k and draw whether its transform is applied."""
+    if seeds is not None and seeds[k] is not None:
+        torch.manual_seed(seeds[k])
+    return not torch.rand(1).item() > transform.probability
+
+
+def _is_2d(data):
+    return data.shape[-1] == 1
+
+
+def _apply_unbatched(transforms, data, seeds):
+    outputs = []
+    for k, transform in enumerate(transforms):
+        if seeds is not None and seeds[k] is not None:
+            torch.manual_seed(seeds[k])
+        outputs.append(transform(dict(data)))
+    return outputs
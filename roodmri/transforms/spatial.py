@@ -0,0 +1,338 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Severity-batched spatial transforms (TorchIO RandomAffine and
+RandomElasticDeformation).
+
+TorchIO resamples every channel of every image with a separate SimpleITK
+filter, which evaluates the transform (for elastic deformation, a cubic
+B-spline over 64 control points) at every voxel each time. Here, for each
+severity level, the random parameters are drawn as in TorchIO and the
+SimpleITK transform is built with TorchIO's own methods (so centers,
+orientations and B-spline grids are the same), then converted to voxel
+coordinates: an affine matrix, or a displacement field evaluated from the
+B-spline control points one axis at a time. The volume is resampled in slabs
+along the first axis: the sampling coordinates of a slab are computed once
+and all channels of the image and the label are interpolated together with
+torch's grid_sample, which uses torch's intra-op threads (see
+threads_per_worker in DatasetGenerator).
+
+Interpolation follows SimpleITK's ResampleImageFilter (points within half a
+voxel of the volume take the values at its edge, points beyond get the pad
+value), so outputs match the unbatched transforms up to single precision
+rounding of the sampling coordinates. Transforms using other interpolation
+methods than 'linear' and 'nearest' are applied unbatched.
+
+With the default settings, labels are treated as intensity images by
+TorchIO (linear interpolation, thresholded by the AsDiscreted post
+transform); labels listed in the transform's label_keys use the transform's
+label interpolation ('nearest' by default).
+"""
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+import torchio as tio
+from torchio.data.io import nib_to_sitk
+
+from roodmri.transforms.kspace import _apply_unbatched, _draw_probability
+
+SLAB_VOXELS = 2 ** 20   # output voxels whose sampling coordinates are computed at once
+GRID_SAMPLE_MODES = {'nearest': 'nearest', 'linear': 'bilinear'}   # trilinear for volumes
+
+
+def affine_severities(transforms, data, seeds = None):
+    """
+    Batched tio.transforms.RandomAffine: affine resampling at several severity levels.
+
+    Each severity level's transform is a single voxel-to-voxel matrix, so
+    sampling coordinates are computed directly for each slab.
+    """
+    keys = _spatial_keys(transforms, data)
+    if keys is None:
+        return _apply_unbatched(transforms, data, seeds)
+    channels = _channel_groups(data, keys, transforms[0])
+    shape = tuple(data[keys[0]].shape[1:])
+    reference = _reference_image(shape)
+    geometry = tio.ScalarImage(tensor=torch.as_tensor(data[keys[0]]))
+    outputs = [dict(data) for _ in transforms]
+    for k, transform in enumerate(transforms):
+        if not _draw_probability(transform, seeds, k):
+            continue
+        params = [[float(value) for value in values.tolist()] for values in transform.get_params(
+            transform.scales, transform.degrees, transform.translation, transform.isotropic)]
+        torch.rand(1)   # drawn by the Affine transform RandomAffine applies
+        affine = tio.transforms.Affine(
+            scales=tuple(params[0]), degrees=tuple(params[1]), translation=tuple(params[2]),
+            center=transform.center, default_pad_value=transform.default_pad_value,
+            default_pad_label=transform.default_pad_label,
+            image_interpolation=transform.image_interpolation,
+            label_interpolation=transform.label_interpolation,
+            check_shape=transform.check_shape)
+        matrix = _voxel_matrix(affine.get_affine_transform(geometry), reference)
+
+        def coordinates(start, stop, matrix=matrix):
+            grid = _index_grid(shape, start, stop)
+            return np.tensordot(matrix[:, :3], grid, axes=1) + matrix[:, 3, None, None, None]
+
+        def pad_value(key, c, is_label, minimum, affine=affine):
+            if is_label:
+                return affine.default_pad_label
+            if affine.default_pad_value == 'minimum':
+                return minimum
+            sitk_image = None
+            if affine.default_pad_value in ('mean', 'otsu'):
+                tensor = torch.as_tensor(data[key][c])
+                sitk_image = nib_to_sitk(tensor[np.newaxis], np.eye(4), force_3d=True)
+            return affine.get_default_pad_value(None, sitk_image)
+
+        outputs[k].update(_resample(channels, shape, coordinates, pad_value))
+    return outputs
+
+
+def elastic_severities(transforms, data, seeds = None):
+    """
+    Batched tio.transforms.RandomElasticDeformation: elastic deformation at
+    several severity levels.
+
+    The cubic B-spline weights of the control points along each axis are
+    computed once and shared by every severity level. The displacement field
+    is contracted along the last two axes once per severity level, and along
+    the first axis one slab at a time.
+    """
+    keys = _spatial_keys(transforms, data)
+    if keys is None:
+        return _apply_unbatched(transforms, data, seeds)
+    channels = _channel_groups(data, keys, transforms[0])
+    shape = tuple(data[keys[0]].shape[1:])
+    reference = _reference_image(shape)
+    outputs = [dict(data) for _ in transforms]
+    weights = dict()   # B-spline weights along each axis, by number of control points
+    for k, transform in enumerate(transforms):
+        if not _draw_probability(transform, seeds, k):
+            continue
+        control_points = transform.get_params(
+            transform.num_control_points, transform.max_displacement,
+            transform.num_locked_borders)
+        torch.rand(1)   # drawn by the ElasticDeformation transform RandomElasticDeformation applies
+        if not any(transform.max_displacement):
+            continue
+        deformation = tio.transforms.ElasticDeformation(
+            control_points=control_points, max_displacement=transform.max_displacement,
+            image_interpolation=transform.image_interpolation,
+            label_interpolation=transform.label_interpolation)
+        bspline = deformation.get_bspline_transform(reference)
+        grid_shape = control_points.shape[:-1]
+        if grid_shape not in weights:
+            weights[grid_shape] = _bspline_weights(bspline, reference)
+        coordinates = _bspline_coordinates(bspline, reference, weights[grid_shape])
+
+        def pad_value(key, c, is_label, minimum):
+            return minimum
+
+        outputs[k].update(_resample(channels, shape, coordinates, pad_value))
+    return outputs
+
+
+def _spatial_keys(transforms, data):
+    """
+    Keys of the images transforms are applied to, or None if the transforms
+    should be applied unbatched.
+    """
+    transform = transforms[0]
+    settings = [(t.include, t.exclude, t.label_keys, t.image_interpolation, t.label_interpolation)
+                for t in transforms]
+    if transform.include is None or any(
+            getattr(t, 'keep', None) is not None
+            or t.image_interpolation not in GRID_SAMPLE_MODES
+            or t.label_interpolation not in GRID_SAMPLE_MODES for t in transforms) \
+            or any(s != settings[0] for s in settings):
+        return None
+    exclude = transform.exclude or []
+    keys = [key for key in data if key in transform.include and key not in exclude]
+    if not keys or any(np.ndim(data[key]) != 4 for key in keys) \
+            or len({tuple(data[key].shape[1:]) for key in keys}) > 1:
+        return None   # TorchIO raises its own errors
+    return keys
+
+
+def _channel_groups(data, keys, transform):
+    """
+    Channels of data[key] for key in keys, grouped by interpolation method.
+
+    Channels with the same interpolation method (with the default settings,
+    all channels of the image and the label) are resampled together by one
+    grid_sample call per slab, which computes the interpolation weights of
+    each output voxel once for all of them.
+
+    Returns:
+        Dictionary mapping each interpolation method to a pair: a (1,
+        channels, ...) float32 tensor of the channels, and a list of (key,
+        channel index, whether it is a label map, minimum value) tuples.
+    """
+    label_keys = transform.label_keys or []
+    groups = dict()
+    for key in keys:
+        is_label = key in label_keys
+        interpolation = transform.label_interpolation if is_label else transform.image_interpolation
+        for c, channel in enumerate(torch.as_tensor(data[key])):
+            groups.setdefault(interpolation, []).append(
+                (channel.float(), (key, c, is_label, channel.min().item())))
+    return {interpolation: (torch.stack([channel for channel, _ in group])[None],
+                            [info for _, info in group])
+            for interpolation, group in groups.items()}
+
+
+def _resample(channels, shape, coordinates, pad_value):
+    """
+    Resample grouped channels (see _channel_groups) at shared coordinates.
+
+    Args:
+        coordinates: Function giving the (3, slab...) input voxel coordinates
+            of the output voxels of the slab [start, stop) along the first axis.
+        pad_value: Function giving the value of points outside the volume, from
+            the key, the channel index, whether it is a label map and the
+            channel's minimum value.
+
+    Returns:
+        Dictionary mapping each key to its resampled float32 tensor.
+    """
+    outputs, pad_values = dict(), dict()
+    for interpolation, (_, infos) in channels.items():
+        pad_values[interpolation] = [float(pad_value(*info)) for info in infos]
+        for key, c, _, _ in infos:
+            outputs[key] = max(outputs.get(key, 0), c + 1)
+    outputs = {key: torch.empty((n,) + shape, dtype=torch.float32) for key, n in outputs.items()}
+    # grid_sample coordinates are normalized to [-1, 1], in reverse axis order
+    scales = [2 / (size - 1) if size > 1 else 0. for size in shape]
+    rows = max(1, SLAB_VOXELS // (shape[1] * shape[2]))
+    for start in range(0, shape[0], rows):
+        stop = min(start + rows, shape[0])
+        slab_coordinates = coordinates(start, stop)
+        grid = np.empty(slab_coordinates.shape[1:] + (3,), dtype=np.float32)
+        # as ITK: inside if within half a voxel of the volume, edge values are extended
+        outside = np.zeros(slab_coordinates.shape[1:], dtype=bool)
+        for axis, size in enumerate(shape):
+            grid[..., 2 - axis] = slab_coordinates[axis] * scales[axis] - (size > 1)
+            outside |= (slab_coordinates[axis] < -0.5) | (slab_coordinates[axis] >= size - 0.5)
+        grid = torch.from_numpy(grid)[None]
+        outside = torch.from_numpy(outside)
+        for interpolation, (inputs, infos) in channels.items():
+            resampled = torch.nn.functional.grid_sample(
+                inputs, grid, mode=GRID_SAMPLE_MODES[interpolation],
+                padding_mode='border', align_corners=True)[0]
+            for (key, c, _, _), value, channel in zip(infos, pad_values[interpolation],
+                                                      resampled):
+                channel[outside] = value
+                outputs[key][c, start:stop] = channel
+    return outputs
+
+
+def _reference_image(shape):
+    """Empty SimpleITK image with the geometry TorchIO gives to dictionary inputs."""
+    geometry = nib_to_sitk(np.zeros((1, 1, 1, 1), dtype=np.float32), np.eye(4), force_3d=True)
+    reference = sitk.Image([int(n) for n in shape], sitk.sitkUInt8)
+    reference.SetOrigin(geometry.GetOrigin())
+    reference.SetSpacing(geometry.GetSpacing())
+    reference.SetDirection(geometry.GetDirection())
+    return reference
+
+
+def _index_to_physical(reference):
+    """Matrix and origin mapping voxel indices of reference to physical points."""
+    direction = np.reshape(reference.GetDirection(), (3, 3))
+    return direction * np.array(reference.GetSpacing()), np.array(reference.GetOrigin())
+
+
+def _voxel_matrix(sitk_transform, reference):
+    """
+    3 x 4 matrix mapping output voxel indices to input voxel indices.
+
+    A resampling transform maps output physical points to input physical
+    points; for an affine transform the composition with the voxel to
+    physical mappings is affine, and is recovered from the images of the
+    origin and the unit vectors.
+    """
+    points = [(0., 0., 0.), (1., 0., 0.), (0., 1., 0.), (0., 0., 1.)]
+    images = np.array([reference.TransformPhysicalPointToContinuousIndex(
+        sitk_transform.TransformPoint(reference.TransformContinuousIndexToPhysicalPoint(p)))
+        for p in points])
+    return np.column_stack([(images[1:] - images[0]).T, images[0]])
+
+
+def _index_grid(shape, start, stop):
+    """Voxel indices (3, stop - start, shape[1], shape[2]) of a slab."""
+    x, y, z = np.arange(start, stop), np.arange(shape[1]), np.arange(shape[2])
+    grid = np.empty((3, stop - start) + tuple(shape[1:]))
+    grid[0] = x[:, None, None]
+    grid[1] = y[None, :, None]
+    grid[2] = z[None, None, :]
+    return grid
+
+
+def _bspline_weights(bspline, reference):
+    """
+    Cubic B-spline weights of the control points at the voxels of reference.
+
+    Returns:
+        List with one (voxels, control points) matrix per axis. The B-spline
+        grid is aligned with the axes of the image (see ITK's
+        BSplineTransformInitializer), so the weights are separable.
+    """
+    grid = bspline.GetCoefficientImages()[0]
+    matrix, origin = _index_to_physical(reference)
+    grid_matrix, grid_origin = _index_to_physical(grid)
+    scale = np.linalg.solve(grid_matrix, matrix)   # voxel index to grid index
+    assert np.allclose(scale, np.diag(np.diag(scale))), \
+        "The B-spline grid should be aligned with the axes of the image."
+    scale = np.diag(scale)
+    offset = np.linalg.solve(grid_matrix, origin - grid_origin)   # grid index of voxel 0
+    weights = []
+    for axis, (size, num_points) in enumerate(zip(reference.GetSize(), grid.GetSize())):
+        u = offset[axis] + scale[axis] * np.arange(size)
+        # support of each voxel: 4 control points from floor(u) - 1 (as ITK)
+        first = np.clip(np.floor(u).astype(int) - 1, 0, num_points - 4)
+        axis_weights = np.zeros((size, num_points))
+        for m in range(4):
+            axis_weights[np.arange(size), first + m] = _cubic_bspline(u - (first + m))
+        weights.append(axis_weights)
+    return weights
+
+
+def _cubic_bspline(x):
+    x = np.abs(x)
+    return np.where(x < 1, (4 - 6 * x ** 2 + 3 * x ** 3) / 6,
+                    np.where(x < 2, (2 - x) ** 3 / 6, 0.))
+
+
+def _bspline_coordinates(bspline, reference, weights):
+    """Function giving the sampling coordinates of a slab for a B-spline transform."""
+    shape = tuple(reference.GetSize())
+    matrix, _ = _index_to_physical(reference)
+    to_index = np.linalg.inv(matrix)   # physical displacement to voxel displacement
+    weights_x, weights_y, weights_z = weights
+    partial = []   # displacement components contracted along the last two axes
+    for image in bspline.GetCoefficientImages():
+        values = sitk.GetArrayFromImage(image).transpose()   # ITK to NumPy
+        values = np.tensordot(values, weights_z, axes=([2], [1]))
+        partial.append(np.tensordot(values, weights_y, axes=([1], [1])).transpose(0, 2, 1))
+
+    def coordinates(start, stop):
+        displacement = np.stack([np.tensordot(weights_x[start:stop], values, axes=1)
+                                 for values in partial])
+        return _index_grid(shape, start, stop) + np.tensordot(to_index, displacement, axes=1)
+
+    return coordinates
@@ -13,4 +13,4 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from .misc import rgetattr, rsetattr
+from .misc import rgetattr, rsetattr, sample_seed
@@ -0,0 +1,335 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmark the generation of benchmarking samples on synthetic volumes.
+
+Each transform in the transform settings is timed at each severity level on
+synthetic NIfTI image/label pairs of several sizes, so no real data (or
+network access) is needed. Time is split into the stages DatasetGenerator
+goes through for each sample: load, pre_transforms, transform,
+post_transforms and write. Results are saved as JSON, together with the
+versions of the main dependencies and the git commit, and two result files
+(e.g., from two commits, or before and after a TorchIO/MONAI upgrade) can be
+compared:
+
+    python -m roodmri.utils.benchmark run results.json --sizes 64,64,48 128,128,96
+    python -m roodmri.utils.benchmark compare baseline.json results.json
+
+Each transform is benchmarked at each size in a new process, so the peak
+resident memory (RSS) recorded for it is not inflated by previous runs.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+STAGES = ['load', 'pre_transforms', 'transform', 'post_transforms', 'write']
+DEFAULT_SIZES = [(64, 64, 48), (128, 128, 96), (192, 192, 144)]
+
+
+def synthetic_subject(shape, path, seed = 0):
+    """
+    Write a synthetic image/label pair as NIfTI files.
+
+    The label is an ellipsoid in the middle of the volume, and the image is
+    smooth random "tissue" with a brighter ellipsoid and noise, so that
+    intensity, spatial and k-space transforms do representative work.
+
+    Args:
+        shape: Sequence of 3 integers with the size of the volume.
+        path: Directory where image.nii.gz and label.nii.gz are written.
+        seed (optional): Integer random seed. Default is 0.
+
+    Returns:
+        Dictionary with the paths to the 'image' and 'label' files, as in the
+        input_files of DatasetGenerator.
+    """
+    rng = np.random.default_rng(seed)
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+    label = (sum((x / r) ** 2 for x, r in zip(grid, (0.4, 0.3, 0.35))) <= 1).astype(np.uint8)
+    head = sum(x ** 2 for x in grid) <= 0.8
+    tissue = ndimage.gaussian_filter(rng.standard_normal(shape), sigma=max(shape) / 32)
+    image = (head * (100 + 400 * tissue) + 200 * label
+             + 10 * rng.standard_normal(shape)).astype(np.float32)
+    affine = np.diag([1.0, 1.0, 1.0, 1.0])
+    files = {'image': str(path / 'image.nii.gz'), 'label': str(path / 'label.nii.gz')}
+    nib.save(nib.Nifti1Image(image, affine), files['image'])
+    nib.save(nib.Nifti1Image(label, affine), files['label'])
+    return files
+
+
+def benchmark_generation(
+    sizes = None,
+    transform_settings = None,
+    repeats = 1,
+    seed = 0,
+    output_format = 'nii.gz',
+    json_path = None
+):
+    """
+    Time each transform/severity level on synthetic volumes of several sizes.
+
+    Args:
+        sizes (optional): Sequence of volume shapes (3 integers each). If None,
+            DEFAULT_SIZES. Default is None.
+        transform_settings (optional): Dictionary of transform settings, as
+            for DatasetGenerator. If None, the defaults in
+            roodmri/transforms/defaults.py are used. Transform settings are
+            sent to worker processes, so they should be picklable. Default is
+            None.
+        repeats (optional): Number of times each sample is timed; the median
+            time of each stage is reported. Default is 1.
+        seed (optional): Integer seed for the synthetic data and the
+            transforms. Default is 0.
+        output_format (optional): Output format of the write stage (see
+            DatasetGenerator). Default is 'nii.gz'.
+        json_path (optional): Path of a JSON file the results are saved to.
+            Default is None.
+
+    Returns:
+        Dictionary with the 'environment' (package versions, git commit,
+        platform), the 'settings' of the run and the 'results': one entry per
+        size and transform with the peak RSS (and the RSS before loading data)
+        in MB, the time of the batched implementation of the transform for all
+        severity levels if there is one, and the time in seconds of each stage
+        for each severity level.
+    """
+    if sizes is None:
+        sizes = DEFAULT_SIZES
+    assert isinstance(repeats, int) and repeats > 0, "repeats should be a positive integer."
+    if transform_settings is None:
+        from roodmri.transforms.defaults import DEFAULT_TRANSFORM_SETTINGS
+        transform_settings = DEFAULT_TRANSFORM_SETTINGS
+    results = []
+    context = multiprocessing.get_context('spawn')   # fresh process: clean peak RSS
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            size = tuple(int(n) for n in size)
+            input_file = synthetic_subject(size, Path(tmp_dir) / 'x'.join(map(str, size)),
+                                           seed)
+            for transform_name, settings in transform_settings.items():
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(_benchmark_transform, input_file,
+                                             transform_name, settings, repeats, seed,
+                                             output_format, tmp_dir).result()
+                results.append({'size': list(size), 'transform': transform_name, **result})
+                print(f"{'x'.join(map(str, size))} {transform_name}: "
+                      f"{sum(sum(s[stage] for stage in STAGES) for s in result['severities']):.3f}"
+                      f" seconds, peak RSS {result['peak_rss_mb']:.0f} MB")
+    report = {
+        'environment': environment(),
+        'settings': {'repeats': repeats, 'seed': seed, 'output_format': output_format},
+        'results': results
+    }
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def compare_results(baseline, current, tolerance = 0.2, min_seconds = 0.01):
+    """
+    Compare two benchmark reports.
+
+    Args:
+        baseline: Report (or path to a JSON report) from benchmark_generation.
+        current: Report (or path to a JSON report) to compare to baseline.
+        tolerance (optional): Relative increase above which a time or peak
+            RSS is reported as a regression. Default is 0.2.
+        min_seconds (optional): Stage times below this value in both reports
+            are ignored, as they are dominated by noise. Default is 0.01.
+
+    Returns:
+        List of dictionaries (size, transform, severity, measure, baseline,
+        current, ratio), one per measure present in both reports, sorted by
+        decreasing ratio. Entries with ratio > 1 + tolerance are regressions.
+    """
+    baseline, current = [_load_report(report) for report in (baseline, current)]
+    current_results = {(tuple(r['size']), r['transform']): r for r in current['results']}
+    rows = []
+
+    def add(result, severity, measure, old, new):
+        if old is None or new is None or max(old, new) < min_seconds:
+            return
+        rows.append({'size': result['size'], 'transform': result['transform'],
+                     'severity': severity, 'measure': measure, 'baseline': old,
+                     'current': new, 'ratio': new / old if old > 0 else float('inf')})
+
+    for result in baseline['results']:
+        other = current_results.get((tuple(result['size']), result['transform']))
+        if other is None:
+            continue
+        add(result, None, 'peak_rss_mb', result['peak_rss_mb'], other['peak_rss_mb'])
+        add(result, None, 'batched_transform', result['batched_transform'],
+            other['batched_transform'])
+        other_severities = {s['severity']: s for s in other['severities']}
+        for stages in result['severities']:
+            if stages['severity'] not in other_severities:
+                continue
+            for stage in STAGES:
+                add(result, stages['severity'], stage, stages[stage],
+                    other_severities[stages['severity']][stage])
+    rows.sort(key=lambda row: row['ratio'], reverse=True)
+    for row in rows:
+        row['regression'] = row['ratio'] > 1 + tolerance
+    return rows
+
+
+def environment():
+    """Versions of Python and the main dependencies, git commit and platform."""
+    import monai
+    import torch
+    import torchio
+    versions = {'python': platform.python_version(), 'numpy': np.__version__,
+                'torch': torch.__version__, 'monai': monai.__version__,
+                'torchio': torchio.__version__, 'nibabel': nib.__version__}
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                                text=True, cwd=Path(__file__).parent,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'versions': versions, 'git_commit': commit, 'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+
+def _benchmark_transform(input_file, transform_name, settings, repeats, seed,
+                         output_format, tmp_dir):
+    """Time each stage of each severity level of one transform (run in a new process)."""
+    import monai.transforms as tf
+    from roodmri.data.generator import (BASE_TRANSFORMS, _batched_transform,
+                                        _configure_transform, _num_severities,
+                                        _set_random_state)
+    from roodmri.data.writers import get_writer
+    from roodmri.utils.misc import sample_seed
+    baseline_rss = _peak_rss_mb()
+    writer = get_writer(output_format)
+    out_path = Path(tempfile.mkdtemp(dir=tmp_dir))
+    severities = []
+    for i in range(_num_severities(settings)):
+        transform = _configure_transform(settings, i)
+        times = {stage: [] for stage in STAGES}
+        for _ in range(repeats):
+            _set_random_state(tf.Compose(settings['pre_transforms'] + [transform]
+                                         + settings['post_transforms']),
+                              sample_seed(seed, transform_name, i + 1, '000001'))
+            start = time.perf_counter()
+            data = tf.Compose(BASE_TRANSFORMS)(input_file)
+            affine = data['image_meta_dict']['affine']
+            times['load'].append(time.perf_counter() - start)
+            for stage, stage_transform in [
+                    ('pre_transforms', tf.Compose(settings['pre_transforms'])),
+                    ('transform', transform),
+                    ('post_transforms', tf.Compose(settings['post_transforms']))]:
+                start = time.perf_counter()
+                data = stage_transform(data)
+                times[stage].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            for key in ['image', 'label']:
+                writer.write(data[key], writer.sample_path(out_path, transform_name, i + 1,
+                                                           '000001', key), affine)
+            times['write'].append(time.perf_counter() - start)
+        severities.append({'severity': i + 1,
+                           **{stage: float(np.median(t)) for stage, t in times.items()}})
+    batched_time = None
+    batched = _batched_transform(settings)
+    if batched is not None:
+        transforms = [_configure_transform(settings, i)
+                      for i in range(_num_severities(settings))]
+        seeds = [sample_seed(seed, transform_name, i + 1, '000001')
+                 for i in range(len(transforms))]
+        loaded = tf.Compose(settings['pre_transforms'])(tf.Compose(BASE_TRANSFORMS)(input_file))
+        batched_times = []
+        for _ in range(repeats):
+            data = deepcopy(loaded)
+            start = time.perf_counter()
+            batched(transforms, data, seeds)
+            batched_times.append(time.perf_counter() - start)
+        batched_time = float(np.median(batched_times))
+    return {'baseline_rss_mb': baseline_rss, 'peak_rss_mb': _peak_rss_mb(),
+            'batched_transform': batched_time, 'severities': severities}
+
+
+def _peak_rss_mb():
+    """Peak resident memory of the current process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10   # bytes on macOS
+
+
+def _load_report(report):
+    if isinstance(report, (str, Path)):
+        with open(report) as f:
+            return json.load(f)
+    return report
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='run the benchmark')
+    run_parser.add_argument('json_path', help='JSON file to save results to')
+    run_parser.add_argument('--sizes', nargs='+', default=None,
+                            help='volume sizes, e.g. 64,64,48 128,128,96')
+    run_parser.add_argument('--transforms', nargs='+', default=None,
+                            help='names of default transforms to benchmark (default: all)')
+    run_parser.add_argument('--repeats', type=int, default=1)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output-format', default='nii.gz')
+    compare_parser = subparsers.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(args)
+    if args.command == 'run':
+        transform_settings = None
+        if args.transforms is not None:
+            from roodmri.transforms.defaults import DEFAULT_TRANSFORM_SETTINGS
+            transform_settings = {name: DEFAULT_TRANSFORM_SETTINGS[name]
+                                  for name in args.transforms}
+        sizes = None
+        if args.sizes is not None:
+            sizes = [tuple(int(n) for n in size.split(',')) for size in args.sizes]
+        benchmark_generation(sizes, transform_settings, args.repeats, args.seed,
+                             args.output_format, args.json_path)
+        return 0
+    rows = compare_results(args.baseline, args.current, args.tolerance)
+    for row in rows:
+        print(f"{'REGRESSION ' if row['regression'] else ''}"
+              f"{'x'.join(map(str, row['size']))} {row['transform']}"
+              f"{'' if row['severity'] is None else '_' + str(row['severity'])} "
+              f"{row['measure']}: {row['baseline']:.4f} -> {row['current']:.4f} "
+              f"({row['ratio']:.2f}x)")
+    return int(any(row['regression'] for row in rows))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,6 +14,8 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import functools
+import hashlib
+import importlib
 
 # for setting deep attributes (attribute of an attribute)
 # solution obtained from https://stackoverflow.com/questions/31174295/getattr-and-setattr-on-nested-subobjects-chained-properties
@@ -24,4 +26,43 @@ def rsetattr(obj, attr, val):
 def rgetattr(obj, attr, *args):
     def _getattr(obj, attr):
         return getattr(obj, attr, *args)
-    return functools.reduce(_getattr, [obj] + attr.split('.'))
\ No newline at end of file
+    return functools.reduce(_getattr, [obj] + attr.split('.'))
+
+def sample_seed(seed, transform_name, severity, subject_id):
+    """
+    Derive the random seed for one benchmarking sample.
+
+    The seed depends only on the global seed, the transform name, the
+    severity level and the subject ID, so a sample is generated identically
+    regardless of the order (or the machine) in which samples are generated.
+    """
+    key = f'{seed}/{transform_name}/{severity}/{subject_id}'.encode()
+    return int.from_bytes(hashlib.sha256(key).digest()[:4], 'little')
+
+def lazy_attributes(package, attributes):
+    """
+    Module-level __getattr__ and __dir__ (PEP 562) importing names on first use.
+
+    Args:
+        package: __name__ of the package.
+        attributes: Dictionary mapping public names to the (relative) module
+            they are defined in, e.g., {'calculate_metrics': '.calculate'}.
+
+    Returns:
+        Tuple (__getattr__, __dir__) to assign in the package's __init__.py,
+        so that a submodule (and its dependencies, e.g., torch) is only
+        imported when one of its names is first accessed.
+    """
+    namespace = vars(importlib.import_module(package))
+
+    def __getattr__(name):
+        if name not in attributes:
+            raise AttributeError(f"module {package!r} has no attribute {name!r}")
+        value = getattr(importlib.import_module(attributes[name], package), name)
+        namespace[name] = value   # later lookups do not go through __getattr__
+        return value
+
+    def __dir__():
+        return sorted(set(namespace) | set(attributes))
+
+    return __getattr__, __dir__
@@ -0,0 +1,37 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def input_files(tmp_path):
+    """Two small synthetic subjects (random image, box-shaped label)."""
+    rng = np.random.default_rng(0)
+    affine = np.diag([1.2, 1., 1.5, 1.])
+    input_files = []
+    for i in range(2):
+        image = (rng.random((16, 18, 12)) * 100).astype(np.float32)
+        label = np.zeros((16, 18, 12), dtype=np.float32)
+        label[4 + i:11, 5:13, 3:9 - i] = 1
+        paths = {'image': str(tmp_path / f'image{i}.nii.gz'),
+                 'label': str(tmp_path / f'label{i}.nii.gz')}
+        nib.save(nib.Nifti1Image(image, affine), paths['image'])
+        nib.save(nib.Nifti1Image(label, affine), paths['label'])
+        input_files.append(paths)
+    return input_files
+
@@ -0,0 +1,103 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from copy import deepcopy
+
+import monai.transforms as tf
+import numpy as np
+import pytest
+import torch
+import torchio as tio
+
+from roodmri.data.generator import _configure_transform, _set_random_state
+from roodmri.transforms.batched import get_batched_transform
+from roodmri.transforms.defaults import DEFAULT_TRANSFORM_SETTINGS
+
+BATCHED_DEFAULTS = [name for name, settings in DEFAULT_TRANSFORM_SETTINGS.items()
+                    if get_batched_transform(settings['transform']) is not None]
+
+
+def synthetic_sample():
+    """Two-channel image (noise and a smooth gradient) with a box-shaped label."""
+    rng = np.random.default_rng(1)
+    shape = (16, 18, 12)
+    gradient = np.add.outer(np.add.outer(np.arange(16), np.arange(18)), np.arange(12))
+    image = np.stack([rng.random(shape) * 100, gradient * 2.]).astype(np.float32)
+    label = np.zeros((1,) + shape, dtype=np.float32)
+    label[0, 4:11, 5:13, 3:9] = 1
+    return {'image': image, 'label': label}
+
+
+def apply_both(transforms, pre_transforms = ()):
+    """Outputs of the batched implementation and of each transform applied alone."""
+    data = tf.Compose(list(pre_transforms))(synthetic_sample())
+    seeds = [101 * (k + 1) for k in range(len(transforms))]
+    expected = []
+    for transform, seed in zip(deepcopy(transforms), seeds):
+        _set_random_state(tf.Compose([transform]), seed)
+        expected.append(transform(deepcopy(data)))
+    transforms = deepcopy(transforms)
+    for transform, seed in zip(transforms, seeds):
+        _set_random_state(tf.Compose([transform]), seed)
+    batched = get_batched_transform(transforms[0])
+    return batched(transforms, deepcopy(data), seeds), expected
+
+
+def assert_close(outputs, expected):
+    assert len(outputs) == len(expected)
+    for output, reference in zip(outputs, expected):
+        for key in ['image', 'label']:
+            a, b = np.asarray(output[key]), np.asarray(reference[key])
+            assert a.shape == b.shape and a.dtype == b.dtype, key
+            np.testing.assert_allclose(a, b, rtol=0, atol=1e-5 * max(np.ptp(b), 1),
+                                       err_msg=key)
+
+
+@pytest.mark.parametrize('transform_name', BATCHED_DEFAULTS)
+def test_default_transforms(transform_name):
+    settings = DEFAULT_TRANSFORM_SETTINGS[transform_name]
+    transforms = [_configure_transform(settings, i) for i in range(5)]
+    assert_close(*apply_both(transforms, settings['pre_transforms']))
+
+
+
+@pytest.mark.parametrize('transform_name', ['Ghosting', 'RandomMotion'])
+def test_kspace_transforms_unseeded(transform_name):
+    # without seeds, parameters are drawn from torch's global generator in
+    # the same order as the unbatched transforms
+    settings = DEFAULT_TRANSFORM_SETTINGS[transform_name]
+    transforms = [_configure_transform(settings, i) for i in range(5)]
+    data = tf.Compose(settings['pre_transforms'])(synthetic_sample())
+    torch.manual_seed(5)
+    expected = [transform(deepcopy(data)) for transform in deepcopy(transforms)]
+    torch.manual_seed(5)
+    outputs = get_batched_transform(transforms[0])(transforms, deepcopy(data), None)
+    assert_close(outputs, expected)
+
+
+@pytest.mark.parametrize('transform', [
+    tio.transforms.RandomAffine(include=['image', 'label'], label_keys=['label'],
+                                scales=(0.8, 1.2), degrees=20, translation=5,
+                                default_pad_value='otsu'),
+    tio.transforms.RandomElasticDeformation(include=['image', 'label'], label_keys=['label'],
+                                            num_control_points=(5, 6, 7),
+                                            max_displacement=(3, 5, 4))
+], ids=['affine', 'elastic'])
+def test_spatial_transforms_with_labels(transform):
+    outputs, expected = apply_both([deepcopy(transform) for _ in range(3)],
+                                   [tf.ToTensord(keys=['image', 'label'])])
+    assert_close(outputs, expected)
+    for output in outputs:   # nearest neighbour interpolation of labels
+        assert set(np.unique(np.asarray(output['label']))) <= {0, 1}
@@ -0,0 +1,231 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from copy import deepcopy
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from roodmri.data import DatasetGenerator, SampleIndex
+from roodmri.metrics.evaluate import benchmark_samples
+from roodmri.transforms.defaults import DEFAULT_TRANSFORM_SETTINGS
+from tests.utils import assert_same_dataset, generate, read_dataset
+
+
+def test_resume(input_files, tmp_path):
+    out_path = tmp_path / 'out'
+    generate(input_files, out_path)
+    paths = sorted(out_path.glob('*/*/*.nii.gz'))
+    mtimes = [path.stat().st_mtime_ns for path in paths]
+    generate(input_files, out_path)   # complete: nothing is written again
+    assert [path.stat().st_mtime_ns for path in paths] == mtimes
+    paths[0].unlink()   # only this sample is written again
+    generate(input_files, out_path)
+    assert paths[0].exists()
+    assert all(path.stat().st_mtime_ns == mtime for path, mtime in zip(paths, mtimes)
+               if path.parent != paths[0].parent)
+
+
+def test_resume_rewrites_corrupted(input_files, tmp_path):
+    out_path = tmp_path / 'out'
+    dataset = generate(input_files, out_path)
+    path = next(out_path.glob('Ghosting_2/*/*_image.nii.gz'))
+    contents = path.read_bytes()   # corrupted without changing size
+    path.write_bytes(contents[:100] + bytes(255 - b for b in contents[100:]))
+    assert_same_dataset(dataset, generate(input_files, out_path))
+
+
+def test_resume_verify_checksum(input_files, tmp_path):
+    out_path = tmp_path / 'out'
+    dataset = generate(input_files, out_path)
+    path = next(out_path.glob('Ghosting_2/*/*_image.nii.gz'))
+    stat = path.stat()
+    contents = path.read_bytes()
+    corrupted = contents[:100] + bytes(255 - b for b in contents[100:])
+    path.write_bytes(corrupted)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    # same size and modification time: only found by checksums
+    DatasetGenerator(input_files, str(out_path), seed=3).generate_dataset()
+    assert path.read_bytes() == corrupted
+    assert_same_dataset(dataset, generate(input_files, out_path, verify='checksum'))
+
+
+def test_resume_rewrites_shared_labels(input_files, tmp_path):
+    out_path = tmp_path / 'out'
+    dataset = generate(input_files, out_path)
+    image = next(out_path.glob('Ghosting_2/000001/*_image.nii.gz'))
+    image.unlink()
+    for path in out_path.glob('.labels/000001_*'):   # replaced, not changed in place
+        contents = path.read_bytes()
+        path.unlink()
+        path.write_bytes(contents[:100] + bytes(255 - b for b in contents[100:]))
+    label = str(image.relative_to(out_path)).split('.nii')[0][:-len('image')] + 'label'
+    assert_same_dataset({label: dataset[label]}, {label: generate(input_files, out_path)[label]})
+
+
+def test_shared_labels_written_once(input_files, tmp_path):
+    out_path = tmp_path / 'out'
+    generator = DatasetGenerator(input_files, str(out_path), seed=3, num_workers=2)
+    generator.generate_dataset()
+    num_preserving = sum(generator._label_preserving.values())
+    labels = sorted(out_path.glob('.labels/*'))
+    assert len(labels) == len(input_files)
+    # one file per subject, linked by each of its label-preserving samples
+    assert all(path.stat().st_nlink == 1 + 5 * num_preserving for path in labels)
+    mtimes = [path.stat().st_mtime_ns for path in labels]
+    for path in out_path.glob('Ghosting_2/*/*_image.nii.gz'):
+        path.unlink()
+    generate(input_files, out_path, num_workers=2)   # intact: linked, not written again
+    assert [path.stat().st_mtime_ns for path in labels] == mtimes
+    assert all(path.stat().st_nlink == 1 + 5 * num_preserving for path in labels)
+
+
+def test_resume_disabled_overwrites(input_files, tmp_path):
+    out_path = tmp_path / 'out'
+    generate(input_files, out_path)
+    path = next(out_path.rglob('*_image.nii.gz'))
+    mtime = path.stat().st_mtime_ns
+    generate(input_files, out_path, resume=False)
+    assert path.stat().st_mtime_ns != mtime
+
+
+def test_units_group_severities(input_files, tmp_path):
+    generator = DatasetGenerator(input_files, str(tmp_path / 'out'), seed=3)
+    units = generator._get_units()
+    assert len(units) == 2 * len(DEFAULT_TRANSFORM_SETTINGS)
+    assert all(tasks == [(tasks[0][0], i) for i in range(5)] for _, tasks in units)
+    generator.generate_dataset()
+    next((tmp_path / 'out').glob('Ghosting_3/*/*_image.nii.gz')).unlink()
+    units = DatasetGenerator(input_files, str(tmp_path / 'out'), seed=3)._get_units()
+    assert [tasks for _, tasks in units] == [[('Ghosting', 2)]]
+
+
+def test_seed_reproducible(input_files, tmp_path):
+    dataset = generate(input_files, tmp_path / 'a')
+    images = [path for path in dataset if path.endswith('_image')]
+    assert len(images) == 2 * 5 * len(DEFAULT_TRANSFORM_SETTINGS)
+    assert_same_dataset(dataset, generate(input_files, tmp_path / 'b'))
+    other = generate(input_files, tmp_path / 'c', seed=4)
+    assert any(not np.array_equal(data, other[path][0])
+               for path, (data, _) in dataset.items())
+
+
+def test_shards_match_unsharded(input_files, tmp_path):
+    dataset = generate(input_files, tmp_path / 'full')
+    out_path = tmp_path / 'sharded'
+    for shard_index in range(3):
+        generate(input_files, out_path, shard_index=shard_index, num_shards=3)
+    assert_same_dataset(dataset, read_dataset(out_path))
+    # one manifest per shard with samples, no index, a shared label per subject
+    assert sorted(path.name for path in out_path.iterdir() if path.is_file()) == [
+        'manifest.0.jsonl', 'manifest.1.jsonl']
+    assert len(list((out_path / '.labels').iterdir())) == 2
+    assert not list(out_path.glob('*/*/.*'))   # no temporary files left
+    assert len(SampleIndex.load(out_path)) == len(SampleIndex.load(tmp_path / 'full'))
+    paths = sorted(out_path.glob('*/*/*.nii.gz'))
+    mtimes = [path.stat().st_mtime_ns for path in paths]
+    generate(input_files, out_path, shard_index=1, num_shards=3)
+    generate(input_files, out_path)   # the manifests of all shards are read
+    assert [path.stat().st_mtime_ns for path in paths] == mtimes
+    assert (out_path / 'index.parquet').exists()
+
+
+def test_load_once_and_workers_match(input_files, tmp_path):
+    dataset = generate(input_files, tmp_path / 'a')
+    assert_same_dataset(dataset, generate(input_files, tmp_path / 'b', load_once=True))
+    assert_same_dataset(dataset, generate(input_files, tmp_path / 'c', num_workers=2))
+
+
+def test_background_writer_matches(input_files, tmp_path):
+    dataset = generate(input_files, tmp_path / 'a')
+    assert_same_dataset(dataset, generate(input_files, tmp_path / 'b', write_workers=2))
+    other = generate(input_files, tmp_path / 'c', load_once=True, write_workers=1,
+                     max_pending_writes=1)
+    assert_same_dataset(dataset, other)
+
+
+def test_batched_transforms_match_unbatched(input_files, tmp_path):
+    dataset = generate(input_files, tmp_path / 'batched')
+    transform_settings = deepcopy(DEFAULT_TRANSFORM_SETTINGS)
+    for settings in transform_settings.values():
+        settings['batched_transform'] = None
+    unbatched = generate(input_files, tmp_path / 'unbatched',
+                         transform_settings=transform_settings)
+    assert dataset.keys() == unbatched.keys()
+    for path, (data, affine) in dataset.items():
+        expected = unbatched[path][0]
+        np.testing.assert_allclose(affine, unbatched[path][1], err_msg=path)
+        atol = 1e-5 * max(np.ptp(expected), 1)
+        np.testing.assert_allclose(data, expected, rtol=0, atol=atol, err_msg=path)
+
+
+def multi_modality_files(input_files, tmp_path):
+    """The input files with a second modality (a smooth gradient) next to the image."""
+    items = []
+    for i, item in enumerate(input_files):
+        nifti = nib.load(item['image'])
+        gradient = np.add.outer(np.add.outer(np.arange(16), np.arange(18)), np.arange(12))
+        path = str(tmp_path / f'flair{i}.nii.gz')
+        nib.save(nib.Nifti1Image((gradient * 2. + i).astype(np.float32), nifti.affine), path)
+        items.append({'t1': item['image'], 'flair': path, 'label': item['label']})
+    return items
+
+
+def test_multi_modality(input_files, tmp_path):
+    dataset = generate(multi_modality_files(input_files, tmp_path), tmp_path / 'multi')
+    single = generate(input_files, tmp_path / 'single')
+    labels = {path: value for path, value in single.items()
+              if path.endswith('_label') and not path.startswith('.labels')}
+    assert {path for path in dataset if path.endswith('_label')
+            and not path.startswith('.labels')} == labels.keys()
+    assert_same_dataset({path: dataset[path] for path in labels}, labels)
+    for path, (data, affine) in single.items():
+        if path.endswith('_image'):
+            t1, t1_affine = dataset[path[:-len('image')] + 't1']
+            assert dataset[path[:-len('image')] + 'flair'][0].shape == t1.shape
+            np.testing.assert_allclose(t1_affine, affine, err_msg=path)
+            np.testing.assert_array_equal(t1, data, err_msg=path)
+    index = SampleIndex.load(tmp_path / 'multi')
+    assert set(index.df['modality']) == {'t1', 'flair'}
+    assert len(index) == 2 * len(labels)   # one row per modality
+    for samples in benchmark_samples(tmp_path / 'multi').values():
+        for transform_name, _, image_paths, _ in samples:
+            if transform_name != 'Clean':
+                assert [path.name.split('.')[0].rsplit('_', 1)[1]
+                        for path in image_paths] == ['t1', 'flair']
+
+
+@pytest.mark.parametrize('batched', [True, False])
+def test_multi_modality_matches_single_modality(input_files, tmp_path, batched):
+    transform_settings = deepcopy(DEFAULT_TRANSFORM_SETTINGS)
+    if not batched:
+        for settings in transform_settings.values():
+            settings['batched_transform'] = None
+    items = multi_modality_files(input_files, tmp_path)
+    dataset = generate(items, tmp_path / 'multi', transform_settings=transform_settings)
+    for modality in ['t1', 'flair']:
+        single = generate([{'image': item[modality], 'label': item['label']} for item in items],
+                          tmp_path / modality, transform_settings=transform_settings)
+        images = [path for path in single if path.endswith('_image')]
+        assert {path[:-len('image')] for path in images} == {
+            path[:-len(modality)] for path in dataset if path.endswith(f'_{modality}')}
+        for path in images:
+            data, affine = dataset[path[:-len('image')] + modality]
+            expected = single[path][0]
+            np.testing.assert_allclose(affine, single[path][1], err_msg=path)
+            atol = 1e-5 * max(np.ptp(expected), 1)
+            np.testing.assert_allclose(data, expected, rtol=0, atol=atol, err_msg=path)
@@ -0,0 +1,90 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+
+import pandas as pd
+import pytest
+
+from roodmri.data import SampleIndex
+from roodmri.metrics.evaluate import benchmark_samples
+from tests.utils import generate
+
+
+@pytest.fixture
+def dataset(input_files, tmp_path):
+    """Out path of a dataset generated from the input_files fixture."""
+    out_path = tmp_path / 'out'
+    generate(input_files, out_path)
+    return out_path
+
+
+def sha1(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def test_index_lists_every_sample(dataset):
+    index = SampleIndex.load(dataset)
+    assert (dataset / 'index.parquet').exists()
+    assert len(index) == len(list(dataset.glob('*/*/*_image.nii.gz')))
+    for row in index.df.itertuples(index=False):
+        image_path, label_path = index.paths(row.subject_id, row.transform, row.severity)
+        assert image_path == dataset / row.image_path
+        assert label_path == dataset / row.label_path
+        assert image_path.stat().st_size == row.image_size
+        assert sha1(image_path) == row.image_sha1
+        assert sha1(label_path) == row.label_sha1
+        assert row.shape == '16x18x12' or row.transform in ('Affine', 'ElasticDeformation')
+    assert sorted(index.image_paths()) == sorted(dataset.glob('*/*/*_image.nii.gz'))
+
+
+def test_index_select(dataset):
+    index = SampleIndex.load(dataset)
+    subject_id = index.df['subject_id'].iloc[0]
+    selected = index.select("transform == 'Ghosting' and severity >= 3 "
+                            "and subject_id in @subjects", subjects=[subject_id])
+    assert sorted(selected.df['severity']) == [3, 4, 5]
+    assert set(selected.df['subject_id']) == {subject_id}
+    assert all(path.parent.parent.name in ('Ghosting_3', 'Ghosting_4', 'Ghosting_5')
+               for path in selected.label_paths())
+    assert len(index.select('severity > 5')) == 0
+
+
+def test_index_csv_and_manifest_fallback(dataset):
+    df = SampleIndex.load(dataset).df
+    SampleIndex(df, dataset).save(dataset / 'index.csv')
+    (dataset / 'index.parquet').unlink()
+    pd.testing.assert_frame_equal(SampleIndex.load(dataset).df, df)
+    (dataset / 'index.csv').unlink()
+    pd.testing.assert_frame_equal(SampleIndex.load(dataset).df, df)
+    assert not (dataset / 'index.csv').exists()
+
+
+def test_benchmark_samples_query(dataset):
+    samples = benchmark_samples(dataset)
+    assert len(samples) == 2
+    for subject_id, subject_samples in samples.items():
+        assert len(subject_samples) == len(SampleIndex.load(dataset).select(
+            'subject_id == @subject_id', subject_id=subject_id)) + 1
+        assert ('Clean', 0) in [sample[:2] for sample in subject_samples]
+    subject_id = sorted(samples)[0]
+    selected = benchmark_samples(dataset, query="transform == 'Ghosting' and severity <= 2 "
+                                                "and subject_id == @subject_id",
+                                 query_vars={'subject_id': subject_id})
+    assert list(selected) == [subject_id]
+    assert [sample[:2] for sample in selected[subject_id]] == [('Ghosting', 1), ('Ghosting', 2)]
+    assert selected[subject_id] == [sample for sample in samples[subject_id]
+                                    if sample[:2] in (('Ghosting', 1), ('Ghosting', 2))]
@@ -0,0 +1,137 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import ndimage
+import torch
+
+from roodmri.metrics import (RunningStats, bootstrap_metrics, calculate_metrics,
+                             calculate_metrics_streaming, segmentation_metrics)
+
+METRIC_ARGS = {'transform_col': 'Transform', 'severity_col': 'Severity',
+               'metric_cols': {'DSC': True, 'HD95': False}, 'clean_label': 'Clean',
+               'grouping_cols': ['Model', 'Task']}
+
+
+def random_mask(rng, shape = (20, 22, 16)):
+    """Smooth random blob."""
+    noise = ndimage.gaussian_filter(rng.random(shape), 2)
+    return noise > np.percentile(noise, 85)
+
+
+def one_hot(mask):
+    mask = torch.as_tensor(mask)
+    return torch.stack([~mask, mask]).unsqueeze(0).float()
+
+
+def results_table(seed = 0):
+    """Random per-sample results for 3 models x 2 tasks, with missing HD95 values."""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for model in ['a', 'b', 'c']:
+        for task in ['WMH', 'Hip']:
+            conditions = [('Clean', 0)] + [(transform, severity)
+                                           for transform in ['Affine', 'Noise']
+                                           for severity in range(1, 6)]
+            for transform, severity in conditions:
+                for subject in range(8):
+                    rows.append((model, task, transform, severity, f'{subject:06d}',
+                                 rng.random(), rng.random() * 10))
+    df = pd.DataFrame(rows, columns=['Model', 'Task', 'Transform', 'Severity',
+                                     'Subject_ID', 'DSC', 'HD95'])
+    df.loc[rng.random(len(df)) < 0.05, 'HD95'] = np.nan
+    return df.sample(frac=1, random_state=seed)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_segmentation_metrics_match_monai(seed):
+    from monai.metrics import (compute_average_surface_distance, compute_hausdorff_distance,
+                               compute_meandice)
+    rng = np.random.default_rng(seed)
+    pred, label = random_mask(rng), random_mask(rng)
+    values = segmentation_metrics(pred, label)
+    y_pred, y = one_hot(pred), one_hot(label)
+    assert values['DSC'] == pytest.approx(
+        compute_meandice(y_pred, y, include_background=False).item())
+    assert values['HD95'] == pytest.approx(
+        compute_hausdorff_distance(y_pred, y, percentile=95).item())
+    assert values['ASD'] == pytest.approx(
+        compute_average_surface_distance(y_pred, y, symmetric=True).item())
+    assert values['VD'] == np.count_nonzero(pred) - np.count_nonzero(label)
+
+
+def test_segmentation_metrics_empty_masks():
+    empty, mask = np.zeros((8, 8, 8), dtype=bool), np.zeros((8, 8, 8), dtype=bool)
+    mask[2:5, 2:5, 2:5] = True
+    assert segmentation_metrics(empty, empty) == {'DSC': 1.0, 'HD95': 0.0, 'ASD': 0.0, 'VD': 0}
+    values = segmentation_metrics(empty, mask, spacing=(1., 1., 2.))
+    assert values['DSC'] == 0.0 and np.isnan(values['HD95']) and np.isnan(values['ASD'])
+    assert values['VD'] == -54.0
+
+
+def test_streaming_matches_calculate_metrics(tmp_path):
+    df = results_table()
+    combined, combined_agg = calculate_metrics(df, **METRIC_ARGS)
+    path = tmp_path / 'results.csv'
+    df.to_csv(path, index=False)
+    shards = [RunningStats(['Model', 'Task', 'Transform', 'Severity'], ['DSC', 'HD95'])
+              .update(df.iloc[i::3]) for i in range(3)]
+    merged = shards[0].merge(shards[1]).merge(shards[2])
+    for data in [str(path), (df.iloc[i:i + 50] for i in range(0, len(df), 50)), merged]:
+        streamed, streamed_agg = calculate_metrics_streaming(data, chunksize=70, **METRIC_ARGS)
+        pd.testing.assert_frame_equal(streamed, combined, check_exact=False)
+        pd.testing.assert_frame_equal(streamed_agg, combined_agg, check_exact=False)
+
+
+def test_bootstrap_estimates_match_calculate_metrics():
+    df = results_table()
+    combined, combined_agg = calculate_metrics(df, **METRIC_ARGS)
+    combined_ci, combined_agg_ci = bootstrap_metrics(df, num_samples=200, seed=0,
+                                                     **METRIC_ARGS)
+    for ci, expected in [(combined_ci, combined), (combined_agg_ci, combined_agg)]:
+        estimate = ci.xs('estimate', axis=1, level=2)
+        mean = expected.xs('mean', axis=1, level=2).loc[estimate.index, estimate.columns]
+        np.testing.assert_allclose(estimate.values, mean.values, rtol=1e-12)
+        assert (ci.xs('lower', axis=1, level=2) <= estimate + 1e-12).all().all()
+        assert (ci.xs('upper', axis=1, level=2) >= estimate - 1e-12).all().all()
+
+
+def test_bootstrap_reproducible():
+    df = results_table()
+    combined_ci, combined_agg_ci = bootstrap_metrics(df, num_samples=100, seed=1,
+                                                     **METRIC_ARGS)
+    parallel = bootstrap_metrics(df, num_samples=100, seed=1, num_workers=2, **METRIC_ARGS)
+    pd.testing.assert_frame_equal(parallel[0], combined_ci)
+    pd.testing.assert_frame_equal(parallel[1], combined_agg_ci)
+    # each group draws from its own generator, whatever the other groups
+    subset = bootstrap_metrics(df[df['Model'] == 'b'], num_samples=100, seed=1,
+                               **METRIC_ARGS)[0]
+    pd.testing.assert_frame_equal(subset, combined_ci.loc[['b']])
+
+
+def test_cached_matches_calculate_metrics(tmp_path):
+    cache_path = str(tmp_path / 'metrics.pkl')
+    df = results_table()
+    changed = df.copy()
+    changed.loc[changed.index[0], 'DSC'] = 0.5
+    # first call, reuse of every group, a changed group, a new and a removed group
+    for data in [df[df['Model'] != 'c'], df, df.sample(frac=1, random_state=1),
+                 changed, changed[changed['Task'] != 'Hip']]:
+        expected = calculate_metrics(data, **METRIC_ARGS)
+        cached = calculate_metrics(data, cache_path=cache_path, **METRIC_ARGS)
+        pd.testing.assert_frame_equal(cached[0], expected[0])
+        pd.testing.assert_frame_equal(cached[1], expected[1])
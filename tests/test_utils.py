@@ -0,0 +1,102 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from roodmri.data.utils import is_file_list, scan_input_files
+
+
+def save_like(path, reference, shape = None, affine = None):
+    """Save a NIfTI file like reference, optionally with another shape or affine."""
+    nifti = nib.load(reference)
+    data = nifti.get_fdata()
+    if shape is not None:
+        data = data[tuple(slice(n) for n in shape)]
+    nib.save(nib.Nifti1Image(data.astype(np.float32),
+                             nifti.affine if affine is None else affine), path)
+    return str(path)
+
+
+def test_is_file_list_checks_every_item(input_files):
+    assert is_file_list(input_files)
+    # problems after the first item were missed when only it was checked
+    for item in [{'image': input_files[0]['image']},
+                 {'image': input_files[0]['image'], 'label': None},
+                 ['image', 'label']]:
+        with pytest.raises(AssertionError):
+            is_file_list(input_files + [item])
+
+
+def test_is_file_list_modalities(input_files):
+    items = [{'t1': item['image'], 'flair': item['image'], 'label': item['label']}
+             for item in input_files]
+    assert is_file_list(items)
+    for item in [{'t1': items[0]['t1'], 'label': items[0]['label']},
+                 {'t1': items[0]['t1'], 't2': items[0]['t1'], 'label': items[0]['label']},
+                 {'t1': items[0]['t1'], 'flair': items[0]['t1']}]:
+        with pytest.raises(AssertionError):
+            is_file_list(items + [item])
+
+
+def test_scan_input_files(input_files):
+    info = scan_input_files(input_files, mode='data')
+    assert info == [{'shape': (16, 18, 12), 'voxels': 16 * 18 * 12, 'dtype': 'float32'}] * 2
+
+
+def test_scan_input_files_reports_problems(input_files, tmp_path):
+    image, label = input_files[0]['image'], input_files[0]['label']
+    missing = str(tmp_path / 'missing.nii.gz')
+    cropped = save_like(tmp_path / 'cropped.nii.gz', image, shape=(16, 18, 10))
+    shifted = save_like(tmp_path / 'shifted.nii.gz', image, affine=np.diag([1., 1., 1., 1.]))
+    bad_files = [{'image': missing, 'label': label},
+                 {'image': cropped, 'label': label},
+                 {'image': shifted, 'label': label}]
+    with pytest.raises(AssertionError) as error:
+        scan_input_files(input_files + bad_files)
+    message = str(error.value)
+    assert message.startswith('3 problems')   # all reported at once
+    assert f'{missing}: file not found' in message
+    assert f'{cropped}: image shape (16, 18, 10) does not match label shape' in message
+    assert f'{shifted}: image and label affines do not match' in message
+
+
+def test_scan_input_files_data_mode(input_files, tmp_path):
+    truncated = tmp_path / 'truncated.nii.gz'
+    contents = open(input_files[0]['image'], 'rb').read()
+    truncated.write_bytes(contents[:len(contents) // 2])
+    bad_files = [{'image': str(truncated), 'label': input_files[0]['label']}]
+    scan_input_files(bad_files)   # the header is readable
+    with pytest.raises(AssertionError, match='unreadable'):
+        scan_input_files(bad_files, mode='data')
+
+
+def test_scan_input_files_modalities(input_files, tmp_path):
+    image, label = input_files[0]['image'], input_files[0]['label']
+    items = [{'t1': item['image'], 'flair': item['image'], 'label': item['label']}
+             for item in input_files]
+    assert scan_input_files(items) == [{'shape': (16, 18, 12), 'voxels': 2 * 16 * 18 * 12,
+                                        'dtype': 'float32'}] * 2
+    cropped = save_like(tmp_path / 'cropped.nii.gz', image, shape=(16, 18, 10))
+    shifted = save_like(tmp_path / 'shifted.nii.gz', image, affine=np.diag([1., 1., 1., 1.]))
+    bad_files = [{'t1': image, 'flair': cropped, 'label': label},
+                 {'t1': shifted, 'flair': image, 'label': label}]
+    with pytest.raises(AssertionError) as error:
+        scan_input_files(items + bad_files)
+    message = str(error.value)
+    assert message.startswith('2 problems')
+    assert f'{cropped}: image shape (16, 18, 10) does not match label shape' in message
+    assert f'{shifted}: image and label affines do not match' in message
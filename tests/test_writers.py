@@ -0,0 +1,113 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import nibabel as nib
+import numpy as np
+
+from roodmri.data.writers import ZarrWriter
+from tests.utils import assert_same_dataset, generate
+
+
+def read_zarr_dataset(out_path):
+    """Map each array of a zarr dataset to (data, affine), keyed like read_dataset."""
+    dataset = dict()
+    for path in sorted(out_path.glob('[!.]*.zarr/*/*')):
+        if not path.is_dir():
+            continue
+        name = path.parent.parent.name[:-len('.zarr')]
+        subject_id, key = path.parent.name, path.name
+        array, affine = ZarrWriter.read(path)
+        dataset[f'{name}/{subject_id}/{subject_id}_{name}_{key}'] = (np.asarray(array), affine)
+    return dataset
+
+
+def samples(dataset):
+    """Files of a dataset without the shared labels (named after the output data types)."""
+    return {path: value for path, value in dataset.items() if not path.startswith('.labels')}
+
+
+def test_nifti_compression(input_files, tmp_path):
+    dataset = generate(input_files, tmp_path / 'default')
+    fast = generate(input_files, tmp_path / 'fast', compression_level=1)
+    assert_same_dataset(dataset, fast)
+    assert_same_dataset(dataset, generate(input_files, tmp_path / 'nii', output_format='nii'))
+    size = sum(path.stat().st_size for path in (tmp_path / 'default').rglob('*.nii.gz'))
+    assert size <= sum(path.stat().st_size for path in (tmp_path / 'fast').rglob('*.nii.gz'))
+
+
+def test_zarr_matches_nifti(input_files, tmp_path):
+    dataset = generate(input_files, tmp_path / 'nifti')
+    generate(input_files, tmp_path / 'zarr', output_format='zarr')
+    arrays = read_zarr_dataset(tmp_path / 'zarr')
+    assert_same_dataset(samples(dataset), arrays)
+
+
+def test_zarr_resume(input_files, tmp_path):
+    out_path = tmp_path / 'out'
+    generate(input_files, out_path, output_format='zarr')
+    arrays = read_zarr_dataset(out_path)
+    files = sorted(path for path in out_path.glob('*.zarr/**/*') if path.is_file())
+    mtimes = [path.stat().st_mtime_ns for path in files]
+    generate(input_files, out_path, output_format='zarr')
+    assert [path.stat().st_mtime_ns for path in files] == mtimes
+    removed = out_path / 'Ghosting_2.zarr' / '000001' / 'image'
+    for path in removed.rglob('*'):
+        if path.is_file():
+            path.unlink()
+    generate(input_files, out_path, output_format='zarr')
+    assert_same_dataset(arrays, read_zarr_dataset(out_path))
+
+
+def test_compact_nifti_dtypes(input_files, tmp_path):
+    dataset = samples(generate(input_files, tmp_path / 'float32'))
+    compact = samples(generate(input_files, tmp_path / 'compact', image_dtype='int16',
+                               label_dtype='uint8'))
+    assert dataset.keys() == compact.keys()
+    for path, (data, affine) in dataset.items():
+        values, compact_affine = compact[path]
+        np.testing.assert_allclose(compact_affine, affine, err_msg=path)
+        if path.endswith('_label'):
+            np.testing.assert_array_equal(values, data, err_msg=path)
+        else:   # scaled to the int16 range of each image
+            atol = np.abs(data).max() / 2 ** 14
+            np.testing.assert_allclose(values, data, rtol=0, atol=atol, err_msg=path)
+    image = next((tmp_path / 'compact').glob('*/*/*_image.nii.gz'))
+    assert nib.load(image).get_data_dtype() == np.int16
+    label = next((tmp_path / 'compact').glob('*/*/*_label.nii.gz'))
+    assert nib.load(label).get_data_dtype() == np.uint8
+
+
+def test_compact_zarr_dtypes(input_files, tmp_path):
+    dataset = generate(input_files, tmp_path / 'nifti')
+    generate(input_files, tmp_path / 'zarr', output_format='zarr', image_dtype='float16',
+             label_dtype='uint8')
+    for path, (values, _) in read_zarr_dataset(tmp_path / 'zarr').items():
+        assert values.dtype == (np.uint8 if path.endswith('_label') else np.float16)
+        np.testing.assert_allclose(values, dataset[path][0], rtol=1e-3, atol=1e-6,
+                                   err_msg=path)
+
+
+def test_compact_dtypes_resume(input_files, tmp_path):
+    out_path = tmp_path / 'out'
+    generate(input_files, out_path, image_dtype='int16', label_dtype='uint8')
+    paths = sorted(out_path.glob('*/*/*.nii.gz'))
+    mtimes = [path.stat().st_mtime_ns for path in paths]
+    generate(input_files, out_path, image_dtype='int16', label_dtype='uint8')
+    assert [path.stat().st_mtime_ns for path in paths] == mtimes
+    # other data types: every sample is written again
+    dataset = generate(input_files, out_path)
+    assert all(path.stat().st_mtime_ns != mtime for path, mtime in zip(paths, mtimes))
+    assert_same_dataset(samples(dataset),
+                        samples(generate(input_files, tmp_path / 'float32')))
@@ -0,0 +1,48 @@
+# Copyright (C) 2022  AICONS Lab
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import nibabel as nib
+import numpy as np
+
+from roodmri.data import DatasetGenerator
+
+
+def generate(input_files, out_path, **kwargs):
+    """Generate a dataset with the default transforms and return its files."""
+    kwargs.setdefault('seed', 3)
+    DatasetGenerator(input_files, str(out_path), **kwargs).generate_dataset()
+    return read_dataset(out_path)
+
+
+def read_dataset(out_path):
+    """
+    Map each NIfTI file in a dataset to (data, affine).
+
+    Files are keyed by their path relative to out_path, without the .nii or
+    .nii.gz extension.
+    """
+    dataset = dict()
+    for path in sorted(out_path.rglob('*.nii*')):
+        nifti = nib.load(path)
+        key = str(path.relative_to(out_path)).split('.nii')[0]
+        dataset[key] = (nifti.get_fdata(), nifti.affine)
+    return dataset
+
+
+def assert_same_dataset(dataset, other):
+    assert dataset.keys() == other.keys()
+    for path, (data, affine) in dataset.items():
+        np.testing.assert_array_equal(data, other[path][0], err_msg=path)
+        np.testing.assert_allclose(affine, other[path][1], err_msg=path)